@@ -0,0 +1,357 @@
+from collections import namedtuple
+import numpy as np
+import networkx as nx
+
+# Integer-indexed program graph for the hot paths (stencil enumeration,
+# matching, coverage). Nodes are 0..n-1, edges are numbered in the order
+# networkx's G.edges() would list them for the same graph.
+#	ids: original node id (LLVM pointer string, constant_3, ...) per node
+#	opcode: interned opcode per node, an index into opcodes
+#	opcodes: opcode names
+#	out_ptr, out_nbr: CSR successors; edge e goes to out_nbr[e]
+#	edge_src, edge_arg: source node and arg_num_at_dest of edge e
+#	in_ptr, in_nbr, in_edge: CSR predecessors and the edge they come in by
+CompactGraph = namedtuple('CompactGraph', ['ids', 'opcode', 'opcodes',
+	'out_ptr', 'out_nbr', 'edge_src', 'edge_arg', 'in_ptr', 'in_nbr', 'in_edge'])
+
+def _compact_graph(ids, opcode_names, edges):
+	opcodes = sorted(set(opcode_names))
+	opcode_to_code = {op: i for i, op in enumerate(opcodes)}
+	opcode = np.array([opcode_to_code[op] for op in opcode_names], dtype=np.int32)
+	n = len(ids)
+
+	# edges arrive in G.edges() order: grouped by source in node order
+	edge_src = np.array([s for s, t, arg in edges], dtype=np.int32)
+	out_nbr = np.array([t for s, t, arg in edges], dtype=np.int32)
+	edge_arg = np.array([arg for s, t, arg in edges], dtype=np.int32)
+	out_ptr = np.zeros(n + 1, dtype=np.int32)
+	np.cumsum(np.bincount(edge_src, minlength=n), out=out_ptr[1:])
+
+	in_edge = np.argsort(out_nbr, kind='stable').astype(np.int32)
+	in_nbr = edge_src[in_edge]
+	in_ptr = np.zeros(n + 1, dtype=np.int32)
+	np.cumsum(np.bincount(out_nbr, minlength=n), out=in_ptr[1:])
+
+	return CompactGraph(ids, opcode, opcodes, out_ptr, out_nbr, edge_src, edge_arg,
+		in_ptr, in_nbr, in_edge)
+
+# Build from the (V, E) returned by dfg.graph_from_json, with the same nodes
+# and edges graph2nx(V, E) would have
+#   Like a networkx DiGraph, a repeated (source, dest) pair is one edge that
+#   keeps its first position and its last arg_num_at_dest. A pointer that is
+#   also an instruction keeps the instruction's opcode.
+def compact_graph(V, E):
+	index = {}
+	for e in E:
+		index.setdefault(e.source, len(index))
+		index.setdefault(e.dest, len(index))
+	opcode_of = {}
+	for v in sorted(V):
+		if v.id not in opcode_of or opcode_of[v.id] == 'pointer':
+			opcode_of[v.id] = v.opcode
+		index.setdefault(v.id, len(index))
+	ids = list(index)
+
+	successors = [dict() for _ in ids]
+	for e in E:
+		successors[index[e.source]][index[e.dest]] = e.arg_num_at_dest
+	edges = [(s, t, arg) for s in range(len(ids)) for t, arg in successors[s].items()]
+	return _compact_graph(ids, [opcode_of.get(v, '') for v in ids], edges)
+
+def compact_from_nx(G):
+	index = {v: i for i, v in enumerate(G.nodes())}
+	edges = [(index[s], index[t], data.get('arg_num_at_dest', 0)) for s, t, data in G.edges(data=True)]
+	return _compact_graph(list(index), [G.nodes[v].get('opcode', '') for v in index], edges)
+
+# Returns: a networkx DiGraph laid out like graph2nx's, for visualize_graph and
+# anything else that wants networkx
+def compact_to_nx(C, **graphattrs):
+	G = nx.DiGraph()
+	G.add_nodes_from(C.ids)
+	for e in range(len(C.out_nbr)):
+		s, t = C.ids[C.edge_src[e]], C.ids[C.out_nbr[e]]
+		G.add_edge(s, t, source=s, dest=t, arg_num_at_dest=int(C.edge_arg[e]))
+	for v, v_id in enumerate(C.ids):
+		G.add_node(v_id, id=v_id, opcode=C.opcodes[C.opcode[v]])
+	for v in G:
+		G.nodes[v]['arity'] = G.in_degree(v)
+	G.graph = graphattrs
+	return G
+
+def node_index(C):
+	return {v_id: v for v, v_id in enumerate(C.ids)}
+
+def successors(C, v):
+	return C.out_nbr[C.out_ptr[v]:C.out_ptr[v + 1]]
+
+def predecessors(C, v):
+	return C.in_nbr[C.in_ptr[v]:C.in_ptr[v + 1]]
+
+# Returns: list of node arrays, one per weakly connected component, in order of
+# their first node
+#   edge_mask: if given, only the edges (by number) it's true for join nodes
+def weakly_connected_components(C, edge_mask=None):
+	n = len(C.ids)
+	src, dest = C.edge_src, C.out_nbr
+	if edge_mask is not None:
+		src, dest = src[edge_mask], dest[edge_mask]
+	# union-find, keeping the lowest node of each component as its root
+	parent = list(range(n))
+	def find(v):
+		while parent[v] != v:
+			parent[v] = parent[parent[v]]
+			v = parent[v]
+		return v
+	for s, t in zip(src.tolist(), dest.tolist()):
+		s, t = find(s), find(t)
+		if s != t:
+			parent[max(s, t)] = min(s, t)
+	roots, component = np.unique([find(v) for v in range(n)], return_inverse=True)
+	order = np.argsort(component, kind='stable')
+	bounds = np.cumsum(np.bincount(component, minlength=len(roots)))[:-1]
+	return np.split(order.astype(np.int32), bounds)
+
+# Returns: the subgraph of C induced by nodes (integers), as a CompactGraph
+#   whose node i is nodes[i]
+def induced_subgraph(C, nodes):
+	nodes = np.asarray(nodes, dtype=np.int64)
+	position = np.full(len(C.ids), -1, dtype=np.int64)
+	position[nodes] = np.arange(len(nodes))
+	src, dest = position[C.edge_src], position[C.out_nbr]
+	keep = np.flatnonzero((src >= 0) & (dest >= 0))
+	keep = keep[np.argsort(src[keep], kind='stable')]
+	edges = list(zip(src[keep].tolist(), dest[keep].tolist(), C.edge_arg[keep].tolist()))
+	return _compact_graph([C.ids[v] for v in nodes.tolist()], [C.opcodes[C.opcode[v]] for v in nodes.tolist()], edges)
+
+# Index of the labels of C for matching, built once per graph and reused by
+# every search in it. Edges are labelled (source opcode, dest opcode, arg).
+#	opcode_ptr, opcode_nodes: nodes with opcode c are
+#	         opcode_nodes[opcode_ptr[c]:opcode_ptr[c+1]]
+#	label_edges: edges sorted by label (then edge number)
+#	label_ranges: dict from (src opcode, dest opcode, arg), and from
+#	         (src opcode, dest opcode) for any arg, to a (start, end) slice of
+#	         label_edges
+#	out_key, out_edges: edges sorted by (source, dest opcode), with
+#	         out_key = source * number of opcodes + dest opcode, so the
+#	         successors of v with opcode c are a searchsorted slice
+#	in_key, in_edges: the same for predecessors, by (dest, source opcode)
+#	cache: neighbour and label lookups already done
+LabelIndex = namedtuple('LabelIndex', ['opcode_ptr', 'opcode_nodes', 'label_edges', 'label_ranges',
+	'out_key', 'out_edges', 'in_key', 'in_edges', 'cache'])
+
+def _label_index(C):
+	num_opcodes = len(C.opcodes)
+	opcode_nodes = np.argsort(C.opcode, kind='stable')
+	opcode_ptr = np.zeros(num_opcodes + 1, dtype=np.int64)
+	np.cumsum(np.bincount(C.opcode, minlength=num_opcodes), out=opcode_ptr[1:])
+
+	src_opcode = C.opcode[C.edge_src].astype(np.int64)
+	dest_opcode = C.opcode[C.out_nbr].astype(np.int64)
+	label_edges = np.lexsort((C.edge_arg, dest_opcode, src_opcode))
+	label_ranges = {}
+	labels = zip(src_opcode[label_edges].tolist(), dest_opcode[label_edges].tolist(),
+		C.edge_arg[label_edges].tolist())
+	for i, (s, d, arg) in enumerate(labels):
+		for label in ((s, d, arg), (s, d)):
+			start, _ = label_ranges.get(label, (i, i))
+			label_ranges[label] = (start, i + 1)
+
+	out_edges = np.lexsort((dest_opcode, C.edge_src))
+	out_key = (C.edge_src.astype(np.int64) * num_opcodes + dest_opcode)[out_edges]
+	in_edges = np.lexsort((src_opcode, C.out_nbr))
+	in_key = (C.out_nbr.astype(np.int64) * num_opcodes + src_opcode)[in_edges]
+	return LabelIndex(opcode_ptr, opcode_nodes, label_edges, label_ranges,
+		out_key, out_edges, in_key, in_edges, {})
+
+# the index of the graph last asked for, as each run matches in one graph
+_last_label_index = [None, None]
+
+# Returns: the LabelIndex of C, built on first use
+def label_index(C):
+	if _last_label_index[0] is not C:
+		_last_label_index[:] = [C, _label_index(C)]
+	return _last_label_index[1]
+
+def nodes_with_opcode(C, labels, code):
+	return labels.opcode_nodes[labels.opcode_ptr[code]:labels.opcode_ptr[code + 1]]
+
+# Returns: edges with the given opcodes at their ends, and arg if given
+def edges_with_label(C, labels, src_code, dest_code, arg=None):
+	label = (src_code, dest_code) if arg is None else (src_code, dest_code, arg)
+	start, end = labels.label_ranges.get(label, (0, 0))
+	return labels.label_edges[start:end]
+
+# Returns: list of successors (out) or predecessors of v with opcode code
+def neighbours_with_opcode(C, labels, v, code, out):
+	key = ('neighbours', v, code, out)
+	if key not in labels.cache:
+		keys, edges = (labels.out_key, labels.out_edges) if out else (labels.in_key, labels.in_edges)
+		k = v * len(C.opcodes) + code
+		edges = edges[np.searchsorted(keys, k):np.searchsorted(keys, k, side='right')]
+		labels.cache[key] = (C.out_nbr if out else C.edge_src)[edges].tolist()
+	return labels.cache[key]
+
+# Returns: list of nodes with opcode code and a successor (out) or
+#   predecessor with opcode other
+def nodes_with_neighbour(C, labels, code, other, out):
+	key = ('nodes', code, other, out)
+	if key not in labels.cache:
+		if out:
+			nodes = C.edge_src[edges_with_label(C, labels, code, other)]
+		else:
+			nodes = C.out_nbr[edges_with_label(C, labels, other, code)]
+		labels.cache[key] = np.unique(nodes).tolist()
+	return labels.cache[key]
+
+# Node-induced subgraph isomorphisms of H (a small networkx stencil) in C,
+# the same set subgraph_isomorphisms_iter of a DiGraphMatcher on opcodes finds
+# Yields: dict from ids of C to nodes of H
+def subgraph_isomorphisms(C, H, labels=None):
+	for _, match in subgraph_isomorphisms_many(C, [H], labels):
+		yield match
+
+# Search plan for one stencil: each component is matched breadth first from
+# the end of its rarest edge label with the fewest candidates, so its first
+# node only tries nodes with such an edge and every other node is found
+# through the edges of a matched neighbour. Each step is (opcode, anchor, out,
+# in, self loop, root label), where anchor is (earlier position, whether the
+# node is its successor) or None, out / in are the earlier positions it has
+# edges to / from, and root label is (opcode, is a successor) of a neighbour a
+# first node must have. Neighbours are taken in an order that only depends on
+# opcodes where possible, so that stencils with the same start get the same
+# first steps.
+# Returns: (steps, H node at each position), or None if H can't match in C
+def _search_plan(C, labels, H, opcode_to_code):
+	if any(H.nodes[u]['opcode'] not in opcode_to_code for u in H):
+		return None
+	want = {u: opcode_to_code[H.nodes[u]['opcode']] for u in H}
+	def rarity(u):
+		return (len(nodes_with_opcode(C, labels, want[u])), H.nodes[u]['opcode'])
+	def label_rarity(e):
+		s, t = e
+		return (len(edges_with_label(C, labels, want[s], want[t])),
+			H.nodes[s]['opcode'], H.nodes[t]['opcode'], str(s), str(t))
+
+	roots = []
+	for component in nx.weakly_connected_components(H):
+		edges = list(H.subgraph(component).edges())
+		if not edges:
+			u, = component
+			roots.append((rarity(u)[0], str(u), u, None))
+			continue
+		s, t = min(edges, key=label_rarity)
+		sources = nodes_with_neighbour(C, labels, want[s], want[t], True)
+		dests = nodes_with_neighbour(C, labels, want[t], want[s], False)
+		if len(sources) <= len(dests):
+			roots.append((len(sources), str(s), s, (want[t], True)))
+		else:
+			roots.append((len(dests), str(t), t, (want[s], False)))
+
+	order = []
+	anchors = []
+	root_labels = []
+	for _, _, root, root_label in sorted(roots, key=lambda r: r[:2]):
+		order.append(root)
+		anchors.append(None)
+		root_labels.append(root_label)
+		i = len(order) - 1
+		while i < len(order):
+			w = order[i]
+			# successors first, then predecessors
+			nbrs = [(False, rarity(u), str(u), u, True) for u in H.successors(w)] + \
+			       [(True, rarity(u), str(u), u, False) for u in H.predecessors(w)]
+			for _, _, _, u, w_to_u in sorted(nbrs, key=lambda n: n[:3]):
+				if u not in order:
+					order.append(u)
+					anchors.append((i, w_to_u))
+					root_labels.append(None)
+			i += 1
+	position = {u: i for i, u in enumerate(order)}
+	steps = []
+	for i, u in enumerate(order):
+		out_pos = frozenset(position[w] for w in H.successors(u) if position[w] < i)
+		in_pos = frozenset(position[w] for w in H.predecessors(u) if position[w] < i)
+		steps.append((want[u], anchors[i], out_pos, in_pos, H.has_edge(u, u), root_labels[i]))
+	return steps, order
+
+# Node-induced subgraph isomorphisms of every stencil of Hs in C, found in a
+# single search: the stencils' search plans are merged into a trie, so a
+# partial match shared by several stencils is only found once
+#   labels: the LabelIndex of C, label_index(C) by default
+# Yields: (index into Hs, dict from ids of C to nodes of that stencil)
+def subgraph_isomorphisms_many(C, Hs, labels=None):
+	if labels is None:
+		labels = label_index(C)
+	opcode_to_code = {op: i for i, op in enumerate(C.opcodes)}
+	# trie of steps: children of each trie node, and the stencils (with their
+	# H node at each position) whose plan ends there
+	children = [{}]
+	ends = [[]]
+	for s, H in enumerate(Hs):
+		plan = _search_plan(C, labels, H, opcode_to_code)
+		if plan is None:
+			continue
+		steps, order = plan
+		t = 0
+		for step in steps:
+			if step not in children[t]:
+				children[t][step] = len(children)
+				children.append({})
+				ends.append([])
+			t = children[t][step]
+		ends[t].append((s, order))
+
+	out_sets = {}
+	def out_set(v):
+		if v not in out_sets:
+			out_sets[v] = set(successors(C, v).tolist())
+		return out_sets[v]
+
+	f = []
+	def extend(t):
+		for s, order in ends[t]:
+			yield s, {C.ids[v]: order[j] for j, v in enumerate(f)}
+		for (code, anchor, out_pos, in_pos, self_loop, root_label), child in children[t].items():
+			if anchor is not None:
+				j, w_to_v = anchor
+				candidates = neighbours_with_opcode(C, labels, f[j], code, w_to_v)
+			elif root_label is not None:
+				candidates = nodes_with_neighbour(C, labels, code, *root_label)
+			else:
+				candidates = nodes_with_opcode(C, labels, code).tolist()
+			for v in candidates:
+				if v in f:
+					continue
+				v_out = out_set(v)
+				if self_loop != (v in v_out):
+					continue
+				if any(((j in out_pos) != (w in v_out)) or ((j in in_pos) != (v in out_set(w)))
+				       for j, w in enumerate(f)):
+					continue
+				f.append(v)
+				yield from extend(child)
+				f.pop()
+	yield from extend(0)
+
+# Returns: boolean mask over the nodes of C, true for nodes in any of matches
+def covered_mask(C, matches, index=None):
+	if index is None:
+		index = node_index(C)
+	covered = np.zeros(len(C.ids), dtype=bool)
+	nodes = [index[v] for m in matches for v in m['node_matches']]
+	covered[np.array(nodes, dtype=np.int64)] = True
+	return covered
+
+# Returns: the networkx subgraph of C made of the given (integer) edges, with
+#   the node and edge attributes graph2nx gives the whole program graph
+def edge_subgraph(C, edge_list):
+	H = nx.DiGraph()
+	out_edges = {}
+	for s, t in edge_list:
+		if s not in out_edges:
+			out_edges[s] = dict(zip(successors(C, s).tolist(), range(C.out_ptr[s], C.out_ptr[s + 1])))
+		s_id, t_id = C.ids[s], C.ids[t]
+		H.add_edge(s_id, t_id, source=s_id, dest=t_id, arg_num_at_dest=int(C.edge_arg[out_edges[s][t]]))
+	for v in sorted({v for e in edge_list for v in e}):
+		H.add_node(C.ids[v], id=C.ids[v], opcode=C.opcodes[C.opcode[v]], arity=int(C.in_ptr[v + 1] - C.in_ptr[v]))
+	return H
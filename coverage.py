@@ -0,0 +1,121 @@
+from collections import namedtuple
+from statistics import NormalDist
+import numpy as np
+
+# Coverage of a program graph by stencils, on a boolean mask of its nodes. The
+# matches of each stencil are kept as rows of integer nodes, so applying a
+# stencil is one vectorised step over all its matches rather than a graph
+# edit per match, and scoring a combination of stencils takes a few array
+# operations: cheap enough for a selection heuristic to ask thousands of times
+# a second.
+#	rows: the matches of each stencil, a 2d array with a row of nodes each
+#	ptr, nodes: distinct nodes the matches of stencil i cover are
+#	         nodes[ptr[i]:ptr[i+1]]
+#	weight: weight of each node; 1 for instructions and 0 for the constants,
+#	         arguments and other nodes that aren't, unless weighted otherwise
+#	unit: the sampled unit (e.g. block) each node is in, numbered from 0, -1
+#	         for nodes in none; None unless the graph is a sample
+#	num_units: number of units the sample was drawn from
+CoverageTable = namedtuple('CoverageTable', ['rows', 'ptr', 'nodes', 'weight', 'unit', 'num_units'])
+
+# An estimate of the fraction of weight covered, from a sample of units
+#	coverage: ratio estimate of the fraction covered
+#	low, high: confidence interval around it
+#	units_sampled, num_units: units in the sample, and in the whole graph
+Estimate = namedtuple('Estimate', ['coverage', 'low', 'high', 'units_sampled', 'num_units'])
+
+# Returns: CoverageTable of the given matches
+#   rows: list per stencil of its matches, as 2d arrays of integer nodes
+#   weight: array of the weight of each node of the graph
+def coverage_table(rows, weight, unit=None, num_units=None):
+	rows = [np.asarray(r, dtype=np.int64) for r in rows]
+	covered = [np.unique(r) for r in rows]
+	ptr = np.zeros(len(rows) + 1, dtype=np.int64)
+	np.cumsum([len(c) for c in covered], out=ptr[1:])
+	nodes = np.concatenate(covered + [np.zeros(0, dtype=np.int64)])
+	return CoverageTable(rows, ptr, nodes, np.asarray(weight, dtype=float), unit, num_units)
+
+def empty_mask(table):
+	return np.zeros(len(table.weight), dtype=bool)
+
+# Apply the matches of stencil i that none of the covered nodes are in, all at
+# once: overlapping matches among them cover their shared nodes once
+# Returns: weight this newly covers, having set it in covered
+def apply_stencil(table, covered, i):
+	rows = table.rows[i]
+	if not len(rows):
+		return 0.0
+	free = rows[~covered[rows].any(axis=1)]
+	newly = np.unique(free)
+	covered[newly] = True
+	return float(table.weight[newly].sum())
+
+# Returns: mask of the nodes covered by applying stencils in turn, each only
+#   where the ones before it left every node of a match uncovered
+def sequential_coverage(table, stencils, covered=None):
+	covered = empty_mask(table) if covered is None else covered.copy()
+	for i in stencils:
+		apply_stencil(table, covered, i)
+	return covered
+
+# Returns: mask of the nodes in any match of any of stencils, which bounds
+#   what they can cover together (see selection.py)
+def union_coverage(table, stencils):
+	covered = empty_mask(table)
+	segments = [table.nodes[table.ptr[i]:table.ptr[i + 1]] for i in stencils]
+	if segments:
+		covered[np.concatenate(segments)] = True
+	return covered
+
+def covered_weight(table, covered):
+	return float(table.weight @ covered)
+
+# Returns: fraction of the graph's weight the covered nodes hold
+def covered_fraction(table, covered):
+	total = table.weight.sum()
+	return covered_weight(table, covered) / total if total else 0.0
+
+# Returns: nodes of C in a random sample of its units, the unit each is in
+#   (renumbered in the sample from 0, -1 for the rest), and the number of units
+#   unit: unit of each node of C, -1 for nodes in none, which are included
+#         when they neighbour a sampled node, so matches of stencils with
+#         constants or arguments are found in the sample too
+#   fraction: of the units to sample, at least one
+def sample_units(C, unit, fraction, seed=0):
+	units = np.unique(unit[unit >= 0])
+	size = min(len(units), max(1, int(round(fraction * len(units)))))
+	chosen = np.sort(np.random.default_rng(seed).choice(units, size, replace=False))
+	sampled = np.isin(unit, chosen)
+	# nodes in no unit next to a sampled node, over edges either way
+	outside = (unit < 0)
+	near = np.zeros(len(unit), dtype=bool)
+	near[C.out_nbr[sampled[C.edge_src]]] = True
+	near[C.edge_src[sampled[C.out_nbr]]] = True
+	nodes = np.flatnonzero(sampled | (outside & near))
+	sample_unit = np.where(sampled[nodes], np.searchsorted(chosen, unit[nodes]), -1)
+	return nodes, sample_unit, len(units)
+
+# Returns: Estimate of the fraction of weight covered in the whole graph, from
+#   the covered nodes of a sample's table
+#   The units are a simple random sample (without replacement), each a cluster
+#   of nodes, so this is the ratio estimator of cluster sampling: covered over
+#   total weight of the sample, with a normal interval from the variance of
+#   the units' residuals, scaled down as the sample nears all the units.
+#   Matches across units are only found when all their units are sampled;
+#   units no stencil's matches cross (weakly connected components of the
+#   instructions, for stencils of connected instructions) leave no bias.
+def estimate_coverage(table, covered, confidence=0.95):
+	in_unit = table.unit >= 0
+	num_sampled = int(table.unit.max()) + 1 if in_unit.any() else 0
+	total = np.bincount(table.unit[in_unit], weights=table.weight[in_unit], minlength=num_sampled)
+	hit = np.bincount(table.unit[in_unit], weights=(table.weight * covered)[in_unit], minlength=num_sampled)
+	if not total.sum():
+		return Estimate(0.0, 0.0, 0.0, num_sampled, table.num_units)
+	ratio = float(hit.sum() / total.sum())
+	if num_sampled < 2:
+		return Estimate(ratio, 0.0, 1.0, num_sampled, table.num_units)
+	residual = hit - ratio * total
+	variance = ((1 - num_sampled / table.num_units) * (residual @ residual) / (num_sampled - 1)
+	            / (num_sampled * total.mean() ** 2))
+	half = NormalDist().inv_cdf((1 + confidence) / 2) * float(np.sqrt(variance))
+	return Estimate(ratio, max(0.0, ratio - half), min(1.0, ratio + half), num_sampled, table.num_units)
@@ -1,4 +1,5 @@
 #include "json.hpp"
+#include "llvm/ADT/DenseMap.h"
 #include "llvm/Analysis/IVUsers.h"
 #include "llvm/IR/Function.h"
 #include "llvm/IR/LegacyPassManager.h"
@@ -16,6 +17,10 @@
 #include <sstream>
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <unistd.h>
 
 #include "Shared.h"
 
@@ -53,6 +58,27 @@ namespace {
     cl::init(false) // Default value
   );
 
+  // -jobs is a command line argument to opt
+  static cl::opt<int> Jobs(
+    "jobs", // Name of command line arg
+    cl::desc("Specify the number of processes the python program mines stencils with"), // -help
+    cl::init(1) // Default value
+  );
+
+  // -matcher-server is a command line argument to opt
+  static cl::opt<bool> MatcherServer(
+    "matcher-server", // Name of command line arg
+    cl::desc("Specify whether to run the python program on a long-lived server (dfg_server.py)"), // -help
+    cl::init(false) // Default value
+  );
+
+  // -exchange-format is a command line argument to opt
+  static cl::opt<string> ExchangeFormat(
+    "exchange-format", // Name of command line arg
+    cl::desc("Specify the format of the graph and matches exchanged with the python program (ndjson, or json to debug)"), // -help
+    cl::init("ndjson") // Default value
+  );
+
     // -profiling is a command line argument to opt
   static cl::opt<bool> Profiling(
     "profiling", // Name of command line arg
@@ -60,11 +86,39 @@ namespace {
     cl::init(true) // Default value
   );
 
+  // A match read back from the python program, shared by its instructions
+  struct StencilMatch {
+    string TemplateId;
+    int MatchIdx;
+  };
+
+  // What an instruction matched: an index into the matches (-1 if it
+  // wasn't matched) and the stencil node it matched
+  struct InstructionMatch {
+    int Match = -1;
+    string TemplateNode;
+  };
+
   struct DFGPass : public ModulePass {
     static char ID;
+    // Records of the graph, in json mode; in ndjson mode they're written to
+    // DFGFile as they're built
     json DestinationToOperands;
+    ofstream DFGFile;
+    // Dense ids of the values in the graph, and in json mode the pointer
+    // strings the python program knows them by
+    DenseMap<const Value *, unsigned> ValueIds;
+    map<string, unsigned> PointerIds;
     int TotalInstructions = 0;
     int InstructionsMatched = 0;
+    // Blocks of the module seen so far; in module order, so these are the ids
+    // profiling gives the blocks too
+    int NumBlocks = 0;
+    // Per basic block instrumented for profiling, by block id: instructions
+    // matched and in total, and the function it's in
+    vector<uint32_t> BlockMatched;
+    vector<uint32_t> BlockTotal;
+    vector<string> BlockFunction;
     Function *Increment;
     Function *SaveStatic;
     Function *SaveStaticWrapper;
@@ -90,6 +144,19 @@ namespace {
       return PtrStream.str();
     }
 
+    // Returns: the id of V in the graph: its dense id, or in json mode its
+    // pointer, which is easier to follow when debugging
+    string valueId(Value &V) {
+      auto Inserted = ValueIds.insert({&V, ValueIds.size()});
+      unsigned Id = Inserted.first->second;
+      if (ExchangeFormat == "json") {
+        string Ptr = stringifyPtr(V);
+        PointerIds[Ptr] = Id;
+        return Ptr;
+      }
+      return to_string(Id);
+    }
+
     string stringifyType(Type *T) {
       string TypeString;
       raw_string_ostream TypeStream(TypeString);
@@ -134,11 +201,11 @@ namespace {
           //errs() << "Different parents " << *OpInstruction << I << "\n";
           OpJson["description"] = "instruction-external";
           OpJson["type"] = stringifyType(Op->getType());
-          OpJson["value"] = stringifyPtr(*OpInstruction);
+          OpJson["value"] = valueId(*OpInstruction);
         } else {
           OpJson["description"] = "instruction";
           OpJson["type"] = stringifyType(Op->getType());
-          OpJson["value"] = stringifyPtr(*OpInstruction);
+          OpJson["value"] = valueId(*OpInstruction);
         }
       } else if (ConstantInt *OpConstant = dyn_cast<ConstantInt>(Op)) {
         OpJson["description"] = "constant";
@@ -151,14 +218,14 @@ namespace {
       } else if (Argument *OpArgument = dyn_cast<Argument>(Op)) {
         OpJson["description"] = "argument";
         OpJson["type"] = stringifyType(Op->getType());
-        OpJson["value"] = stringifyPtr(*OpArgument);
+        OpJson["value"] = valueId(*OpArgument);
         OpJson["argument_number_in_function"] = OpArgument->getArgNo();
       } else if (DerivedUser *OpDerivedUser = dyn_cast<DerivedUser>(Op)) {
         // all pointer operands seem to be of DerivedUser type
         if (PointerType *t = dyn_cast<PointerType>(Op->getType())) {
           OpJson["description"] = "pointer";
           OpJson["type"] = stringifyType(Op->getType());
-          OpJson["value"] = stringifyPtr(*OpDerivedUser);
+          OpJson["value"] = valueId(*OpDerivedUser);
         } else if (UndefValue *Und = dyn_cast<UndefValue>(Op)) {
           errs() << "Skipping UndefValue\n";
         }
@@ -169,31 +236,169 @@ namespace {
       return OpJson;
     }
 
+    // Content hash of the instructions of Blocks as the DFG has them: their
+    // opcodes, types and operands, with operands that are instructions of
+    // Blocks referred to by position rather than by pointer, so the hash only
+    // changes when the code does. FNV-1a, as llvm::hash_value may be seeded
+    // differently from run to run.
+    string contentHash(const vector<BasicBlock *> &Blocks) {
+      DenseMap<const Instruction *, unsigned> Position;
+      for (auto *B : Blocks) {
+        for (auto &I : *B) {
+          if (!skipInstruction(I)) {
+            unsigned P = Position.size();
+            Position[&I] = P;
+          }
+        }
+      }
+
+      uint64_t Hash = 14695981039346656037ULL;
+      for (auto *B : Blocks) {
+        for (auto &I : *B) {
+          if (skipInstruction(I)) continue;
+          json InstrJson;
+          InstrJson["opcode"] = I.getOpcodeName();
+          InstrJson["type"] = stringifyType(I.getType());
+          InstrJson["operands"] = {};
+          for (auto &Op : I.operands()) {
+            if (skipOperand(Op)) continue;
+            json OpJson = jsonPerOperand(Op, I);
+            if (OpJson == nullptr) continue;
+            if (OpJson["description"] == "instruction") {
+              auto It = Position.find(cast<Instruction>(Op));
+              OpJson["value"] = It == Position.end() ? -1 : (int)It->second;
+            } else if (OpJson["description"] == "pointer") {
+              OpJson["value"] = Op->getName().str();
+            } else {
+              OpJson.erase("value");
+            }
+            InstrJson["operands"].push_back(OpJson);
+          }
+          InstrJson["out"] = any_of(I.users(), [&](User *U) {
+            auto *UInst = dyn_cast<Instruction>(U);
+            return UInst && UInst->getParent() != I.getParent();
+          });
+          for (unsigned char C : InstrJson.dump() + "\n") {
+            Hash = (Hash ^ C) * 1099511628211ULL;
+          }
+        }
+      }
+      return formatv("{0:x-16}", Hash);
+    }
+
+    // Connect to the dfg_server.py listening on SocketPath
+    // Returns: the connected socket, or -1 if there's no server
+    int connectToMatcherServer(const string &SocketPath) {
+      struct sockaddr_un Address = {};
+      if (SocketPath.size() >= sizeof(Address.sun_path)) {
+        return -1;
+      }
+      Address.sun_family = AF_UNIX;
+      strncpy(Address.sun_path, SocketPath.c_str(), sizeof(Address.sun_path) - 1);
+      int Socket = socket(AF_UNIX, SOCK_STREAM, 0);
+      if (Socket < 0) {
+        return -1;
+      }
+      if (connect(Socket, (struct sockaddr *)&Address, sizeof(Address)) < 0) {
+        close(Socket);
+        return -1;
+      }
+      return Socket;
+    }
+
+    // Run dfg.py with Args on a dfg_server.py server (see there for the
+    // protocol), starting one if none is running, and print its output
+    // Returns: whether it ran, false if the caller should run dfg.py itself
+    bool runOnMatcherServer(const vector<string> &Args) {
+      const char *EnvSocket = getenv("DFG_SERVER_SOCKET");
+      string SocketPath = EnvSocket ? EnvSocket
+        : "/tmp/dfg-coverings-" + to_string(getuid()) + ".sock";
+
+      int Socket = connectToMatcherServer(SocketPath);
+      if (Socket < 0) {
+        // options go before the command
+        string StartServer = "python3 dfg_server.py --socket " + SocketPath + " start";
+        if (system(StartServer.c_str()) != 0) {
+          return false;
+        }
+        Socket = connectToMatcherServer(SocketPath);
+        if (Socket < 0) {
+          return false;
+        }
+      }
+
+      char Cwd[4096];
+      if (!getcwd(Cwd, sizeof(Cwd))) {
+        close(Socket);
+        return false;
+      }
+      json Request;
+      Request["cwd"] = Cwd;
+      Request["argv"] = Args;
+      string Message = Request.dump() + "\n";
+      for (size_t Sent = 0; Sent < Message.size(); ) {
+        ssize_t N = write(Socket, Message.data() + Sent, Message.size() - Sent);
+        if (N <= 0) {
+          close(Socket);
+          return false;
+        }
+        Sent += N;
+      }
+
+      string Response;
+      char Buffer[1 << 16];
+      ssize_t N;
+      while ((N = read(Socket, Buffer, sizeof(Buffer))) > 0) {
+        Response.append(Buffer, N);
+      }
+      close(Socket);
+
+      json ResponseJson = json::parse(Response, nullptr, false);
+      if (ResponseJson.is_discarded()) {
+        errs() << "Bad response from matcher server, running dfg.py directly\n";
+        return false;
+      }
+      outs() << ResponseJson["output"].get<string>();
+      outs().flush();
+      return true;
+    }
+
     virtual bool runOnModule(Module &M) {
 
       if (Profiling) {
         declareProfilingFunctions(&M);
       }
 
+      startDFG();
       for (auto &F : M) {
         dfgPerFunction(F);
       }
+      finishDFG();
 
-      writeOutJsonDFG();
-      //string
-      string CallPython = "python3 dfg.py " + (string)(IsInteractive ? "-i " : "")
-        + "--input " + OutputFilename;
+      vector<string> Args = {"--input", OutputFilename,
+        "--exchange-format", ExchangeFormat};
       if (!StencilJsonFilename.empty()) {
-        CallPython += " --stencil-json " + StencilJsonFilename;
+        Args.insert(Args.end(), {"--stencil-json", StencilJsonFilename});
+      }
+      if (Jobs > 1) {
+        Args.insert(Args.end(), {"--jobs", to_string(Jobs)});
+      }
+      // The server has no terminal to pause on, so interactive runs always
+      // call python directly
+      if (!MatcherServer || IsInteractive || !runOnMatcherServer(Args)) {
+        string CallPython = "python3 dfg.py " + (string)(IsInteractive ? "-i" : "");
+        for (auto &Arg : Args) {
+          CallPython += " " + Arg;
+        }
+        system(CallPython.c_str());
       }
-      system(CallPython.c_str());
-
-      json MatchesJson = readInJsonMatches();
 
-      auto PerInstruction = jsonToInstructionMatches(MatchesJson);
+      vector<StencilMatch> Matches;
+      vector<InstructionMatch> PerInstruction;
+      readMatches(Matches, PerInstruction);
 
       for (auto &F : M) {
-        annotateMatchesPerFunction(PerInstruction, F);
+        annotateMatchesPerFunction(Matches, PerInstruction, F);
       }
 
       string S = formatv("{0}/{1} ({2:P}) static instructions matched\n",
@@ -213,13 +418,17 @@ namespace {
       auto VoidType = Type::getVoidTy(M->getContext());
       auto VoidFunType = FunctionType::get(VoidType, {}, /*isVarArg*/false);
       auto IntType = Type::getInt32Ty(M->getContext());
-      auto FunType = FunctionType::get(VoidType, {IntType, IntType},
+      auto IncrementType = FunctionType::get(VoidType, {IntType},
         /*isVarArg*/false);
-      Increment = Function::Create(FunType, Function::ExternalLinkage,
-        "incremementCounts", M);
+      Increment = Function::Create(IncrementType, Function::ExternalLinkage,
+        "incrementBlockCount", M);
 
       // To save static types, wrap the function with args with one without args
-      SaveStatic = Function::Create(FunType, Function::ExternalLinkage,
+      auto StringPtrType = Type::getInt8PtrTy(M->getContext())->getPointerTo();
+      auto SaveStaticType = FunctionType::get(VoidType, {IntType, IntType,
+        IntType, IntType->getPointerTo(), IntType->getPointerTo(),
+        StringPtrType}, /*isVarArg*/false);
+      SaveStatic = Function::Create(SaveStaticType, Function::ExternalLinkage,
        "saveStaticCounts", M);
       SaveStaticWrapper = Function::Create(VoidFunType,
         Function::ExternalLinkage, "saveStaticCountsWrapper", M);
@@ -237,37 +446,124 @@ namespace {
       Type *IntTy = IntegerType::getInt32Ty(M.getContext());
       Constant *MatchedArg = ConstantInt::get(IntTy, Matched, false);
       Constant *TotalArg = ConstantInt::get(IntTy, Total, false);
-      builder.CreateCall(SaveStatic, {MatchedArg, TotalArg});
+      Constant *NumBlocksArg = ConstantInt::get(IntTy, BlockMatched.size(),
+        false);
+
+      // The runtime scales each block's executions by these to get the
+      // dynamic counts
+      auto IntArray = [&](const vector<uint32_t> &Values, StringRef Name) {
+        Constant *Init = ConstantDataArray::get(M.getContext(), Values);
+        auto *G = new GlobalVariable(M, Init->getType(), /*isConstant*/true,
+          GlobalValue::PrivateLinkage, Init, Name);
+        return ConstantExpr::getPointerCast(G, IntTy->getPointerTo());
+      };
+      Constant *MatchedArray = IntArray(BlockMatched, "block_matched");
+      Constant *TotalArray = IntArray(BlockTotal, "block_total");
+
+      // One name string per function, shared by its blocks
+      map<string, Constant *> FunctionNames;
+      vector<Constant *> Names;
+      for (auto &Name : BlockFunction) {
+        auto It = FunctionNames.find(Name);
+        if (It == FunctionNames.end()) {
+          It = FunctionNames.emplace(Name,
+            cast<Constant>(builder.CreateGlobalStringPtr(Name))).first;
+        }
+        Names.push_back(It->second);
+      }
+      Type *StringTy = Type::getInt8PtrTy(M.getContext());
+      ArrayType *NamesTy = ArrayType::get(StringTy, Names.size());
+      auto *NamesGlobal = new GlobalVariable(M, NamesTy, /*isConstant*/true,
+        GlobalValue::PrivateLinkage, ConstantArray::get(NamesTy, Names),
+        "block_function");
+      Constant *NamesArray = ConstantExpr::getPointerCast(NamesGlobal,
+        StringTy->getPointerTo());
+
+      builder.CreateCall(SaveStatic, {MatchedArg, TotalArg, NumBlocksArg,
+        MatchedArray, TotalArray, NamesArray});
       builder.CreateRet(nullptr);
     }
 
-    void writeOutJsonDFG() {
-      ofstream JsonFile;
-      JsonFile.open(OutputFilename);
-      JsonFile << DestinationToOperands.dump(4) << "\n";
-      JsonFile.close();
+    void startDFG() {
+      if (ExchangeFormat != "json") {
+        DFGFile.open(OutputFilename);
+      }
+    }
+
+    // Write a record of the graph: in ndjson mode one per line as it's
+    // built, in json mode at the end, as one list
+    void writeRecord(const json &Record) {
+      if (ExchangeFormat == "json") {
+        DestinationToOperands.push_back(Record);
+      } else {
+        DFGFile << Record.dump() << "\n";
+      }
     }
 
-    json readInJsonMatches() {
-      ifstream JsonFile;
-      stringstream Buffer;
+    void finishDFG() {
+      if (ExchangeFormat == "json") {
+        DFGFile.open(OutputFilename);
+        DFGFile << DestinationToOperands.dump(4) << "\n";
+      }
+      DFGFile.close();
+    }
 
+    // Read the matches the python program wrote, in one pass, into the match
+    // of each instruction by id. The file is either ndjson (one match per
+    // line) or a json list of matches.
+    void readMatches(vector<StencilMatch> &Matches,
+        vector<InstructionMatch> &PerInstruction) {
       size_t Pos = OutputFilename.find(".json");
       if (Pos == string::npos) {
         errs() << "Expected output filename to include .json suffix\n";
         exit(1);
       }
-      string MatchesFilename = OutputFilename.replace(Pos, OutputFilename.length(),
-        "-matches.json");
+      string MatchesFilename = OutputFilename.substr(0, Pos) + "-matches.json";
+
+      PerInstruction.assign(ValueIds.size(), InstructionMatch());
+      auto AddMatch = [&](const json &Match) {
+        Matches.push_back({Match[TemplateId].get<string>(),
+          Match[MatchIdx].get<int>()});
+        for (auto &[Key, Value] : Match[TemplateNode].items()) {
+          unsigned Id;
+          if (ExchangeFormat == "json") {
+            auto It = PointerIds.find(Key);
+            if (It == PointerIds.end()) continue;
+            Id = It->second;
+          } else {
+            Id = stoul(Key);
+          }
+          if (Id >= PerInstruction.size()) continue;
+          PerInstruction[Id].Match = Matches.size() - 1;
+          PerInstruction[Id].TemplateNode = Value.get<string>();
+        }
+      };
 
-      JsonFile.open(MatchesFilename);
-      Buffer << JsonFile.rdbuf();
-      JsonFile.close();
-      return json::parse(Buffer.str());
+      ifstream MatchesFile(MatchesFilename);
+      if ((MatchesFile >> ws).peek() == '[') {
+        for (auto &Match : json::parse(MatchesFile)) {
+          AddMatch(Match);
+        }
+      } else {
+        string Line;
+        while (getline(MatchesFile, Line)) {
+          if (!Line.empty()) {
+            AddMatch(json::parse(Line));
+          }
+        }
+      }
     }
 
     void dfgPerFunction(Function &F) {
+      vector<BasicBlock *> Blocks;
       for (auto &B : F) {
+        Blocks.push_back(&B);
+      }
+      string FunctionHash = contentHash(Blocks);
+
+      for (auto &B : F) {
+        int BlockId = NumBlocks++;
+        string BlockHash = contentHash({&B});
         for (auto &I : B) {
 
           TotalInstructions++;
@@ -277,10 +573,13 @@ namespace {
 
           // Add instruction (identified by pointer) to the json
           json InstrJson;
-          InstrJson["pointer"] = stringifyPtr(I);
+          InstrJson["pointer"] = valueId(I);
           InstrJson["text"] = stringifyValue(I);
           InstrJson["opcode"] = I.getOpcodeName();
           InstrJson["type"] = stringifyType(I.getType());
+          InstrJson["block"] = BlockId;
+          InstrJson["block_hash"] = BlockHash;
+          InstrJson["function_hash"] = FunctionHash;
           InstrJson["operands"] = {};
 
           // Add incoming edges from operands where applicable
@@ -311,30 +610,16 @@ namespace {
 
           if (ExternalUse.hasValue()) {
             json OutJson;
-            OutJson["pointer"] = stringifyPtr(*ExternalUse.getValue());
+            OutJson["pointer"] = valueId(*ExternalUse.getValue());
             OutJson["description"] = "out";
             OutJson["type"] = stringifyType(ExternalUse.getValue()->getType());
-            OutJson["value"] = stringifyPtr(I);
-            DestinationToOperands.push_back(OutJson);
+            OutJson["value"] = valueId(I);
+            writeRecord(OutJson);
           }
 
-          DestinationToOperands.push_back(InstrJson);
-        }
-      }
-    }
-
-    // Map from individual instruction to the match data for quick lookup
-    map<string, json> jsonToInstructionMatches(json Matches) {
-      map<string, json> PerInstruction;
-
-      for (json &Match : Matches) {
-        for (auto &[Key, Value] : Match["node_matches"].items()) {
-          string Instruction = Key;
-          PerInstruction[Instruction] = Match;
+          writeRecord(InstrJson);
         }
       }
-
-      return PerInstruction;
     }
 
     void addMetadataString(Instruction *I, string Name, string Md) {
@@ -343,42 +628,41 @@ namespace {
       I->setMetadata(Name, Node);
     }
 
-    void annotateMatchesPerFunction(map<string, json> Matches, Function &F) {
+    void annotateMatchesPerFunction(const vector<StencilMatch> &Matches,
+        const vector<InstructionMatch> &PerInstruction, Function &F) {
       for (auto &B : F) {
         int BlockMatchedInstructions = 0;
 
         for (auto &I : B) {
 
           // Skip instructions that were not matched
-          string IPtr = stringifyPtr(I);
-          if (Matches.find(IPtr) == Matches.end()) continue;
+          auto Id = ValueIds.find(&I);
+          if (Id == ValueIds.end() || PerInstruction[Id->second].Match < 0) continue;
 
           InstructionsMatched++;
           BlockMatchedInstructions++;
-          json MatchJson = Matches[IPtr];
-
-          string TemplateIdStr = (string)MatchJson[TemplateId];
-          addMetadataString(&I, TemplateId, TemplateIdStr);
+          const InstructionMatch &IMatch = PerInstruction[Id->second];
+          const StencilMatch &Match = Matches[IMatch.Match];
 
-          string MatchIdxStr = to_string((int)(MatchJson[MatchIdx]));
-          addMetadataString(&I, MatchIdx, MatchIdxStr);
-
-          string TemplateNodeStr = MatchJson[TemplateNode][IPtr];
-          addMetadataString(&I, TemplateNode, TemplateNodeStr);
+          addMetadataString(&I, TemplateId, Match.TemplateId);
+          addMetadataString(&I, MatchIdx, to_string(Match.MatchIdx));
+          addMetadataString(&I, TemplateNode, IMatch.TemplateNode);
         }
 
-        // If instrumenting profiling, increment counters
+        // If instrumenting profiling, count the block's executions by its
+        // id; its static counts are passed to the runtime once, at startup
         if (Profiling) {
           int BlockTotalInstructions = distance(B.begin(), B.end());
 
           Type *IntTy = IntegerType::getInt32Ty(F.getContext());
-          Constant *Matched = ConstantInt::get(IntTy, BlockMatchedInstructions,
-            false);
-          Constant *Total = ConstantInt::get(IntTy, BlockTotalInstructions,
+          Constant *BlockId = ConstantInt::get(IntTy, BlockMatched.size(),
             false);
+          BlockMatched.push_back(BlockMatchedInstructions);
+          BlockTotal.push_back(BlockTotalInstructions);
+          BlockFunction.push_back(F.getName());
 
           Instruction *Term = B.getTerminator();
-          auto Call = CallInst::Create(Increment, {Matched, Total}, "", Term);
+          auto Call = CallInst::Create(Increment, {BlockId}, "", Term);
         }
       }
     }
@@ -1,12 +1,28 @@
+import os
+import sys
 import json
 import argparse
 from collections import namedtuple, defaultdict
 from graphviz import Digraph
+import graphviz
 import networkx as nx
 from networkx import isomorphism
 import itertools
 import time
 import csv
+import math
+import heapq
+import pickle
+import contextlib
+import html
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import compact_graph
+import dfg_cache
+import selection
+import coverage
+import exclusive
+import metrics
 
 Vertex = namedtuple('Vertex', ['id', 'opcode'])
 Edge = namedtuple('Edge', ['source', 'dest', 'arg_num_at_dest'])
@@ -15,6 +31,18 @@ acceptable_identifiers = ['template_id', 'template_ID', 'name']
 opcodes_with_side_effects = ["ret", "br", "call", "out", "store", "load"]
 unacceptable_subgraph_nodes = ['argument', 'constant', 'external'] + opcodes_with_side_effects
 
+# Returns: list of the records (instructions or matches) in a file exchanged
+#   with DFGPass: either one json object per line (ndjson, which the pass
+#   writes by default) or a json list (its -exchange-format=json)
+def read_records(f):
+	first = f.read(1)
+	while first.isspace():
+		first = f.read(1)
+	f.seek(0)
+	if first == '[':
+		return json.load(f)
+	return [json.loads(line) for line in f if line.strip()]
+
 # Returns:
 #	V: list of Vertices
 #	E: list of Edges
@@ -22,8 +50,8 @@ unacceptable_subgraph_nodes = ['argument', 'constant', 'external'] + opcodes_wit
 #    vertex named 'constant', same for 'argument')
 def graph_from_json(fn):
 	instructions = {}
-	with open(fn, 'r') as f:
-		instructions = json.load(f)
+	with metrics.phase('json-load'), open(fn, 'r') as f:
+		instructions = read_records(f)
 	V = set()
 	E = []
 	# all constants, "external", and "out" nodes are unique for now
@@ -70,6 +98,117 @@ def graph_from_json(fn):
 				E.append(Edge(operand['value'], instruction_ptr, i))
 	return V, E
 
+# Returns: dict from node id (of C, built from the DFG json file fn) to the
+#   number of times its basic block ran, from a block profile: the
+#   <name>-profiling-blocks.csv an instrumented build of the same module
+#   writes, whose block ids are the ones DFGPass gives each instruction
+def profile_node_weights(C, fn, profile_fn):
+	with open(profile_fn, 'r') as f:
+		executions = {int(row['block']): int(row['executions']) for row in csv.DictReader(f)}
+	with open(fn, 'r') as f:
+		instructions = [record for record in read_records(f) if 'opcode' in record]
+	if instructions and 'block' not in instructions[0]:
+		raise ValueError('%s has no block ids to match %s against; rebuild it with DFGPass' % (fn, profile_fn))
+	block_of = {str(record['pointer']): record['block'] for record in instructions}
+	return {v: executions.get(block_of[str(v)], 0) for v in C.ids if str(v) in block_of}
+
+# bump when the layout of cached node units changes
+node_units_format = b'node-units-1'
+
+# Returns: the basic block and function each node of C (built from the DFG
+#   json file fn) is in, and where in them, for the block store; None if the
+#   DFG has no block hashes
+#   dict of arrays, one entry per node: <unit> ('block' or 'function',
+#   numbered in file order, -1 for nodes that aren't instructions),
+#   <unit>_hash (DFGPass's content hash of the unit) and <unit>_position
+#   (position of the instruction among the unit's)
+def node_units(C, fn, use_cache=True):
+	names = [unit + field for unit in ['block', 'function'] for field in ['', '_hash', '_position']]
+	key = dfg_cache.file_hash(fn, node_units_format)
+	arrays = dfg_cache.read_entry('graphs', key, names) if use_cache else None
+	if arrays is not None:
+		return arrays
+
+	with open(fn, 'r') as f:
+		instructions = [record for record in read_records(f) if 'opcode' in record]
+	if not instructions or 'block_hash' not in instructions[0]:
+		return None
+	index = {str(v): i for i, v in enumerate(C.ids)}
+	nodes = np.array([index[str(record['pointer'])] for record in instructions], dtype=np.int64)
+	arrays = {}
+	for unit in ['block', 'function']:
+		# a unit starts where the hash or block changes; identical functions
+		# next to each other are one unit, which the store tells apart anyway
+		hashes = [record[unit + '_hash'] for record in instructions]
+		starts = [i == 0 or hashes[i] != hashes[i - 1] or
+		          (unit == 'block' and instructions[i]['block'] != instructions[i - 1]['block'])
+		          for i in range(len(instructions))]
+		number = np.cumsum(starts) - 1
+		start_of = np.flatnonzero(starts)[number]
+		arrays[unit] = np.full(len(C.ids), -1, dtype=np.int64)
+		arrays[unit][nodes] = number
+		arrays[unit + '_hash'] = np.full(len(C.ids), '', dtype='<U%d' % max(len(h) for h in hashes))
+		arrays[unit + '_hash'][nodes] = hashes
+		arrays[unit + '_position'] = np.full(len(C.ids), -1, dtype=np.int64)
+		arrays[unit + '_position'][nodes] = np.arange(len(instructions)) - start_of
+	if use_cache:
+		dfg_cache.write_entry('graphs', key, arrays)
+	return arrays
+
+# bump when the layout of the block store changes
+block_store_format = 'block-store-1'
+
+# The block store of a DFG json file keeps the stencil enumeration of each of
+# its components (see deduplicated_stencil_candidates) from one run on the
+# file to the next, so after an edit only the components of changed blocks
+# (or functions) are enumerated again. It is a dict from a component's key
+# (the content hash of its block or function and its nodes' positions in it)
+# to (opcodes, edges, subgraphs, labelling) in terms of those positions, and
+# the name, canonical node names and json of each stencil found.
+def _block_store_key(fn, bottom_k, top_k):
+	return dfg_cache.key_hash(block_store_format, os.path.abspath(fn), str(bottom_k), str(top_k))
+
+# Returns: dict with the store's 'components' and 'stencils'
+def read_block_store(fn, bottom_k, top_k):
+	arrays = dfg_cache.read_entry('blocks', _block_store_key(fn, bottom_k, top_k), ['store'])
+	if arrays is not None:
+		try:
+			return pickle.loads(arrays['store'].tobytes())
+		except (pickle.UnpicklingError, EOFError, ValueError):
+			pass
+	return {'components': {}, 'stencils': {}}
+
+def write_block_store(fn, bottom_k, top_k, store):
+	data = np.frombuffer(pickle.dumps(store, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+	dfg_cache.write_entry('blocks', _block_store_key(fn, bottom_k, top_k), {'store': data}, replace=True)
+
+# bump when the layout of cached compact graphs changes
+compact_graph_format = b'compact-graph-1'
+
+# Returns: graph_from_json(fn) as a CompactGraph
+#   The graph's arrays are cached on disk by the file's contents, so later
+#   runs on the same DFG memory-map them instead of parsing the json again.
+def compact_graph_from_json(fn, use_cache=True):
+	with metrics.phase('graph-build'):
+		return _compact_graph_from_json(fn, use_cache)
+
+def _compact_graph_from_json(fn, use_cache):
+	key = dfg_cache.file_hash(fn, compact_graph_format)
+	arrays = dfg_cache.read_entry('graphs', key, compact_graph.CompactGraph._fields) if use_cache else None
+	if arrays is not None:
+		# ids are looked up one at a time, which is slow on a memory map
+		arrays['ids'] = arrays['ids'].tolist()
+		arrays['opcodes'] = [str(op) for op in arrays['opcodes']]
+		return compact_graph.CompactGraph(**arrays)
+
+	C = compact_graph.compact_graph(*graph_from_json(fn))
+	if use_cache:
+		arrays = C._asdict()
+		arrays['ids'] = np.array(C.ids, dtype=str)
+		arrays['opcodes'] = np.array(C.opcodes, dtype=str)
+		dfg_cache.write_entry('graphs', key, arrays)
+	return C
+
 def construct_chain(opcodes):
 	V = set()
 	E = []
@@ -120,20 +259,17 @@ def print_graph(G):
 def has_side_effects(opcode):
 	return any([o in opcode for o in opcodes_with_side_effects])
 
+# whether a node of the program graph is one of the module's instructions,
+# rather than a constant, argument, external value, out node or pointer
+def is_instruction_opcode(opcode):
+	return opcode != 'pointer' and not any([opcode.startswith(o + '_') for o in ['argument', 'constant', 'external', 'out']])
 
-def visualize_graph(G, matches=None, filename='output.gv'):
-	if not (type(G) is nx.DiGraph): G = graph2nx(*G)
 
+# Returns: graphviz Digraph of nodes ((id, opcode) pairs) and edges ((id, id)
+#   pairs), with the nodes in the set pointer_matches filled in red
+def dot_graph(nodes, edges, pointer_matches):
 	dot = Digraph()
-	node_gen = ((v, dat['opcode']) for v,dat in G.nodes(data=True))
-	edge_gen = G.edges
-
-	# pull out pointers of instructions that match a subgraph
-	pointer_matches = []
-	if matches:
-		pointer_matches = [p for m in matches for p in m['node_matches']]
-
-	for n in node_gen:
+	for n in nodes:
 		vertex = Vertex(*n)
 
 		# Hacky, should fix at some point
@@ -158,17 +294,115 @@ def visualize_graph(G, matches=None, filename='output.gv'):
 			else:
 				dot.attr('node', shape='oval', style='solid', color='black')
 		dot.node(vertex.id, vertex.opcode)
-	for e in edge_gen:
+	for e in edges:
 		dot.edge(*e)
+	return dot
 
+# Lays out the dot file filename in format, in a worker process
+# Returns: (name of the rendered file, None), or (None, the error)
+def _render_dot(filename, format):
 	try:
-		dot.render(filename, view=True)
+		return graphviz.render('dot', format, filename), None
 	except Exception as e:
-		print("viewer error", e)
+		return None, str(e)
+
+# Draw G, with the nodes of matches in red, to filename (dot source) and
+# filename.<format>
+#   shards: if given, the unit (e.g. instruction_units, or node_units'
+#           'function') of each node of G as a CompactGraph, -1 for nodes in
+#           none: draws each unit to <filename base>-<unit>.gv instead, with the
+#           constants, arguments and other nodes in no unit it uses. Units
+#           without a match are skipped when there are matches, jobs
+#           processes lay them out, and <filename base>-index.html links to
+#           them all.
+#   max_nodes: graphs with more nodes only get their dot source written,
+#           since laying them out could take dot minutes
+#   view: open the drawing (or index) in a viewer
+def visualize_graph(G, matches=None, filename='output.gv', shards=None, jobs=1, max_nodes=None, view=False,
+                    format='pdf'):
+	if not (type(G) in (nx.DiGraph, compact_graph.CompactGraph)): G = graph2nx(*G)
+
+	# pull out pointers of instructions that match a subgraph
+	pointer_matches = set()
+	if matches:
+		pointer_matches = {p for m in matches for p in m['node_matches']}
+
+	if shards is None:
+		if type(G) is compact_graph.CompactGraph: G = compact_graph.compact_to_nx(G)
+		dot = dot_graph(G.nodes(data='opcode'), G.edges, pointer_matches)
+		if max_nodes is not None and len(G) > max_nodes:
+			dot.save(filename)
+			print('Not laying out %s: %d nodes is more than %d' % (filename, len(G), max_nodes))
+			return
+		try:
+			dot.render(filename, format=format, view=view)
+		except Exception as e:
+			print("viewer error", e)
+		return
+
+	C = G if type(G) is compact_graph.CompactGraph else compact_graph.compact_from_nx(G)
+	shards = np.asarray(shards)
+	# each edge belongs to the unit of its ends, or of its one end in a unit
+	src, dest = C.edge_src, C.out_nbr
+	edge_shard = np.where(shards[src] >= 0, shards[src], shards[dest])
+	keep = (edge_shard >= 0) & ((shards[src] == shards[dest]) | (shards[src] < 0) | (shards[dest] < 0))
+	edge_order = np.flatnonzero(keep)[np.argsort(edge_shard[keep], kind='stable')]
+	num_units = int(shards.max()) + 1 if len(shards) else 0
+	edge_bounds = np.searchsorted(edge_shard[edge_order], np.arange(num_units + 1))
+	node_order = np.argsort(shards, kind='stable')
+	node_bounds = np.searchsorted(shards[node_order], np.arange(num_units + 1))
+	matched = np.array([v in pointer_matches for v in C.ids], dtype=bool)
+	opcode = [C.opcodes[op] for op in C.opcode.tolist()]
+	base = filename.replace('.gv', '', 1) if filename.endswith('.gv') else filename
+
+	written = []
+	for u in range(num_units):
+		edges = edge_order[edge_bounds[u]:edge_bounds[u + 1]]
+		nodes = np.union1d(node_order[node_bounds[u]:node_bounds[u + 1]], np.concatenate([src[edges], dest[edges]]))
+		num_matched = int(matched[nodes].sum())
+		if not len(nodes) or (pointer_matches and not num_matched):
+			continue
+		shard_filename = '%s-%d.gv' % (base, u)
+		dot_graph([(C.ids[v], opcode[v]) for v in nodes.tolist()],
+		          [(C.ids[s], C.ids[t]) for s, t in zip(src[edges].tolist(), dest[edges].tolist())],
+		          pointer_matches).save(shard_filename)
+		written.append((u, shard_filename, len(nodes), num_matched))
+
+	to_render = [shard_filename for _, shard_filename, num_nodes, _ in written
+	             if max_nodes is None or num_nodes <= max_nodes]
+	if jobs > 1 and len(to_render) > 1:
+		with ProcessPoolExecutor(max_workers=jobs) as executor:
+			rendered = list(executor.map(_render_dot, to_render, [format] * len(to_render)))
+	else:
+		rendered = [_render_dot(shard_filename, format) for shard_filename in to_render]
+	rendered = dict(zip(to_render, rendered))
+
+	index_filename = base + '-index.html'
+	def link(path):
+		return '<a href="%s">%s</a>' % (html.escape(os.path.relpath(path, os.path.dirname(index_filename) or '.')),
+		                                html.escape(os.path.basename(path)))
+	with open(index_filename, 'w') as f:
+		f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>%s</title></head><body>\n' % html.escape(base))
+		f.write('<h1>%s</h1>\n<table>\n<tr><th>unit</th><th>nodes</th><th>matched</th><th>drawing</th></tr>\n'
+		        % html.escape(base))
+		for u, shard_filename, num_nodes, num_matched in written:
+			output, error = rendered.get(shard_filename, (None, 'more than %d nodes' % (max_nodes or 0)))
+			drawing = link(output) if output else '%s (not laid out: %s)' % (link(shard_filename), html.escape(error))
+			f.write('<tr><td>%d</td><td>%d</td><td>%d</td><td>%s</td></tr>\n' % (u, num_nodes, num_matched, drawing))
+		f.write('</table>\n</body></html>\n')
+	num_rendered = sum(1 for output, _ in rendered.values() if output)
+	print('Drew %d of %d units, %d laid out, indexed in %s' % (len(written), num_units, num_rendered, index_filename))
+	if view:
+		try:
+			graphviz.view(index_filename)
+		except Exception as e:
+			print("viewer error", e)
 
 
 def is_subgraph(littleG, bigG):
 	if not (type(littleG) is nx.DiGraph): littleG = graph2nx(*littleG)
+	if type(bigG) is compact_graph.CompactGraph:
+		return next(compact_graph.subgraph_isomorphisms(bigG, littleG), None) is not None
 	if not (type(bigG) is nx.DiGraph): bigG = graph2nx(*bigG)
 
 	def node_match(data1, data2):
@@ -186,18 +420,14 @@ def is_subgraph(littleG, bigG):
 	- instruction nodes should be the same if they have the same opcode and
 	  number of args
 	- constants and arguments can always be considered the same
+	A CompactGraph G2 is searched through its opcode and edge label index
+	(compact_graph.label_index), built on the first search and reused after.
 """
 def find_matches(littleG, bigG):
 	if not (type(littleG) is nx.DiGraph): littleG = graph2nx(*littleG)
-	if not (type(bigG) is nx.DiGraph): bigG = graph2nx(*bigG)
+	if not (type(bigG) in (nx.DiGraph, compact_graph.CompactGraph)): bigG = graph2nx(*bigG)
 
-	for ident in acceptable_identifiers:
-		if ident in littleG.graph:
-			littleGName = littleG.graph[ident]
-			break
-	else:
-		littleGName = '[UNNAMED%d]' % find_matches.counter
-		find_matches.counter += 1
+	littleGName = stencil_name(littleG)
 
 
 	def node_match(data1, data2):
@@ -205,8 +435,13 @@ def find_matches(littleG, bigG):
 
 	matches = []
 
-	gm = isomorphism.DiGraphMatcher(bigG, littleG, node_match=node_match);
-	for i,match in enumerate(gm.subgraph_isomorphisms_iter()):
+	if type(bigG) is compact_graph.CompactGraph:
+		isomorphisms = compact_graph.subgraph_isomorphisms(bigG, littleG)
+	else:
+		gm = isomorphism.DiGraphMatcher(bigG, littleG, node_match=node_match);
+		isomorphisms = gm.subgraph_isomorphisms_iter()
+		metrics.count('vf2_calls', k=littleG.number_of_edges())
+	for i,match in enumerate(isomorphisms):
 		matches.append( dict(
 				template_id = littleGName,
 				match_idx = i,
@@ -215,61 +450,339 @@ def find_matches(littleG, bigG):
 
 	return matches
 
-find_matches.counter = 0
+# name of a stencil for its matches' template_id
+def stencil_name(littleG):
+	for ident in acceptable_identifiers:
+		if ident in littleG.graph:
+			return littleG.graph[ident]
+	stencil_name.counter += 1
+	return '[UNNAMED%d]' % (stencil_name.counter - 1)
 
+stencil_name.counter = 0
 
 """
-return a collection of graphs like the chains from earlier, that are small and cover the most
+	find_matches for a whole library of stencils in one search of bigG, which
+	is much faster than one find_matches per stencil for large libraries
+	graph_key: if given, a content hash of bigG (see match_graph_key), and the
+	  matches of each stencil are cached on disk by it and the stencil's
+	  canonical form, so only stencils new to this graph are searched for
+	Returns: list of the matches of each stencil, as find_matches returns them
+	  (the same matches, though not necessarily in the same order)
 """
-def guess_best_subgraphs( G ) :
-	pass
+def find_matches_many(littleGs, bigG, graph_key=None):
+	littleGs = [littleG if type(littleG) is nx.DiGraph else graph2nx(*littleG) for littleG in littleGs]
+	if type(bigG) is nx.DiGraph:
+		bigG = compact_graph.compact_from_nx(bigG)
+	elif not (type(bigG) is compact_graph.CompactGraph):
+		bigG = compact_graph.compact_graph(*bigG)
+
+	names = [stencil_name(littleG) for littleG in littleGs]
+	matches = [[] for _ in littleGs]
+	def add_match(i, match):
+		matches[i].append(dict(
+				template_id = names[i],
+				match_idx = len(matches[i]),
+				node_matches = match
+			))
 
+	# matches of stencils with a canonical form are kept (and cached) as rows
+	# of node indices of bigG, one column per node of the canonical ordering
+	orderings = {}
+	entry_keys = {}
+	for i, littleG in enumerate(littleGs):
+		key, ordering = canonical_form(littleG)
+		# only an exact canonical form tells isomorphic stencils apart
+		if key[0] == 'canonical':
+			orderings[i] = ordering
+			if graph_key is not None:
+				entry_keys[i] = dfg_cache.key_hash(graph_key, repr(key))
+	rows = {}
+	for i, entry_key in entry_keys.items():
+		arrays = dfg_cache.read_entry('matches', entry_key, ['matches'])
+		if arrays is not None:
+			rows[i] = arrays['matches']
+
+	to_search = [i for i in range(len(littleGs)) if i not in rows]
+	for i, littleG in enumerate(littleGs):
+		metrics.count('stencils_searched' if i in to_search else 'stencils_cached', k=littleG.number_of_edges())
+	found = defaultdict(list)
+	for j, match in subgraph_isomorphisms_by_shape(bigG, [littleGs[i] for i in to_search]):
+		found[to_search[j]].append(match)
+	index = compact_graph.node_index(bigG) if orderings else None
+	for i in to_search:
+		if i not in orderings:
+			for match in found[i]:
+				add_match(i, match)
+			continue
+		position = {u: j for j, u in enumerate(orderings[i])}
+		rows[i] = np.zeros((len(found[i]), len(position)), dtype=np.int32)
+		for m, match in enumerate(found[i]):
+			for v, u in match.items():
+				rows[i][m, position[u]] = index[v]
+		if i in entry_keys:
+			dfg_cache.write_entry('matches', entry_keys[i], {'matches': rows[i]})
+
+	# cached or not, matches are rebuilt from their rows, so a run gives the
+	# same output either way
+	for i in orderings:
+		ordering = orderings[i]
+		for row in np.asarray(rows[i]).tolist():
+			add_match(i, {bigG.ids[v]: ordering[j] for j, v in enumerate(row)})
+
+	for littleG, H_matches in zip(littleGs, matches):
+		metrics.count('matches', len(H_matches), k=littleG.number_of_edges())
+	return matches
 
-def estimate_coverage(Hs, G_original) :
-	G = G_original.copy()
+# the component classes of the instructions of the graph last asked for, as
+# each run matches in one graph
+_last_instruction_classes = [None, None]
+
+# compact_graph.subgraph_isomorphisms_many, but searching only the first
+# component of each shape of component of C's instructions (see
+# component_classes) and mapping its matches onto the others
+#   Only stencils of connected instructions are sure to match within one
+#   component; the others are searched for in all of C, as are all of them
+#   unless the first components hold at most half the components' nodes,
+#   when building their graph and index wouldn't pay for itself.
+# Yields: the same (index into Hs, match) pairs, though not in the same order
+def subgraph_isomorphisms_by_shape(C, Hs):
+	if _last_instruction_classes[0] is not C:
+		instruction = np.array([is_instruction_opcode(op) for op in C.opcodes], dtype=bool)[C.opcode]
+		_last_instruction_classes[:] = [C, component_classes(C, instruction)]
+	classes = _last_instruction_classes[1]
+	by_shape = []
+	num_first_nodes = sum(len(components[0]) for components in classes)
+	if 2 * num_first_nodes <= sum(len(components[0]) * len(components) for components in classes):
+		by_shape = [j for j, H in enumerate(Hs) if H.number_of_edges() and nx.is_weakly_connected(H)
+		            and all(is_instruction_opcode(op) for _, op in H.nodes(data='opcode'))]
+	rest = sorted(set(range(len(Hs))) - set(by_shape))
+	if rest:
+		for j, match in compact_graph.subgraph_isomorphisms_many(C, [Hs[j] for j in rest]):
+			yield rest[j], match
+	if not by_shape:
+		return
+
+	components = [[component.tolist() for component in class_components] for class_components in classes]
+	F = compact_graph.induced_subgraph(C, np.concatenate([class_components[0] for class_components in classes]))
+	position = {C.ids[v]: (c, p) for c, class_components in enumerate(components)
+	            for p, v in enumerate(class_components[0])}
+	found = []
+	for j, match in compact_graph.subgraph_isomorphisms_many(F, [Hs[j] for j in by_shape]):
+		positions = [position[v] for v in match]
+		for component in components[positions[0][0]]:
+			nodes = [component[p] for _, p in positions]
+			found.append((j, nodes, dict(zip([C.ids[v] for v in nodes], match.values()))))
+	# in the order a search of C would mostly find them: by nodes, taken in
+	# the order the search plan reaches them
+	found.sort(key=lambda f: (f[0], f[1]))
+	for j, _, match in found:
+		yield by_shape[j], match
+
+# bump when the layout of cached matches changes
+match_cache_format = b'matches-1'
+
+# Returns: content hash of a DFG json file for find_matches_many's graph_key
+def match_graph_key(fn):
+	return dfg_cache.file_hash(fn, match_cache_format)
 
-	for H in Hs:
-		matches = find_matches(H, G)
 
-		for m in matches:
-			G.remove_nodes_from( m['node_matches'].keys() )
+"""
+return a collection of graphs like the chains from earlier, that are small and cover the most
+"""
+def guess_best_subgraphs( G ) :
+	pass
 
-	print(len(G_original), len(G))
-	return 1 - (len(G) / len(G_original))
+
+# Returns: the instruction weights of C for coverage, 1 per instruction
+#   unless node_weights (dict from node id to weight, e.g.
+#   profile_node_weights) weighs them
+def instruction_weights(C, node_weights=None):
+	instruction = np.array([is_instruction_opcode(op) for op in C.opcodes], dtype=bool)[C.opcode]
+	if node_weights is None:
+		return instruction.astype(float)
+	return np.array([node_weights.get(v, 0) for v in C.ids], dtype=float) * instruction
+
+# Returns: coverage.CoverageTable of the matches of the stencils Hs in C
+def coverage_table(Hs, C, weight, unit=None, num_units=None, graph_key=None):
+	Hs = [H if type(H) is nx.DiGraph else graph2nx(*H) for H in Hs]
+	index = compact_graph.node_index(C)
+	rows = [[[index[v] for v in m['node_matches']] for m in H_matches]
+	        for H_matches in find_matches_many(Hs, C, graph_key)]
+	rows = [np.array(r, dtype=np.int64).reshape(len(r), H.number_of_nodes()) for H, r in zip(Hs, rows)]
+	return coverage.coverage_table(rows, weight, unit, num_units)
+
+def _as_compact(G):
+	if type(G) is nx.DiGraph:
+		return compact_graph.compact_from_nx(G)
+	if type(G) is compact_graph.CompactGraph:
+		return G
+	return compact_graph.compact_graph(*G)
+
+# Returns: fraction of the instructions of G that the stencils Hs cover when
+#   applied in turn: a match counts unless an earlier stencil covered one of
+#   its nodes, and nodes shared by matches of a stencil count once
+#   node_weights: dict from node id to weight, e.g. profile_node_weights
+def estimate_coverage(Hs, G, node_weights=None, graph_key=None):
+	C = _as_compact(G)
+	table = coverage_table(Hs, C, instruction_weights(C, node_weights), graph_key=graph_key)
+	return coverage.covered_fraction(table, coverage.sequential_coverage(table, range(len(Hs))))
+
+# Returns: the weakly connected component of C's instructions (joined only by
+#   edges between instructions) each node is in, numbered in order of their
+#   first node, and -1 for nodes that aren't instructions
+#   In -blocks mode these are parts of basic blocks, and stencils of connected
+#   instructions never match across them.
+def instruction_units(C):
+	instruction = np.array([is_instruction_opcode(op) for op in C.opcodes], dtype=bool)[C.opcode]
+	edge_mask = instruction[C.edge_src] & instruction[C.out_nbr]
+	units = np.full(len(C.ids), -1, dtype=np.int64)
+	for u, component in enumerate(c for c in compact_graph.weakly_connected_components(C, edge_mask)
+	                              if instruction[c[0]]):
+		units[component] = u
+	return units
+
+# estimate_coverage for graphs too large to match every stencil in: matches
+#   only in a random fraction of the units of G
+#   units: unit of each node of C (e.g. node_units(...)['block']), -1 for
+#          nodes that aren't instructions; instruction_units by default
+# Returns: coverage.Estimate, with a confidence interval
+def sample_coverage(Hs, G, fraction=0.1, units=None, node_weights=None, confidence=0.95, seed=0):
+	C = _as_compact(G)
+	weight = instruction_weights(C, node_weights)
+	if units is None:
+		units = instruction_units(C)
+	nodes, unit, num_units = coverage.sample_units(C, np.asarray(units), fraction, seed)
+	F = compact_graph.induced_subgraph(C, nodes)
+	table = coverage_table(Hs, F, weight[nodes], unit, num_units)
+	return coverage.estimate_coverage(table, coverage.sequential_coverage(table, range(len(Hs))), confidence)
 
 '''
 Returns: list of mutually exclusive matches from all matches
 '''
-def pick_mutually_exclusive_matches(matches):
+def pick_mutually_exclusive_matches(matches, improve=False, node_weights=None):
 	# heuristic: sort matches by size
 	# pick matches one by one if they don't overlap any previous matches
-	# TODO: exhaustively try all combinations of subgraphs,
-	#       picking the combo with the most coverage
-	#       because biggest first doesn't guarantee best coverage
-	matches_longest_to_shortest = sorted(matches, reverse=True, key=lambda m: len(m['node_matches']))
-	matches_exclusive = []
-	covered_nodes = set()
-	for match in matches_longest_to_shortest:
-		pointers = match['node_matches'].keys()
-		if any([p in covered_nodes for p in pointers]):
-			continue
-		covered_nodes.update(pointers)
-		matches_exclusive.append(match)
-	return matches_exclusive
+	# (see exclusive.py, which does this on a prebuilt conflict graph)
+	# improve: then swap matches for non-overlapping ones covering more nodes,
+	#          because biggest first doesn't guarantee best coverage
+	# node_weights: dict from node id to weight (see profile_node_weights), to
+	#          sort and swap matches by the weight they cover instead
+	table = exclusive.match_table([matches], node_weights=node_weights)
+	selected = exclusive.exclusive_selection(table)
+	if improve:
+		selected = exclusive.improve_exclusive(table, selected)
+		selected = sorted(selected, key=lambda m: table.position[m])
+	return [matches[m] for m in selected]
 
 # pick collection exactly r subgraph stencils
 # that statically covers the most instructions
-def pick_r_stencils(subgraph_to_matches, r, filename):
+#	method: 'exhaustive' tries every combination and keeps the one with the most
+#	        mutually exclusive matches
+#	        'greedy' and 'exact' treat it as maximum coverage of instructions
+#	        (see selection.py): lazy greedy, or branch and bound that stops
+#	        after time_budget seconds
+#	improve: improve the exclusive matches of the best combination by local search
+#	node_weights: dict from node id to weight (see profile_node_weights), to
+#	        cover the most executed instructions instead: 'exhaustive' keeps the
+#	        combination whose exclusive matches cover the most weight, and
+#	        'greedy' and 'exact' maximise weighted coverage
+def pick_r_stencils(subgraph_to_matches, r, filename, method='exhaustive', time_budget=None, improve=False,
+                    node_weights=None):
+	with metrics.phase('select'):
+		best_matches, best_combo_with_counts = _pick_r_stencils(subgraph_to_matches, r, method, time_budget, improve,
+			node_weights)
+	with metrics.phase('write'):
+		_write_r_stencils(subgraph_to_matches, best_combo_with_counts, filename)
+	# and print for ease
+	print('Best stencil combination:')
+	for stencil, count in best_combo_with_counts.items():
+		print('\t%s: %d' % (stencil, count))
+	print("Total number of times stencils matched: %d" % len(best_matches))
+	return best_matches
+
+# Returns: (mutually exclusive matches of the best combination, dict from its
+#   stencils to their number of those matches)
+def _pick_r_stencils(subgraph_to_matches, r, method, time_budget, improve, node_weights=None):
 	best_matches = []
-	best_combo_with_counts = None
-	for combo in itertools.combinations(subgraph_to_matches.keys(), r):
-		stencil_matches = [match for subgraph in combo for match in subgraph_to_matches[subgraph]]
-		exclusive_matches = pick_mutually_exclusive_matches(stencil_matches)
-		if len(exclusive_matches) > len(best_matches):
-			best_matches = exclusive_matches
+	best_combo_with_counts = {}
+	# encode all matches once, then only look up each combination's conflicts
+	table = stencil_table(subgraph_to_matches, node_weights)
+	if method == 'exhaustive':
+		# score combinations by the weight their exclusive matches cover (their
+		# number, without weights), then their number. Each stencil's total
+		# over all its matches bounds what it adds to a combination.
+		num_matches = np.diff(table.group_ptr).tolist()
+		if node_weights is None:
+			group_value = num_matches
+		else:
+			group_value = np.bincount(table.group, weights=table.value, minlength=len(num_matches)).tolist()
+		best_selected, best_combo, best_score = [], None, (0, 0)
+		num_tried = num_pruned = 0
+		for combo in itertools.combinations(range(len(subgraph_to_matches)), r):
+			# can't beat the best with less than it in total
+			if (sum(group_value[g] for g in combo), sum(num_matches[g] for g in combo)) <= best_score:
+				num_pruned += 1
+				continue
+			num_tried += 1
+			selected = exclusive.exclusive_selection(table, combo)
+			value = len(selected) if node_weights is None else exclusive.covered_weight(table, selected)
+			if (value, len(selected)) > best_score:
+				best_selected, best_combo, best_score = selected, combo, (value, len(selected))
+		metrics.count('combos_tried', num_tried)
+		metrics.count('combos_pruned', num_pruned)
+		if len(best_selected):
+			if improve:
+				best_selected = exclusive.improve_exclusive(table, best_selected, best_combo)
+				best_selected = sorted(best_selected, key=lambda m: table.position[m])
+			best_matches = table_matches(subgraph_to_matches, table, best_selected)
 			best_combo_with_counts = defaultdict(int)
-			for match in exclusive_matches:
+			for match in best_matches:
 				best_combo_with_counts[match['template_id']] += 1
+	else:
+		stencils, ptr, nodes, weight = selection.coverage_sets(subgraph_to_matches, node_weights)
+		if method == 'greedy':
+			selected = selection.greedy_max_coverage(ptr, nodes, weight, r)
+		else:
+			selected = selection.exact_max_coverage(ptr, nodes, weight, r, time_budget)
+		combo = sorted(selected.stencils)
+		best_selected = exclusive.exclusive_selection(table, combo)
+		if improve:
+			best_selected = exclusive.improve_exclusive(table, best_selected, combo)
+			best_selected = sorted(best_selected, key=lambda m: table.position[m])
+		best_matches = table_matches(subgraph_to_matches, table, best_selected)
+		best_combo_with_counts = defaultdict(int)
+		for match in best_matches:
+			best_combo_with_counts[match['template_id']] += 1
+		gap = (selected.upper_bound - selected.coverage) / selected.upper_bound if selected.upper_bound else 0
+		print('%s covered by %s selection: %d (upper bound %d, gap %.2f%%%s)' %
+			('Instructions' if node_weights is None else 'Instruction executions', method,
+			 selected.coverage, selected.upper_bound, 100 * gap, ', optimal' if selected.optimal else ''))
+	if node_weights is not None:
+		total = sum(node_weights.values())
+		covered = exclusive.covered_weight(table, best_selected)
+		print('Instruction executions covered by exclusive matches: %d of %d (%.2f%%)' %
+			(covered, total, 100 * covered / total if total else 0))
+	return best_matches, best_combo_with_counts
+
+# Returns: match table (see exclusive.py) of all matches of the stencils in
+#   subgraph_to_matches, grouped by stencil
+#   node_weights: dict from node id to weight, or None
+def stencil_table(subgraph_to_matches, node_weights=None):
+	stencils = list(subgraph_to_matches.values())
+	ids = stencils[0].ids if stencils else []
+	weight = None
+	if node_weights is not None:
+		weight = np.array([node_weights.get(v, 0) for v in ids], dtype=float)
+	return exclusive.row_match_table([stencil.rows for stencil in stencils], len(ids), weight)
+
+# Returns: match dicts of matches (indices into table) of subgraph_to_matches
+def table_matches(subgraph_to_matches, table, matches):
+	stencils = list(subgraph_to_matches.values())
+	group = table.group.tolist()
+	group_ptr = table.group_ptr.tolist()
+	return [match_dict(stencils[group[m]], m - group_ptr[group[m]]) for m in map(int, matches)]
+
+def _write_r_stencils(subgraph_to_matches, best_combo_with_counts, filename):
 	# save best combo in csv
 	with open(filename, "w") as csvfile:
 		csvwriter = csv.writer(csvfile, delimiter='\t')
@@ -279,165 +792,647 @@ def pick_r_stencils(subgraph_to_matches, r, filename):
 	# save best combo stencil jsons for matching to other programs
 	stencil_jsons = []
 	for stencil_canonical_string in best_combo_with_counts.keys():
-		stencil_jsons.append(subgraph_to_matches[stencil_canonical_string][0]['template_json'])
+		stencil_jsons.append(subgraph_to_matches[stencil_canonical_string].json)
 	with open(filename.replace(".csv", "-stencils.json", 1), "w") as file:
 		file.write(json.dumps(list(stencil_jsons), indent=4))
-	# and print for ease
-	print('Best stencil combination:')
-	for stencil, count in best_combo_with_counts.items():
-		print('\t%s: %d' % (stencil, count))
-	print("Total number of times stencils matched: %d" % len(best_matches))
-	return best_matches
-
-# generate all stencils with numbers of edges between bottom_k and top_k
-def generate_all_stencils_between_ks(G, bottom_k, top_k, filename):
-	node_pointer_to_opcode = {}
-	for v, v_data in G.nodes(data=True):
-	 	node_pointer_to_opcode[v] = v_data['opcode']
 
+# largest number of node orderings canonical_form will try before giving up
+# on a certificate and falling back to an isomorphism invariant
+max_canonical_orderings = 5040
+
+# The matches of one mined stencil: its name and json are kept once, and each
+# match is a row of node indices of the mined graph
+#	nodes: canonical node name of each column
+#	ids: node id (pointer) of each node index of the mined graph
+#	rows: int array, one row per match
+# The match dicts find_matches returns are only built for output, with
+# match_dict.
+StencilMatches = namedtuple('StencilMatches', ['name', 'json', 'nodes', 'ids', 'rows'])
+
+def match_dict(stencil, i):
+	return dict(
+		template_id = stencil.name,
+		template_json = stencil.json,
+		match_idx = i,
+		node_matches = {stencil.ids[v]: u for v, u in zip(stencil.rows[i].tolist(), stencil.nodes)}
+	)
+
+def match_dicts(stencil):
+	return [match_dict(stencil, i) for i in range(len(stencil.rows))]
+
+# canonical labelling of a small opcode-labelled digraph (edges are unlabelled,
+# matching the node_match used everywhere else)
+# Returns: (key, ordering)
+#	key: ('canonical', opcodes, edges) certificate, equal iff the graphs are
+#	     isomorphic, or ('invariant', opcodes, edges) when there were too many
+#	     orderings to try; invariant keys can collide and need a VF2 check
+#	ordering: the nodes of H in canonical order
+def canonical_form(H):
+	return canonical_labelling(H.nodes(), H.edges(), lambda v: H.nodes[v]['opcode'])
+
+# canonical_form of the graph with the given nodes, edges and node opcodes
+#   Ties between automorphic nodes are broken by node_key, so the ordering is
+#   the same from run to run.
+def canonical_labelling(nodes, edge_list, opcode_of, node_key=str):
+	nodes = sorted(nodes, key=node_key)
+	opcodes = {v: opcode_of(v) for v in nodes}
+	predecessors = defaultdict(list)
+	successors = defaultdict(list)
+	for s, t in edge_list:
+		successors[s].append(t)
+		predecessors[t].append(s)
+
+	# colour refinement: split nodes by opcode, then by the colours of their
+	# predecessors and successors, until the partition stops changing
+	ranks = {op: i for i, op in enumerate(sorted(set(opcodes.values())))}
+	colour = {v: ranks[opcodes[v]] for v in nodes}
+	num_colours = len(ranks)
+	while True:
+		signature = {v: (colour[v],
+		                 tuple(sorted(colour[u] for u in predecessors[v])),
+		                 tuple(sorted(colour[u] for u in successors[v]))) for v in nodes}
+		ranks = {sig: i for i, sig in enumerate(sorted(set(signature.values())))}
+		colour = {v: ranks[signature[v]] for v in nodes}
+		if len(ranks) == num_colours:
+			break
+		num_colours = len(ranks)
+
+	cells = defaultdict(list)
+	for v in nodes:
+		cells[colour[v]].append(v)
+	cells = [cells[c] for c in sorted(cells)]
+	ordered_opcodes = tuple(opcodes[v] for cell in cells for v in cell)
+
+	num_orderings = 1
+	for cell in cells:
+		num_orderings *= math.factorial(len(cell))
+	if num_orderings > max_canonical_orderings:
+		colour_edges = tuple(sorted((colour[s], colour[t]) for s, t in edge_list))
+		return ('invariant', ordered_opcodes, colour_edges), [v for cell in cells for v in cell]
+
+	# try every ordering consistent with the refined partition, keep the one
+	# with the lexicographically smallest edge list
+	best_edges, best_ordering = None, None
+	for cell_orderings in itertools.product(*[itertools.permutations(cell) for cell in cells]):
+		ordering = [v for cell in cell_orderings for v in cell]
+		position = {v: i for i, v in enumerate(ordering)}
+		edges = tuple(sorted((position[s], position[t]) for s, t in edge_list))
+		if best_edges is None or edges < best_edges:
+			best_edges, best_ordering = edges, ordering
+	return ('canonical', ordered_opcodes, best_edges), best_ordering
+
+# whether a node with this opcode may be part of a stencil: it isn't an
+# argument, constant, external value or instruction with side effects
+def is_acceptable_stencil_opcode(opcode):
+	return not any([prefix in opcode for prefix in unacceptable_subgraph_nodes])
+
+# Returns: (edge_index, edges, incident) for the edges of C stencils may use,
+#   the ones between acceptable stencil opcodes (and, when given, leaving nodes)
+#	edge_index: edge number in C of each
+#	edges: (source, dest) of each
+#	incident: dict from node to the set of these edges (by position) touching it
+def stencil_edges(C, nodes=None):
+	acceptable_opcode = np.array([is_acceptable_stencil_opcode(op) for op in C.opcodes], dtype=bool)
+	acceptable = acceptable_opcode[C.opcode[C.edge_src]] & acceptable_opcode[C.opcode[C.out_nbr]]
+	if nodes is not None:
+		in_shard = np.zeros(len(C.ids), dtype=bool)
+		in_shard[nodes] = True
+		acceptable &= in_shard[C.edge_src]
+	edge_index = np.flatnonzero(acceptable).tolist()
+	edges = list(zip(C.edge_src[edge_index].tolist(), C.out_nbr[edge_index].tolist()))
+	incident = defaultdict(set)
+	for i, (s, t) in enumerate(edges):
+		incident[s].add(i)
+		incident[t].add(i)
+	return edge_index, edges, incident
+
+# enumerate every connected subgraph of C with between 1 and top_k edges, using
+# only edges between acceptable stencil opcodes (and, when given, only edges
+# leaving nodes)
+# Returns: dict from k to a list of (first appearance, edge list), one per
+#   connected k-edge subgraph, sorted by first appearance
+#   Subgraphs are grown ESU-style (Wernicke) over the line graph of C: each one
+#   starts from its lowest-numbered edge and is only extended by edges touching
+#   its frontier, so every connected edge set is visited exactly once. Each
+#   level is then put in the order the old prev_candidates x G.edges()
+#   expansion first produced it, so stencil names and match indices are stable.
+#   Edges are numbered across the whole of C, so first appearances from
+#   different shards of nodes compare.
+def connected_edge_subgraphs(C, top_k, nodes=None):
+	edge_index, edges, incident = stencil_edges(C, nodes)
+	subgraphs = _connected_edge_sets(edges, incident, top_k)
+	return {k: [(appearance, [edges[e] for e in sorted(sub)]) for appearance, sub in level]
+	        for k, level in _by_first_appearance(subgraphs, edge_index, top_k).items()}
+
+# Returns: dict from k to the list of connected k-edge sets (frozensets of
+#   positions in edges), for k up to top_k
+def _connected_edge_sets(edges, incident, top_k):
+	neighbours = [frozenset((incident[s] | incident[t]) - {i}) for i, (s, t) in enumerate(edges)]
+
+	subgraphs = defaultdict(list)
+	def extend(sub, sub_and_neighbours, extension, root):
+		subgraphs[len(sub)].append(sub)
+		if len(sub) == top_k:
+			return
+		extension = sorted(extension, reverse=True)
+		while extension:
+			w = extension.pop()
+			new_neighbours = [u for u in neighbours[w] if u > root and u not in sub_and_neighbours]
+			extend(sub | {w}, sub_and_neighbours | neighbours[w], extension + new_neighbours, root)
+
+	if top_k > 0:
+		for v in range(len(edges)):
+			extend(frozenset([v]), neighbours[v] | {v}, [u for u in neighbours[v] if u > v], v)
+	return subgraphs
+
+# Returns: dict from k to a list of (first appearance, edge set) of the edge
+#   sets of _connected_edge_sets, sorted by first appearance
+#	edge_index: edge number in C of each position
+# A k-edge subgraph first appeared as (earliest (k-1)-edge parent, added
+# edge); nesting the parent's first appearance keeps this comparable without
+# knowing the positions of subgraphs from other shards.
+def _by_first_appearance(subgraphs, edge_index, top_k):
+	levels = {}
+	previous_appearance = {}
+	for k in range(1, top_k + 1):
+		appearance = {}
+		for sub in subgraphs.get(k, []):
+			if k == 1:
+				appearance[sub] = (edge_index[min(sub)],)
+			else:
+				appearance[sub] = min((previous_appearance[sub - {e}], edge_index[e])
+				                      for e in sub if (sub - {e}) in previous_appearance)
+		levels[k] = [(appearance[sub], sub) for sub in sorted(appearance, key=appearance.get)]
+		previous_appearance = appearance
+	return levels
+
+# Returns: dict from k (bottom_k <= k <= top_k) to a list of
+#   (first appearance, edge list, canonical key, canonical ordering), one per
+#   connected k-edge stencil candidate in C, sorted by first appearance
+#   Nodes are integers of C.
+def stencil_candidates(C, bottom_k, top_k, nodes=None):
+	with metrics.phase('enumerate'):
+		edge_lists = connected_edge_subgraphs(C, top_k, nodes)
+	opcode_of = lambda v: C.opcodes[C.opcode[v]]
+	node_key = lambda v: C.ids[v]
+	candidates = {}
+	for k in range(bottom_k, top_k + 1):
+		candidates[k] = []
+		with metrics.phase('canonicalize', k):
+			for appearance, edge_list in edge_lists[k]:
+				sub_nodes = {v for e in edge_list for v in e}
+				key, ordering = canonical_labelling(sub_nodes, edge_list, opcode_of, node_key)
+				candidates[k].append((appearance, edge_list, key, ordering))
+	return candidates
+
+# stencil_candidates for a whole program graph, with its weakly connected
+# components (basic blocks in -blocks mode) spread over jobs processes
+# Returns: the same candidates, in the same order, as stencil_candidates(C, ...)
+def parallel_stencil_candidates(C, bottom_k, top_k, jobs):
+	# balance shards by number of edges, several per worker so one large
+	# component doesn't leave the others idle
+	out_degree = np.diff(C.out_ptr)
+	components = sorted(compact_graph.weakly_connected_components(C), key=len, reverse=True)
+	num_shards = max(1, min(len(components), jobs * 4))
+	shards = [[] for _ in range(num_shards)]
+	shard_sizes = [(0, i) for i in range(num_shards)]
+	for component in components:
+		size, i = heapq.heappop(shard_sizes)
+		shards[i].append(component)
+		heapq.heappush(shard_sizes, (size + int(out_degree[component].sum()), i))
+
+	with ProcessPoolExecutor(max_workers=jobs) as executor:
+		futures = [executor.submit(stencil_candidates, C, bottom_k, top_k, np.concatenate(shard))
+		           for shard in shards if shard]
+		results = [future.result() for future in futures]
+
+	candidates = {}
+	for k in range(bottom_k, top_k + 1):
+		candidates[k] = list(heapq.merge(*[result[k] for result in results], key=lambda c: c[0]))
+	return candidates
+
+# Components of the part of C made of the nodes in node_mask, grouped by shape
+# Returns: list of classes of isomorphic components, each a list of node
+#   arrays, one per component, in order of their first node; nodes at the
+#   same position correspond
+#   Shapes are told apart by canonical_labelling, which is only run on
+#   components with the same numbers of edges and opcodes as another one. A
+#   component it gives only an invariant key for is a class of its own.
+#   Components without edges are left out.
+def component_classes(C, node_mask):
+	edge_mask = node_mask[C.edge_src] & node_mask[C.out_nbr]
+	num_edges = np.bincount(C.edge_src[edge_mask], minlength=len(C.ids))
+	components = [component for component in compact_graph.weakly_connected_components(C, edge_mask)
+	              if num_edges[component].sum()]
+	sizes = [(int(num_edges[component].sum()), tuple(sorted(C.opcode[component].tolist())))
+	         for component in components]
+	num_with_size = defaultdict(int)
+	for size in sizes:
+		num_with_size[size] += 1
+
+	opcode_of = lambda v: C.opcodes[C.opcode[v]]
+	node_key = lambda v: C.ids[v]
+	classes = {}
+	for component, size in zip(components, sizes):
+		nodes = component.tolist()
+		key = ('component', nodes[0])
+		ordering = nodes
+		if num_with_size[size] > 1:
+			edge_list = [(int(C.edge_src[e]), int(C.out_nbr[e]))
+			             for v in nodes for e in range(C.out_ptr[v], C.out_ptr[v + 1]) if edge_mask[e]]
+			canonical_key, ordering = canonical_labelling(nodes, edge_list, opcode_of, node_key)
+			if canonical_key[0] == 'canonical':
+				key = canonical_key
+		classes.setdefault(key, []).append(np.array(ordering, dtype=np.int32))
+	return list(classes.values())
+
+# stencil_candidates for a whole program graph, enumerated and canonicalized
+# once per shape of component (see component_classes) and mapped onto the
+# other components of that shape, which in -blocks mode are often many:
+# loop bodies, unrolled code and inlined helpers. Classes are spread over jobs
+# processes.
+#   units, store: node_units of C and its block store, to reuse the
+#   enumeration of components in the store, and update the store to hold
+#   exactly the components of C
+# Returns: the same candidates, in the same order, as stencil_candidates(C, ...)
+#   except that the ordering of a candidate may differ by an automorphism
+def deduplicated_stencil_candidates(C, bottom_k, top_k, jobs=1, units=None, store=None):
+	acceptable = np.array([is_acceptable_stencil_opcode(op) for op in C.opcodes], dtype=bool)[C.opcode]
+	stored_results, unstored, kept = [], {}, {}
+	with metrics.phase('components'):
+		if store is not None:
+			acceptable, stored_results, unstored, kept = _stored_candidates(C, bottom_k, top_k, acceptable, units, store)
+		classes = component_classes(C, acceptable)
+	metrics.count('components', sum(len(components) for components in classes) + len(stored_results))
+	metrics.count('components_stored', len(stored_results))
+	metrics.count('component_classes', len(classes))
+	if jobs > 1 and len(classes) > 1:
+		# balance shards by the edges enumerated, as in parallel_stencil_candidates
+		out_degree = np.diff(C.out_ptr)
+		classes = sorted(classes, key=lambda components: len(components[0]), reverse=True)
+		num_shards = min(len(classes), jobs * 4)
+		shards = [[] for _ in range(num_shards)]
+		shard_sizes = [(0, i) for i in range(num_shards)]
+		for components in classes:
+			size, i = heapq.heappop(shard_sizes)
+			shards[i].append(components)
+			heapq.heappush(shard_sizes, (size + int(out_degree[components[0]].sum()), i))
+		classes = [components for shard in shards for components in shard]
+		with ProcessPoolExecutor(max_workers=jobs) as executor:
+			futures = [executor.submit(_component_class_candidates, C, bottom_k, top_k, shard)
+			           for shard in shards if shard]
+			outputs = [future.result() for future in futures]
+		results = [result for shard_results, _ in outputs for result in shard_results]
+		firsts = [first for _, shard_firsts in outputs for first in shard_firsts]
+	else:
+		results, firsts = _component_class_candidates(C, bottom_k, top_k, classes)
+
+	if store is not None:
+		for components, (first_edges, subgraphs, labelling) in zip(classes, firsts):
+			for component in components:
+				key, nodes = unstored.get(int(component.min()), (None, None))
+				if key is not None and key not in kept:
+					kept[key] = _store_entry(C, components[0], component, nodes, first_edges, subgraphs, labelling)
+		store.clear()
+		store.update(kept)
+
+	candidates = {}
+	for k in range(bottom_k, top_k + 1):
+		candidates[k] = list(heapq.merge(*[result[k] for result in results + stored_results], key=lambda c: c[0]))
+	return candidates
+
+# Returns: (key, nodes) of a component of C for the block store, or None if it
+#   isn't within one block or function
+#	nodes: the component's nodes, in the order of their positions in it
+def _component_unit(component, units):
+	for unit in ['block', 'function']:
+		number = units[unit][component]
+		if number[0] >= 0 and (number == number[0]).all():
+			positions = units[unit + '_position'][component]
+			order = np.argsort(positions, kind='stable')
+			key = dfg_cache.key_hash(unit, str(units[unit + '_hash'][component[0]]),
+				','.join(map(str, positions[order].tolist())))
+			return key, component[order].tolist()
+	return None
+
+# Looks up the components of the part of C made of the nodes in node_mask in
+# the block store
+# Returns: (node_mask, results, unstored, kept)
+#	node_mask: node_mask without the components found
+#	results: stencil_candidates of each component found
+#	unstored: dict from the lowest node of each component not found that could
+#	          be stored to its _component_unit
+#	kept: the store's entries of the components found
+def _stored_candidates(C, bottom_k, top_k, node_mask, units, store):
+	edge_mask = node_mask[C.edge_src] & node_mask[C.out_nbr]
+	num_edges = np.bincount(C.edge_src[edge_mask], minlength=len(C.ids))
+	edge_index, edges, _ = stencil_edges(C)
+	edge_number = dict(zip(edges, edge_index))
+	num_stencil_edges = np.bincount(C.edge_src[edge_index], minlength=len(C.ids))
+	node_mask = node_mask.copy()
+	results, unstored, kept = [], {}, {}
+	for component in compact_graph.weakly_connected_components(C, edge_mask):
+		if not num_edges[component].sum():
+			continue
+		unit = _component_unit(component, units)
+		if unit is None:
+			continue
+		key, nodes = unit
+		entry = store.get(key)
+		candidates = None
+		if entry is not None:
+			candidates = _entry_candidates(C, entry, nodes, int(num_stencil_edges[component].sum()),
+				edge_number, bottom_k, top_k)
+		if candidates is None:
+			unstored[int(component.min())] = unit
+			continue
+		results.append(candidates)
+		kept[key] = entry
+		node_mask[component] = False
+	return node_mask, results, unstored, kept
+
+# Returns: the store entry of a component from the enumeration of the first
+#   component of its class (see _component_class_candidates)
+#	nodes: the component's nodes in the order of the entry's positions
+def _store_entry(C, first_component, component, nodes, first_edges, subgraphs, labelling):
+	position = {v: p for p, v in enumerate(nodes)}
+	local = {u: position[v] for u, v in zip(first_component.tolist(), component.tolist())}
+	opcodes = tuple(C.opcodes[op] for op in C.opcode[nodes].tolist())
+	return (opcodes, [(local[s], local[t]) for s, t in first_edges], dict(subgraphs),
+	        {sub: (key, [local[v] for v in ordering]) for sub, (key, ordering) in labelling.items()})
+
+# Returns: stencil_candidates of a component from its store entry, or None if
+#   the entry doesn't fit the component (a hash collision, or an entry of an
+#   older pass)
+def _entry_candidates(C, entry, nodes, num_stencil_edges, edge_number, bottom_k, top_k):
+	opcodes, local_edges, subgraphs, labelling = entry
+	if len(opcodes) != len(nodes) or len(local_edges) != num_stencil_edges or \
+	   opcodes != tuple(C.opcodes[op] for op in C.opcode[nodes].tolist()):
+		return None
+	edges = [(nodes[s], nodes[t]) for s, t in local_edges]
+	if not all(e in edge_number for e in edges):
+		return None
+	edge_index = [edge_number[e] for e in edges]
+	return _map_candidates(subgraphs, labelling, edge_index, edges, nodes, bottom_k, top_k)
+
+# Returns: (list of stencil_candidates of each component of classes, list of
+#   (first_edges, subgraphs, labelling) of the first component of each class)
+def _component_class_candidates(C, bottom_k, top_k, classes):
+	edge_index, edges, _ = stencil_edges(C)
+	edge_number = dict(zip(edges, edge_index))
+	opcode_of = lambda v: C.opcodes[C.opcode[v]]
+	node_key = lambda v: C.ids[v]
+	# stencil edges of the first component of each class
+	first_of = np.full(len(C.ids), -1, dtype=np.int64)
+	for c, components in enumerate(classes):
+		first_of[components[0]] = c
+	first_positions = [[] for _ in classes]
+	for p, c in enumerate(first_of[[s for s, t in edges]].tolist()):
+		if c >= 0:
+			first_positions[c].append(p)
+
+	firsts = []
+	with metrics.phase('enumerate'):
+		for positions in first_positions:
+			first_index = [edge_index[p] for p in positions]
+			first_edges = [edges[p] for p in positions]
+			incident = defaultdict(set)
+			for i, (s, t) in enumerate(first_edges):
+				incident[s].add(i)
+				incident[t].add(i)
+			firsts.append((first_index, first_edges, _connected_edge_sets(first_edges, incident, top_k)))
+	labellings = [{} for _ in classes]
+	for k in range(bottom_k, top_k + 1):
+		with metrics.phase('canonicalize', k):
+			for (_, first_edges, subgraphs), labelling in zip(firsts, labellings):
+				for sub in subgraphs.get(k, []):
+					edge_list = [first_edges[e] for e in sorted(sub)]
+					sub_nodes = {v for e in edge_list for v in e}
+					labelling[sub] = canonical_labelling(sub_nodes, edge_list, opcode_of, node_key)
+
+	results = []
+	for components, (first_index, first_edges, subgraphs), labelling in zip(classes, firsts, labellings):
+		results.append(_map_candidates(subgraphs, labelling, first_index, first_edges, None, bottom_k, top_k))
+		for component in components[1:]:
+			node_map = dict(zip(components[0].tolist(), component.tolist()))
+			edges = [(node_map[s], node_map[t]) for s, t in first_edges]
+			edge_index = [edge_number[e] for e in edges]
+			results.append(_map_candidates(subgraphs, labelling, edge_index, edges, node_map, bottom_k, top_k))
+	return results, [(first_edges, subgraphs, labelling) for (_, first_edges, subgraphs), labelling in zip(firsts, labellings)]
+
+# Returns: stencil_candidates of a component from the edge sets and labelling
+#   of the first component of its class
+#	edge_index, edges: edge number in C and (source, dest) of each position,
+#	                   in the component
+#	node_map: dict (or list) from nodes of the first component to the
+#	          component's, or None for the first component itself
+def _map_candidates(subgraphs, labelling, edge_index, edges, node_map, bottom_k, top_k):
+	levels = _by_first_appearance(subgraphs, edge_index, top_k)
+	candidates = {}
+	for k in range(bottom_k, top_k + 1):
+		candidates[k] = []
+		for appearance, sub in levels[k]:
+			key, ordering = labelling[sub]
+			if node_map is None:
+				candidates[k].append((appearance, [edges[e] for e in sorted(sub)], key, ordering))
+			else:
+				edge_list = [edges[e] for e in sorted(sub, key=edge_index.__getitem__)]
+				candidates[k].append((appearance, edge_list, key, [node_map[v] for v in ordering]))
+	return candidates
+
+# names each node <opcode>_<n>, numbering nodes of the same opcode in the
+# given order, so a canonical ordering gives a canonical name
+def canonicalize_name(H, ordered_nodes):
+	opcode_to_num = defaultdict(int)
+	pointer_to_canonical = {}
+	for v in ordered_nodes:
+		v_op = H.nodes[v]['opcode']
+		pointer_to_canonical[v] = '%s_%d' % (v_op, opcode_to_num[v_op])
+		opcode_to_num[v_op] += 1
+	canonicalized = sorted([('(%s, %s)' % (pointer_to_canonical[s], pointer_to_canonical[t])) for s, t in H.edges()])
+	canonical_edges = ', '.join(canonicalized)
+	canonical_nodes = ', '.join(sorted([pointer_to_canonical[v] for v in ordered_nodes]))
+	H_name = '%s | %s' % (canonical_nodes, canonical_edges) 
+	return H_name, pointer_to_canonical
+
+def canonicalize_json(H, ordered_nodes, pointer_to_canonical):
+	H_renamed = nx.DiGraph()
+	H_renamed.graph.update(H.graph)
+	for v in ordered_nodes:
+		H_renamed.add_node(pointer_to_canonical[v], **dict(H.nodes[v], id=pointer_to_canonical[v]))
+	for s, t in sorted(H.edges(), key=lambda e: (pointer_to_canonical[e[0]], pointer_to_canonical[e[1]])):
+		H_renamed.add_edge(pointer_to_canonical[s], pointer_to_canonical[t],
+			**dict(H.edges[s, t], source=pointer_to_canonical[s], dest=pointer_to_canonical[t]))
+	return nx.readwrite.json_graph.node_link_data(H_renamed)
+
+# nodes in the order they are first reached by walking the edges of H
+def traversal_order(H):
+	ordering = {}
+	for s, t in H.edges():
+		ordering.setdefault(s, len(ordering))
+		ordering.setdefault(t, len(ordering))
+	return list(ordering)
+
+# name, json and node naming are computed once per canonical stencil, and
+# each match is a row of the nodes of C matching its ordering, with the first
+# appearance of the candidate it came from
+def canonical_stencil(H, ordering):
+	H_name, pointer_to_canonical = canonicalize_name(H, ordering)
+	H_json = canonicalize_json(H, ordering, pointer_to_canonical)
+	return dict(H=H, ordering=ordering, name=H_name,
+	            nodes=[pointer_to_canonical[v] for v in ordering], json=H_json, rows=[], appearances=[])
+
+# Groups stencil candidates of k edges (see stencil_candidates) by canonical
+# form, adding each as a match of the canonical_stencil it is an instance of;
+# VF2 is only needed for the rare candidates that only get an invariant key
+#	buckets: dict from key to the stencils with it, more than one only for
+#	         invariant keys
+#	stencils: list of the stencils, in the order they were first seen
+#	new_stencil: function from (edge_list, key, ordering) of a candidate with
+#	         a canonical key to its canonical_stencil
+def group_stencil_candidates(C, k, candidates, buckets, stencils, new_stencil):
 	def node_match(data1, data2):
 		return data1['opcode'] == data2['opcode'] # and data1['arity'] == data2['arity']
 
-	def has_acceptable_nodes(edge_list):
-		acceptable = []
-		for (s, t) in edge_list:
-			s_op = node_pointer_to_opcode[s]
-			t_op = node_pointer_to_opcode[t]
-			acceptable.append(not any([prefix in s_op for prefix in unacceptable_subgraph_nodes]) \
-			                  and not any([prefix in t_op for prefix in unacceptable_subgraph_nodes]))
-		return all(acceptable)
-
-
-	def canonicalize_name(edge_list, node_list):
-		opcode_to_num = defaultdict(int)
-		pointer_to_id = {}
-		pointer_to_canonical = {}
-		canonicalized = []
-		def pointer_to_string(s):
-			s_op = node_pointer_to_opcode[s]
-			s_op_num = -1
-			if s in pointer_to_id:
-				s_op_num = pointer_to_id[s]
-			else:
-				s_op_num = opcode_to_num[s_op]
-				pointer_to_id[s] = s_op_num
-				opcode_to_num[s_op] += 1
-			s_final = '%s_%d' % (s_op, s_op_num)
-			pointer_to_canonical[s] = s_final
-			return s_final
-		canonicalized = sorted([('(%s, %s)' % (pointer_to_string(s), pointer_to_string(t))) for s, t in edge_list])
-		canonical_edges = ', '.join(canonicalized)
-		canonical_nodes = ', '.join(sorted([pointer_to_canonical[v] for v in node_list]))
-		H_name = '%s | %s' % (canonical_nodes, canonical_edges) 
-		return H_name, pointer_to_canonical
-
-	def canonicalize_json(H, pointer_to_canonical):
-		H_renamed = H.copy()
-		for v in H.nodes():
-			H_renamed.nodes[v]['id'] = pointer_to_canonical[v]
-		for e in H.edges():
-			H_renamed.edges[e]['source'] = pointer_to_canonical[H_renamed.edges[e]['source']]
-			H_renamed.edges[e]['dest'] = pointer_to_canonical[H_renamed.edges[e]['dest']]
-		H_renamed = nx.relabel_nodes(H_renamed, {v: pointer_to_canonical[v] for v in H_renamed.nodes()})
-		return nx.readwrite.json_graph.node_link_data(H_renamed)
-		
-	def edges_to_nodes(edge_list):
-		nodes = set()
-		for s, t in edge_list:
-			nodes.add(s)
-			nodes.add(t)
-		return sorted(list(nodes))
-
-	def H_to_name_and_match(H, match_idx, mapping=None):
-		H_name, pointer_to_canonical = canonicalize_name(H.edges(), H.nodes())
-		if mapping == None:
-			mapping = {v: pointer_to_canonical[v] for v in H.nodes()}
+	for appearance, edge_list, key, ordering in candidates:
+		bucket = buckets.setdefault(key, [])
+		if key[0] == 'canonical':
+			if not bucket:
+				bucket.append(new_stencil(edge_list, key, ordering))
+				stencils.append(bucket[0])
+			bucket[0]['rows'].append(ordering)
+			bucket[0]['appearances'].append(appearance)
+			continue
+		current_H = compact_graph.edge_subgraph(C, edge_list)
+		node_of = {C.ids[v]: v for v in ordering}
+		for stencil in bucket:
+			metrics.count('vf2_calls', k=k)
+			gm = isomorphism.DiGraphMatcher(stencil['H'], current_H, node_match=node_match);
+			if gm.is_isomorphic():
+				mapping = next(gm.isomorphisms_iter())
+				break
 		else:
-			mapping = {v1: pointer_to_canonical[v2] for v1, v2 in mapping.items()}
-		H_json = canonicalize_json(H, pointer_to_canonical)
-		match = dict(
-			template_id = H_name,
-			template_json = H_json,
-			match_idx = match_idx,
-			node_matches = mapping
-		)
-		return H_name, match
-
-	def find_k_edge_subgraph_matches(G, bottom_k, top_k, current_k=1, prev_candidates=[]):
-		# generate all k-edge subgraphs, including those unacceptable nodes
-		candidates = [edge_list + [(s,t)] for edge_list in prev_candidates for s, t, e_data in G.edges(data=True)]
-		# first case
-		if not len(prev_candidates):
-			candidates = [[(s, t)] for s, t, e_data in G.edges(data=True)]
-		# filter out unacceptable nodes
-		candidates = [edge_list for edge_list in candidates if has_acceptable_nodes(edge_list)]
-		# keep only connected subgraphs with k edges
-		Hs = [G.edge_subgraph(edge_list) for edge_list in candidates]
-		connected = [nx.is_connected(H.to_undirected()) for H in Hs]
-		num_edges = [len(H.edges()) for H in Hs]
-		edge_lists = [edge_list for edge_list, con, num in zip(candidates, connected, num_edges) if con and num == current_k]
-		Hs = [H for H, con, num in zip(Hs, connected, num_edges) if con and num == current_k]
-
-		# remove duplicates
-		edges_without_duplicates = set()
-		final_edge_lists = []
-		final_Hs = []
-		for edge_list, H in zip(edge_lists, Hs):
-			alphabetized = tuple(sorted(['%s_%s' % (s, t) for s, t in edge_list]))
-			if alphabetized not in edges_without_duplicates:
-				edges_without_duplicates.add(alphabetized)
-				final_edge_lists.append(edge_list)
-				final_Hs.append(H)
-
-		# compare all current_k-edge subgraphs to each other to find matches
-		canonical_H_to_num = defaultdict(int)
-		canonical_H_to_matches = defaultdict(list)
-		for current_H in final_Hs:
-			found = False
-			for canonical_H in canonical_H_to_num.keys():
-				gm = isomorphism.DiGraphMatcher(current_H, canonical_H, node_match=node_match);
-				if gm.subgraph_is_isomorphic():
-					mapping = next(gm.isomorphisms_iter())
-					H_name, match = H_to_name_and_match(canonical_H, canonical_H_to_num[canonical_H], mapping)
-					canonical_H_to_matches[H_name].append(match)
-					found = True
-					canonical_H_to_num[canonical_H] += 1
-					break
-			if not found:
-				H_name, match = H_to_name_and_match(current_H, canonical_H_to_num[current_H])
-				canonical_H_to_matches[H_name].append(match)
-				canonical_H_to_num[current_H] += 1
-
-		subgraph_to_number_of_matches = {}
-		for edge_list, H_matches in canonical_H_to_matches.items():
-			exclusive_matches = pick_mutually_exclusive_matches(H_matches)
-			subgraph_to_number_of_matches[edge_list] = \
-			  {'total': len(H_matches), 'exclusive': len(exclusive_matches)}
+			stencil = canonical_stencil(current_H, traversal_order(current_H))
+			bucket.append(stencil)
+			stencils.append(stencil)
+			mapping = {v: v for v in current_H.nodes()}
+		stencil['rows'].append([node_of[mapping[v]] for v in stencil['ordering']])
+		stencil['appearances'].append(appearance)
+
+# Returns: dict from name to StencilMatches of grouped stencils
+def stencil_matches(C, stencils):
+	H_to_matches = {}
+	for stencil in stencils:
+		rows = np.array(stencil['rows'], dtype=np.int32).reshape(-1, len(stencil['ordering']))
+		H_to_matches[stencil['name']] = StencilMatches(stencil['name'], stencil['json'], stencil['nodes'], C.ids, rows)
+	return H_to_matches
+
+# Returns: dict from name to the total and mutually exclusive numbers of
+#   matches of each of the stencils of k edges in H_to_matches
+def stencil_counts(C, k, H_to_matches):
+	with metrics.phase('exclusive', k):
+		table = exclusive.row_match_table([H_matches.rows for H_matches in H_to_matches.values()], len(C.ids))
+		exclusive_counts = exclusive.exclusive_counts_per_group(table)
+	return {name: {'total': len(H_matches.rows), 'exclusive': num_exclusive}
+	        for (name, H_matches), num_exclusive in zip(H_to_matches.items(), exclusive_counts.tolist())}
+
+# save the stencils, number of mutually exclusive matches, total number of matches
+# as both human-readable csv and json for possible later use
+def write_stencil_counts(subgraph_to_number_of_matches, filename, bottom_k, top_k):
+	with metrics.phase('write'):
+		with open(filename.replace(".json", "-matches_%d-to-%d-edge-subgraphs.csv" % (bottom_k, top_k), 1), "w") as csvfile:
+			csvwriter = csv.writer(csvfile, delimiter='\t')
+			csvwriter.writerow(['subgraph', 'exclusive', 'total'])
+			for k, v in sorted(subgraph_to_number_of_matches.items()):
+				csvwriter.writerow([k, v['exclusive'], v['total']])
+		with open(filename.replace(".json", "-matches_%d-to-%d-edge-subgraphs.json" % (bottom_k, top_k), 1), "w") as file:
+			file.write(json.dumps(subgraph_to_number_of_matches, indent=4))
+
+# generate all stencils with numbers of edges between bottom_k and top_k
+# G: a networkx DiGraph or a CompactGraph
+# jobs > 1 spreads enumeration and canonicalization over that many processes
+# dedup: enumerate once per shape of component (see
+#        deduplicated_stencil_candidates), rather than once per component
+# incremental: with dedup, only enumerate the components that changed since
+#        the last run on filename, keeping the others in its block store
+def generate_all_stencils_between_ks(G, bottom_k, top_k, filename, jobs=1, dedup=True, incremental=False):
+	C = G if type(G) is compact_graph.CompactGraph else compact_graph.compact_from_nx(G)
+
+	# canonical_stencil of the candidate with a canonical key, kept in the
+	# block store by everything its name and json are made of: the key, and
+	# the arities of its nodes and arguments of its edges in the program
+	in_degree, edge_arg = None, None
+	def stored_canonical_stencil(edge_list, key, ordering):
+		nonlocal in_degree, edge_arg
+		if edge_arg is None:
+			in_degree = np.diff(C.in_ptr).tolist()
+			edge_arg = dict(zip(zip(C.edge_src.tolist(), C.out_nbr.tolist()), C.edge_arg.tolist()))
+		position = {v: i for i, v in enumerate(ordering)}
+		edge_args = tuple(sorted((position[s], position[t], edge_arg[s, t]) for s, t in edge_list))
+		stencil_key = (key, tuple(in_degree[v] for v in ordering), edge_args)
+		stored = store['stencils'].get(stencil_key)
+		if stored is None:
+			stencil = canonical_stencil(compact_graph.edge_subgraph(C, edge_list), [C.ids[v] for v in ordering])
+			stored = (stencil['name'], stencil['nodes'], stencil['json'])
+		else:
+			stencil = dict(H=None, ordering=[C.ids[v] for v in ordering], name=stored[0], nodes=stored[1],
+			               json=stored[2], rows=[], appearances=[])
+		kept_stencils[stencil_key] = stored
+		return stencil
+
+	def find_k_edge_subgraph_matches(C, bottom_k, top_k, current_k):
+		# group the connected current_k-edge subgraphs by canonical form
+		if store is None:
+			new_stencil = lambda edge_list, key, ordering: canonical_stencil(
+				compact_graph.edge_subgraph(C, edge_list), [C.ids[v] for v in ordering])
+		else:
+			new_stencil = stored_canonical_stencil
+		stencils = []
+		with metrics.phase('dedup', current_k):
+			group_stencil_candidates(C, current_k, candidates_by_k[current_k], {}, stencils, new_stencil)
+		canonical_H_to_matches = stencil_matches(C, stencils)
+		num_candidates = len(candidates_by_k[current_k])
+		metrics.count('candidates', num_candidates, k=current_k)
+		# candidates isomorphic to one seen before only add a match
+		metrics.count('candidates_pruned', num_candidates - len(canonical_H_to_matches), k=current_k)
+		metrics.count('stencils', len(canonical_H_to_matches), k=current_k)
+
+		subgraph_to_number_of_matches = stencil_counts(C, current_k, canonical_H_to_matches)
 
 		if current_k < top_k:
-			if current_k < bottom_k:
-				# don't return these intermediate subgraphs
-				return find_k_edge_subgraph_matches(G, bottom_k, top_k, current_k+1, final_edge_lists)
-			# otherwise keep track of all these smaller subgraphs, too
-			next_H_to_matches, next_k_counts = find_k_edge_subgraph_matches(G, bottom_k, top_k, current_k+1, final_edge_lists)
+			# keep track of all these smaller subgraphs, too
+			next_H_to_matches, next_k_counts = find_k_edge_subgraph_matches(C, bottom_k, top_k, current_k+1)
 			canonical_H_to_matches.update(next_H_to_matches)
 			subgraph_to_number_of_matches.update(next_k_counts)
 		return canonical_H_to_matches, subgraph_to_number_of_matches
 	
 	t1 = time.time()
-	subgraph_to_matches, subgraph_to_number_of_matches = find_k_edge_subgraph_matches(G, bottom_k, top_k)
+	units = node_units(C, filename) if dedup and incremental else None
+	store = read_block_store(filename, bottom_k, top_k) if units is not None else None
+	kept_stencils = {}
+	if dedup:
+		stored_keys = {part: set(entries) for part, entries in store.items()} if store is not None else None
+		candidates_by_k = deduplicated_stencil_candidates(C, bottom_k, top_k, jobs, units,
+			store['components'] if store is not None else None)
+	elif jobs > 1:
+		# the workers' phases aren't seen here, so this is one phase
+		with metrics.phase('enumerate'):
+			candidates_by_k = parallel_stencil_candidates(C, bottom_k, top_k, jobs)
+	else:
+		candidates_by_k = stencil_candidates(C, bottom_k, top_k)
+	subgraph_to_matches, subgraph_to_number_of_matches = find_k_edge_subgraph_matches(C, bottom_k, top_k, bottom_k)
+	if store is not None:
+		store['stencils'] = kept_stencils
+		print('Block store: reused %d of %d components and %d of %d stencils' % (
+			len(stored_keys['components'] & set(store['components'])), len(store['components']),
+			len(stored_keys['stencils'] & set(kept_stencils)), len(kept_stencils)))
+		if any(set(entries) != stored_keys[part] for part, entries in store.items()):
+			with metrics.phase('write'):
+				write_block_store(filename, bottom_k, top_k, store)
 	t2 = time.time()
 	print('Seconds: %.4f' % (t2 - t1))
 
-	# save the stencils, number of mutually exclusive matches, total number of matches
-	# as both human-readable csv and json for possible later use
-	with open(filename.replace(".json", "-matches_%d-to-%d-edge-subgraphs.csv" % (bottom_k, top_k), 1), "w") as csvfile:
-		csvwriter = csv.writer(csvfile, delimiter='\t')
-		csvwriter.writerow(['subgraph', 'exclusive', 'total'])
-		for k, v in sorted(subgraph_to_number_of_matches.items()):
-			csvwriter.writerow([k, v['exclusive'], v['total']])
-	with open(filename.replace(".json", "-matches_%d-to-%d-edge-subgraphs.json" % (bottom_k, top_k), 1), "w") as file:
-		file.write(json.dumps(subgraph_to_number_of_matches, indent=4))
+	write_stencil_counts(subgraph_to_number_of_matches, filename, bottom_k, top_k)
 	# and print number of stencils found
 	if bottom_k == top_k:
 		print('Total stencils with %d edges: %d' % (top_k, len(subgraph_to_matches)))
@@ -447,25 +1442,244 @@ def generate_all_stencils_between_ks(G, bottom_k, top_k, filename):
 	return subgraph_to_matches
 
 
+# bump when the layout of search checkpoints changes
+search_checkpoint_format = b'search-checkpoint-1'
+
+def search_checkpoint_filename(filename):
+	return filename.replace('.json', '-search-checkpoint.pkl', 1)
+
+# generate_all_stencils_between_ks within time_budget seconds, for graphs too
+# large to mine in one go (or in one CI slot), and resumable. Stencils are
+# mined a batch of shapes of component (see component_classes) at a time, most
+# promising first: fewer edges first, since a stencil has no more matches than
+# its parts, then shapes with more components, whose stencils gain the most
+# matches. Every checkpoint_interval seconds, and when it stops, the frontier
+# and the matches of the stencils so far go to a checkpoint next to filename,
+# and the best r stencils so far (picked greedily, see selection.py) to
+# combos_filename, as pick_r_stencils writes them.
+#   resume: carry on from filename's checkpoint, if it's of the same DFG and ks
+#   node_weights: dict from node id to weight, to pick the best so far by
+# Returns: (subgraph_to_matches, complete); once complete, the same stencils
+#   and matches, in the same order, as generate_all_stencils_between_ks
+def anytime_stencils_between_ks(G, bottom_k, top_k, filename, time_budget=math.inf, r=2, jobs=1, resume=False,
+                                checkpoint_interval=60, combos_filename=None, node_weights=None):
+	C = G if type(G) is compact_graph.CompactGraph else compact_graph.compact_from_nx(G)
+	start = last_checkpoint = time.time()
+	last_batch = 0
+	key = dfg_cache.file_hash(filename, search_checkpoint_format)
+	checkpoint_fn = search_checkpoint_filename(filename)
+
+	acceptable = np.array([is_acceptable_stencil_opcode(op) for op in C.opcodes], dtype=bool)[C.opcode]
+	with metrics.phase('components'):
+		classes = component_classes(C, acceptable)
+	order = sorted(range(len(classes)), key=lambda c: (-len(classes[c]), len(classes[c][0]), c))
+
+	# the frontier is the next k and how many of its classes (in order) are
+	# done; each k's stencils are grouped as group_stencil_candidates does
+	state = dict(key=key, bottom_k=bottom_k, top_k=top_k, num_classes=len(classes), k=bottom_k, done=0,
+	             seconds=0.0, levels={k: ({}, []) for k in range(bottom_k, top_k + 1)}, best={})
+	if resume:
+		saved = None
+		if os.path.exists(checkpoint_fn):
+			with open(checkpoint_fn, 'rb') as f:
+				try:
+					saved = pickle.load(f)
+				except (pickle.UnpicklingError, EOFError, ValueError):
+					pass
+		if saved is not None and all(saved.get(field) == state[field]
+		                                  for field in ['key', 'bottom_k', 'top_k', 'num_classes']):
+			state = saved
+			if state['k'] <= top_k:
+				print('Resuming stencil search at %d of %d shapes with %d edges' % (state['done'], len(classes), state['k']))
+			else:
+				print('Stencil search of %s already complete' % checkpoint_fn)
+		else:
+			print('No checkpoint of this DFG in %s, starting the stencil search over' % checkpoint_fn)
+
+	def new_stencil(edge_list, key, ordering):
+		stencil = canonical_stencil(compact_graph.edge_subgraph(C, edge_list), [C.ids[v] for v in ordering])
+		# only invariant keys need H, for VF2, and it would bloat checkpoints
+		stencil['H'] = None
+		return stencil
+
+	def add_candidates(k, results):
+		buckets, stencils = state['levels'][k]
+		with metrics.phase('dedup', k):
+			for candidates in results:
+				group_stencil_candidates(C, k, candidates[k], buckets, stencils, new_stencil)
+
+	def subgraph_to_matches():
+		H_to_matches = {}
+		for k in range(bottom_k, top_k + 1):
+			H_to_matches.update(stencil_matches(C, state['levels'][k][1]))
+		return H_to_matches
+
+	def checkpoint():
+		nonlocal last_checkpoint
+		H_to_matches = subgraph_to_matches()
+		if combos_filename is not None and H_to_matches:
+			with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+				_, state['best'] = _pick_r_stencils(H_to_matches, r, 'greedy', None, False, node_weights)
+			with metrics.phase('write'):
+				_write_r_stencils(H_to_matches, state['best'], combos_filename)
+		state['seconds'] += time.time() - last_checkpoint
+		with metrics.phase('write'):
+			with open(checkpoint_fn + '.tmp', 'wb') as f:
+				pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(checkpoint_fn + '.tmp', checkpoint_fn)
+		last_checkpoint = time.time()
+		print('Search checkpoint: %s, %d stencils, best so far: %s' % (
+			'%d of %d shapes with %d edges' % (state['done'], len(classes), state['k']) if state['k'] <= top_k
+			else 'complete', len(H_to_matches), ', '.join('%s (%d)' % kv for kv in state['best'].items()) or 'none'))
+
+	# batches small enough to stop soon after the budget runs out, big enough
+	# that each worker gets a few per round
+	batch_size = max(1, len(classes) // (16 * max(1, jobs)))
+	executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+	try:
+		while state['k'] <= top_k and time.time() - start < time_budget:
+			k, done = state['k'], state['done']
+			batches = [[classes[c] for c in order[i:i + batch_size]]
+			           for i in range(done, min(len(order), done + batch_size * max(1, jobs)), batch_size)]
+			if executor is None:
+				outputs = [_component_class_candidates(C, k, k, batch) for batch in batches]
+			else:
+				# the workers' phases aren't seen here, so this is one phase
+				with metrics.phase('enumerate'):
+					outputs = list(executor.map(_component_class_candidates, *zip(*[(C, k, k, batch) for batch in batches])))
+			for results, _ in outputs:
+				add_candidates(k, results)
+			state['done'] += sum(len(batch) for batch in batches)
+			if state['done'] >= len(classes):
+				state['k'], state['done'] = k + 1, 0
+			last_batch = time.time()
+			if time.time() - last_checkpoint >= checkpoint_interval:
+				checkpoint()
+	finally:
+		if executor is not None:
+			executor.shutdown(cancel_futures=True)
+	complete = state['k'] > top_k
+	if last_checkpoint < last_batch or not os.path.exists(checkpoint_fn):
+		checkpoint()
+	print('Seconds: %.4f' % (time.time() - start))
+	if not complete:
+		print('Stencil search stopped after its %gs budget, %.0fs in total; pass --resume to carry on from %s'
+			% (time_budget, state['seconds'], checkpoint_fn))
+
+	# matches in the order the whole search finds them, and each stencil's
+	# json (the arities of its nodes and arguments of its edges) from its
+	# first match in that order, as the whole search takes it from
+	for k in range(bottom_k, top_k + 1):
+		stencils = state['levels'][k][1]
+		for i, stencil in enumerate(stencils):
+			first = stencil['appearances'][0]
+			order_of = sorted(range(len(stencil['rows'])), key=stencil['appearances'].__getitem__)
+			stencil['rows'] = [stencil['rows'][i] for i in order_of]
+			stencil['appearances'] = [stencil['appearances'][i] for i in order_of]
+			if stencil['H'] is None and stencil['appearances'][0] != first:
+				row = stencil['rows'][0]
+				column = {name: j for j, name in enumerate(stencil['nodes'])}
+				edge_list = [(row[column[e['source']]], row[column[e['dest']]]) for e in stencil['json']['edges']]
+				stencils[i] = dict(new_stencil(edge_list, None, row), rows=stencil['rows'],
+				                   appearances=stencil['appearances'])
+		stencils.sort(key=lambda stencil: stencil['appearances'][0])
+	H_to_matches, subgraph_to_number_of_matches = {}, {}
+	for k in range(bottom_k, top_k + 1):
+		level = stencil_matches(C, state['levels'][k][1])
+		H_to_matches.update(level)
+		subgraph_to_number_of_matches.update(stencil_counts(C, k, level))
+	write_stencil_counts(subgraph_to_number_of_matches, filename, bottom_k, top_k)
+	if bottom_k == top_k:
+		print('Total stencils with %d edges: %d' % (top_k, len(H_to_matches)))
+	else:
+		print('Total stencils with between %d and %d edges: %d' % (bottom_k, top_k, len(H_to_matches)))
+	return H_to_matches, complete
+
+
 """Write json [ <list of matches>
 	{"template_ID" : <>,
 	 "match_idx" : 0, 1, 2, ...,
 	 node_matches: { id -> id} }]
+or with exchange_format 'ndjson', one match per line, without its
+template_json, which DFGPass doesn't read
 """
-def write_matches(matches, filename, extra_filename=''):
+def write_matches(matches, filename, extra_filename='', exchange_format='json'):
 	filename = filename.replace(".json", "-matches%s.json" % extra_filename, 1)
 
-	with open(filename, "w") as file:
-		file.write(json.dumps(matches, indent=4))
+	with metrics.phase('write'), open(filename, "w") as file:
+		if exchange_format == 'ndjson':
+			for m in matches:
+				file.write(json.dumps({'template_id': m['template_id'], 'match_idx': m['match_idx'],
+				                       'node_matches': m['node_matches']}) + '\n')
+		else:
+			file.write(json.dumps(matches, indent=4))
 
 # if no --stencil-json argument, then the default is to generate stencils
-if __name__ == '__main__':
+# stencil libraries already parsed, by (path, mtime, size), so a process that
+# runs main more than once (dfg_server.py) parses each library once
+stencil_libraries = {}
+
+# Returns: list of the stencils (networkx graphs) in a stencil json file
+def load_stencil_json(fn):
+	stat = os.stat(fn)
+	key = (os.path.abspath(fn), stat.st_mtime_ns, stat.st_size)
+	if key not in stencil_libraries:
+		with open(fn, 'r') as jsonfile:
+			stencil_libraries[key] = [nx.readwrite.json_graph.node_link_graph(H_json) for H_json in json.load(jsonfile)]
+	return list(stencil_libraries[key])
+
+def main(argv=None):
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--input', type=str, required=True)
 	parser.add_argument('--stencil-json', type=str, required=False)
-	args = parser.parse_args();
-
-	G = graph2nx(*graph_from_json(args.input))
+	parser.add_argument('--jobs', type=int, default=1,
+		help='number of processes to mine stencils with')
+	parser.add_argument('--num-stencils', type=int, default=2,
+		help='number of stencils to pick for the best combination')
+	parser.add_argument('--selection', choices=['exhaustive', 'greedy', 'exact'], default='exhaustive',
+		help='how to pick the best combination of stencils')
+	parser.add_argument('--time-budget', type=float, default=None,
+		help='seconds the stencil search may take, checkpointing as it goes; the exact selection gets what is left')
+	parser.add_argument('--resume', action='store_true',
+		help="carry on from the last --time-budget run's checkpoint of the input")
+	parser.add_argument('--checkpoint-interval', type=float, default=60,
+		help='seconds between checkpoints of a --time-budget or --resume stencil search')
+	parser.add_argument('--improve-exclusive', action='store_true',
+		help='improve the greedy choice of mutually exclusive matches by local search')
+	parser.add_argument('--no-cache', action='store_true',
+		help='always parse the input json and match stencils instead of using the caches')
+	parser.add_argument('--profile-out', type=str, default=None,
+		help='write the time and peak memory of each phase, and counters, to this json file')
+	parser.add_argument('--exchange-format', choices=['json', 'ndjson'], default='json',
+		help='format to write matches in; DFGPass asks for ndjson unless debugging')
+	parser.add_argument('--render', choices=['graph', 'components', 'functions', 'none'], default='graph',
+		help='draw the whole graph with the best matches, or each component of instructions or function '
+		     'with a match, laid out in --jobs processes, or nothing')
+	parser.add_argument('--render-max-nodes', type=int, default=2000,
+		help='only write the dot source of drawings with more nodes than this, without laying them out')
+	parser.add_argument('--view', action='store_true',
+		help='open the drawing, or the index of drawings, in a viewer')
+	parser.add_argument('--block-profile', type=str, default=None,
+		help='<name>-profiling-blocks.csv of an instrumented run, to pick the stencils and matches '
+		     'covering the most executed instructions')
+	args = parser.parse_args(argv)
+
+	metrics.reset()
+	run(args)
+	if args.profile_out:
+		for (cache, outcome), n in dfg_cache.stats.items():
+			metrics.count('%s_cache_%s' % (cache, outcome), n)
+		metrics.write(args.profile_out, input=args.input, stencil_json=args.stencil_json,
+			argv=sys.argv[1:] if argv is None else list(argv))
+
+def run(args):
+	C = compact_graph_from_json(args.input, use_cache=not args.no_cache)
+	with metrics.phase('graph-build'):
+		G = compact_graph.compact_to_nx(C)
+	node_weights = None
+	if args.block_profile:
+		with metrics.phase('json-load'):
+			node_weights = profile_node_weights(C, args.input, args.block_profile)
 	# print_graph(V, E)
 
 	chains = [
@@ -479,10 +1693,8 @@ if __name__ == '__main__':
 
 	extra_filename = ''
 	if args.stencil_json:
-		with open(args.stencil_json, 'r') as jsonfile:
-			Hs = []
-			for H_json in json.load(jsonfile):
-				Hs.append(nx.readwrite.json_graph.node_link_graph(H_json))
+		with metrics.phase('json-load'):
+			Hs = load_stencil_json(args.stencil_json)
 		extra_filename = '_' + (args.stencil_json.split('/')[-1]).replace('.json', '', 1)
 
 	# For colored printing
@@ -490,24 +1702,59 @@ if __name__ == '__main__':
 	r = "\033[91m"
 	b = "\033[00m"
 
-	matches = []
-	for H in Hs:
-		matches.extend(find_matches(H, G))
+	with metrics.phase('match'):
+		graph_key = None if args.no_cache else match_graph_key(args.input)
+		matches = [match for H_matches in find_matches_many(Hs, C, graph_key) for match in H_matches]
+	if graph_key is not None:
+		print('Match cache: %s' % dfg_cache.stats_summary('matches'))
 
-	matches_exclusive = pick_mutually_exclusive_matches(matches)
+	with metrics.phase('exclusive'):
+		matches_exclusive = pick_mutually_exclusive_matches(matches, improve=args.improve_exclusive,
+			node_weights=node_weights)
 	# save all matches (which might overlap)
-	write_matches(matches, args.input, extra_filename='%s-full' % (extra_filename))
-	write_matches(matches_exclusive, args.input)
+	write_matches(matches, args.input, extra_filename='%s-full' % (extra_filename), exchange_format=args.exchange_format)
+	write_matches(matches_exclusive, args.input, exchange_format=args.exchange_format)
 	
 	if args.stencil_json:
-		exit()
+		return
 
 	# this finds candidate stencils within a dfg
 	# instead of relying on the hand-specified chains
 	bottom_k = 2
 	top_k = 2
-	subgraph_to_matches = generate_all_stencils_between_ks(G, bottom_k=bottom_k, top_k=top_k, filename=args.input)
-	best_combo_matches = pick_r_stencils(subgraph_to_matches, r=2, filename=args.input.replace(".json", "_%d-to-%d-edge-subgraphs_combos.csv" % (bottom_k, top_k), 1))
-	write_matches(best_combo_matches, args.input)
-	visualize_graph(G, best_combo_matches, filename=args.input.replace(".json", "_%d-to-%d-edge-subgraphs_combos.gv" % (bottom_k, top_k), 1))
+	combos_filename = args.input.replace(".json", "_%d-to-%d-edge-subgraphs_combos.csv" % (bottom_k, top_k), 1)
+	time_budget = args.time_budget
+	if args.time_budget is not None or args.resume:
+		# mine what fits in the budget, and leave the rest to --resume
+		start = time.time()
+		subgraph_to_matches, _ = anytime_stencils_between_ks(C, bottom_k, top_k, args.input,
+			math.inf if args.time_budget is None else args.time_budget, r=args.num_stencils, jobs=args.jobs,
+			resume=args.resume, checkpoint_interval=args.checkpoint_interval, combos_filename=combos_filename,
+			node_weights=node_weights)
+		if time_budget is not None:
+			time_budget = max(0, time_budget - (time.time() - start))
+	else:
+		subgraph_to_matches = generate_all_stencils_between_ks(C, bottom_k=bottom_k, top_k=top_k, filename=args.input, jobs=args.jobs,
+			incremental=not args.no_cache)
+	best_combo_matches = pick_r_stencils(subgraph_to_matches, r=args.num_stencils, filename=combos_filename,
+		method=args.selection, time_budget=time_budget, improve=args.improve_exclusive,
+		node_weights=node_weights)
+	write_matches(best_combo_matches, args.input, exchange_format=args.exchange_format)
+	if args.render == 'none':
+		return
+	with metrics.phase('render'):
+		shards = None
+		if args.render == 'functions':
+			units = node_units(C, args.input, use_cache=not args.no_cache)
+			if units is None:
+				print('%s has no function hashes; drawing components instead' % args.input)
+			else:
+				shards = units['function']
+		if args.render != 'graph' and shards is None:
+			shards = instruction_units(C)
+		visualize_graph(C if shards is not None else G, best_combo_matches,
+			filename=args.input.replace(".json", "_%d-to-%d-edge-subgraphs_combos.gv" % (bottom_k, top_k), 1),
+			shards=shards, jobs=args.jobs, max_nodes=args.render_max_nodes, view=args.view)
 
+if __name__ == '__main__':
+	main()
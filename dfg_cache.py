@@ -0,0 +1,102 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from collections import defaultdict
+
+# On-disk caches shared by every run of dfg.py, profiling.py and graph.py.
+# Entries are directories named by a content hash; a hit bumps the entry's
+# mtime and the oldest entries are evicted once a cache grows past its size
+# bound. Entries are written to a temporary directory and renamed into place,
+# so parallel runs never see half-written entries.
+cache_dir = os.environ.get('DFG_CACHE_DIR',
+	os.path.join(os.path.expanduser('~'), '.cache', 'dfg-coverings'))
+max_cache_bytes = int(os.environ.get('DFG_CACHE_MAX_BYTES', 1 << 30))
+
+# hits and misses of this process, by (cache, 'hits' or 'misses')
+stats = defaultdict(int)
+
+def file_hash(fn, salt=b''):
+	h = hashlib.blake2b(salt, digest_size=20)
+	with open(fn, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+# Returns: cache key made of the given strings
+def key_hash(*parts):
+	h = hashlib.blake2b(digest_size=20)
+	for part in parts:
+		h.update(part.encode() + b'\0')
+	return h.hexdigest()
+
+def _entry_bytes(path):
+	return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+# remove least recently used entries of a cache until it fits max_bytes
+def evict(directory, max_bytes, keep=None):
+	entries = []
+	for name in os.listdir(directory):
+		path = os.path.join(directory, name)
+		if name.startswith('.') or name == keep or not os.path.isdir(path):
+			continue
+		try:
+			entries.append((os.path.getmtime(path), _entry_bytes(path), path))
+		except OSError:
+			# removed by another process while we looked
+			continue
+	total = sum(size for _, size, _ in entries)
+	if keep is not None and os.path.isdir(os.path.join(directory, keep)):
+		total += _entry_bytes(os.path.join(directory, keep))
+	for _, size, path in sorted(entries):
+		if total <= max_bytes:
+			break
+		shutil.rmtree(path, ignore_errors=True)
+		total -= size
+
+# Returns: dict from name to memory-mapped array for a cache entry, or None
+#   when the entry isn't cached (or was evicted while we read it)
+def read_entry(cache, key, names):
+	path = os.path.join(cache_dir, cache, key)
+	try:
+		arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in names}
+		os.utime(path)
+	except (OSError, ValueError):
+		stats[cache, 'misses'] += 1
+		return None
+	stats[cache, 'hits'] += 1
+	return arrays
+
+# store a dict from name to array as a cache entry, then evict old entries
+#   replace: overwrite an entry already cached under key, for entries that are
+#            updated rather than named by their contents
+def write_entry(cache, key, arrays, max_bytes=None, replace=False):
+	directory = os.path.join(cache_dir, cache)
+	try:
+		os.makedirs(directory, exist_ok=True)
+		tmp = tempfile.mkdtemp(dir=directory, prefix='.tmp-')
+		for name, array in arrays.items():
+			np.save(os.path.join(tmp, name + '.npy'), array)
+		path = os.path.join(directory, key)
+		if replace:
+			# the old entry is moved aside first, as a directory can't be
+			# renamed over a non-empty one
+			old = tempfile.mkdtemp(dir=directory, prefix='.old-')
+			try:
+				os.rename(path, os.path.join(old, key))
+			except OSError:
+				pass
+			shutil.rmtree(old, ignore_errors=True)
+		try:
+			os.rename(tmp, path)
+		except OSError:
+			# another process cached the same entry first
+			shutil.rmtree(tmp, ignore_errors=True)
+		evict(directory, max_cache_bytes if max_bytes is None else max_bytes, keep=key)
+	except OSError as e:
+		print('cache error', e)
+
+# Returns: "N hits, M misses" for a cache, over this process
+def stats_summary(cache):
+	return '%d hits, %d misses' % (stats[cache, 'hits'], stats[cache, 'misses'])
@@ -0,0 +1,196 @@
+import os
+import io
+import sys
+import json
+import time
+import fcntl
+import socket
+import argparse
+import traceback
+import subprocess
+
+# A warm dfg.py for DFGPass: a server on a Unix socket that has imported dfg.py
+# (networkx, numpy, ...) once and runs dfg.main for each request in a forked
+# child, so building many small modules doesn't pay Python startup and imports
+# for every one. Parsed stencil libraries stay in the server between requests.
+# It's started on demand by the first client and exits after idle_timeout
+# seconds without requests.
+#   Protocol: the client sends one json line {"cwd": ..., "argv": [...]} with
+#   dfg.py's arguments, and gets back {"status": exit status, "output": what
+#   dfg.py printed}, after which the connection is closed. {"stop": true}
+#   asks the server to exit.
+#   This file is also the client (python3 dfg_server.py run -- <dfg.py args>),
+#   which only imports the standard library, so it starts quickly.
+
+default_socket = os.environ.get('DFG_SERVER_SOCKET', '/tmp/dfg-coverings-%d.sock' % os.getuid())
+default_idle_timeout = 600
+
+def _read_line(conn):
+	data = b''
+	while not data.endswith(b'\n'):
+		chunk = conn.recv(1 << 16)
+		if not chunk:
+			break
+		data += chunk
+	return data
+
+# run dfg.main in a forked child and send its result back on conn
+def _handle(conn, request, dfg):
+	os.chdir(request['cwd'])
+	output = io.StringIO()
+	sys.stdout = sys.stderr = output
+	try:
+		dfg.main(request['argv'])
+		status = 0
+	except SystemExit as e:
+		status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+	except Exception:
+		traceback.print_exc()
+		status = 1
+	sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+	conn.sendall(json.dumps({'status': status, 'output': output.getvalue()}).encode() + b'\n')
+
+def serve(socket_path=default_socket, idle_timeout=default_idle_timeout):
+	# one server per socket: whoever holds the lock owns the socket path
+	lock = open(socket_path + '.lock', 'w')
+	try:
+		fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except OSError:
+		return
+
+	import dfg
+	if os.path.exists(socket_path):
+		# left behind by a server that didn't exit cleanly
+		os.unlink(socket_path)
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(socket_path)
+	server.listen(64)
+	server.settimeout(1)
+
+	children = set()
+	last_request = time.time()
+	try:
+		while children or time.time() - last_request < idle_timeout:
+			for pid in list(children):
+				if os.waitpid(pid, os.WNOHANG)[0]:
+					children.remove(pid)
+			try:
+				conn, _ = server.accept()
+			except socket.timeout:
+				continue
+			last_request = time.time()
+			try:
+				conn.settimeout(30)
+				line = _read_line(conn)
+				request = json.loads(line) if line else None
+			except (OSError, ValueError) as e:
+				print('bad request', e)
+				request = None
+			if request is None:
+				# or just checking the server is up
+				conn.close()
+				continue
+			if request.get('stop'):
+				conn.sendall(json.dumps({'status': 0, 'output': ''}).encode() + b'\n')
+				conn.close()
+				# finish the requests being handled, then exit
+				idle_timeout = 0
+				continue
+			try:
+				# parse the stencil library here, so later requests reuse it
+				if '--stencil-json' in request['argv'][:-1]:
+					stencil_json = request['argv'][request['argv'].index('--stencil-json') + 1]
+					dfg.load_stencil_json(os.path.join(request['cwd'], stencil_json))
+			except Exception:
+				# dfg.main will report it
+				pass
+			pid = os.fork()
+			if pid == 0:
+				server.close()
+				try:
+					_handle(conn, request, dfg)
+				finally:
+					os._exit(0)
+			children.add(pid)
+			conn.close()
+	finally:
+		server.close()
+		if os.path.exists(socket_path):
+			os.unlink(socket_path)
+		lock.close()
+
+# Returns: a socket connected to the server, or None if it isn't running
+def connect(socket_path=default_socket):
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		client.connect(socket_path)
+	except OSError:
+		client.close()
+		return None
+	return client
+
+# start a server in the background, unless one is running; wait until it is
+# accepting requests
+# Returns: whether a server is up
+def start(socket_path=default_socket, idle_timeout=default_idle_timeout, wait=30):
+	client = connect(socket_path)
+	if client is None:
+		with open(socket_path + '.log', 'a') as log:
+			# options go before the command, everything after it is dfg.py's
+			subprocess.Popen([sys.executable, os.path.abspath(__file__),
+				'--socket', socket_path, '--idle-timeout', str(idle_timeout), 'serve'],
+				stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+		deadline = time.time() + wait
+		while client is None and time.time() < deadline:
+			time.sleep(0.05)
+			client = connect(socket_path)
+	if client is None:
+		return False
+	client.close()
+	return True
+
+# Run dfg.py with argv on the server, starting it if needed, or in a
+# subprocess if no server can be started
+# Returns: dfg.py's exit status
+def run(argv, socket_path=default_socket, idle_timeout=default_idle_timeout):
+	client = connect(socket_path)
+	if client is None and start(socket_path, idle_timeout):
+		client = connect(socket_path)
+	if client is None:
+		dfg_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dfg.py')
+		return subprocess.call([sys.executable, dfg_py] + argv)
+	with client:
+		client.sendall(json.dumps({'cwd': os.getcwd(), 'argv': argv}).encode() + b'\n')
+		response = json.loads(_read_line(client))
+	sys.stdout.write(response['output'])
+	return response['status']
+
+# ask a running server to exit once it has finished its requests
+def stop(socket_path=default_socket):
+	client = connect(socket_path)
+	if client is not None:
+		with client:
+			client.sendall(json.dumps({'stop': True}).encode() + b'\n')
+			_read_line(client)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('command', choices=['serve', 'start', 'run', 'stop'])
+	parser.add_argument('argv', nargs=argparse.REMAINDER,
+		help="dfg.py's arguments, for run (after --)")
+	parser.add_argument('--socket', type=str, default=default_socket)
+	parser.add_argument('--idle-timeout', type=float, default=default_idle_timeout,
+		help='seconds a server waits for requests before exiting')
+	args = parser.parse_args()
+	argv = args.argv[1:] if args.argv[:1] == ['--'] else args.argv
+	if argv and args.command != 'run':
+		parser.error('options go before the command: %s' % ' '.join(argv))
+
+	if args.command == 'serve':
+		serve(args.socket, args.idle_timeout)
+	elif args.command == 'start':
+		exit(0 if start(args.socket, args.idle_timeout) else 1)
+	elif args.command == 'run':
+		exit(run(argv, args.socket, args.idle_timeout))
+	else:
+		stop(args.socket)
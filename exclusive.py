@@ -0,0 +1,183 @@
+from collections import namedtuple
+import numpy as np
+
+# Mutually exclusive matches without re-checking pointers: the matches are
+# encoded once as integer node arrays, with the matches containing each node,
+# so the matches a match conflicts with are looked up rather than searched
+# for. Matches are put in one global order (most valuable first, then
+# largest, then in list order), which restricted to any groups of matches is the order the greedy of
+# pick_mutually_exclusive_matches visits them in. Sets of matches are then
+# Python int bitsets over that order, and the greedy is: pick the lowest
+# candidate, drop it and everything it conflicts with, repeat.
+#	matches: the match dicts, groups concatenated in order (None for a
+#	         row_match_table)
+#	group: which group (stencil) each match came from
+#	group_ptr: matches of group g are group_ptr[g]:group_ptr[g+1]
+#	size: number of nodes of each match
+#	value: total weight of the nodes of each match (e.g. how often they run),
+#	         its size when nodes aren't weighted
+#	ptr, nodes: integer nodes of match m are nodes[ptr[m]:ptr[m+1]]
+#	order, position: match at each position of the global order, and back
+#	node_ptr, node_owner: matches containing node v are
+#	         node_owner[node_ptr[v]:node_ptr[v+1]]
+#	group_bits: bitset of the positions of each group's matches
+#	conflict_bits: bitset of the positions each match conflicts with, by
+#	         position, filled in as matches get picked
+MatchTable = namedtuple('MatchTable', ['matches', 'group', 'group_ptr', 'size', 'value', 'ptr', 'nodes',
+	'order', 'position', 'node_ptr', 'node_owner', 'group_bits', 'conflict_bits'])
+
+def _bits(positions, num):
+	mask = np.zeros(num, dtype=bool)
+	mask[positions] = True
+	return int.from_bytes(np.packbits(mask, bitorder='little').tobytes(), 'little')
+
+# groups: a list of lists of match dicts (e.g. one per stencil)
+# index: dict from node id to integer, filled in as new nodes are seen
+# node_weights: dict from node id to weight (0 if missing), or None
+def match_table(groups, index=None, node_weights=None):
+	if index is None:
+		index = {}
+	matches = [m for g in groups for m in g]
+	size = np.array([len(m['node_matches']) for m in matches], dtype=np.int64)
+	nodes = np.array([index.setdefault(v, len(index)) for m in matches for v in m['node_matches']],
+		dtype=np.int64)
+	weight = None
+	if node_weights is not None:
+		weight = np.array([node_weights.get(v, 0) for v in index], dtype=float)
+	return _match_table(matches, [len(g) for g in groups], size, nodes, len(index), weight)
+
+# match_table of matches kept as rows of integer nodes
+# groups: a list of 2d integer arrays, one row per match (e.g. one per
+#         stencil, a column per stencil node)
+# num_nodes: nodes are 0..num_nodes-1
+# weight: array of the weight of each node, or None
+def row_match_table(groups, num_nodes, weight=None):
+	size = np.concatenate([np.full(len(g), np.shape(g)[1] if len(g) else 0, dtype=np.int64) for g in groups] +
+	                      [np.zeros(0, dtype=np.int64)])
+	nodes = np.concatenate([np.ravel(g).astype(np.int64) for g in groups] + [np.zeros(0, dtype=np.int64)])
+	return _match_table(None, [len(g) for g in groups], size, nodes, num_nodes, weight)
+
+def _match_table(matches, group_sizes, size, nodes, num_nodes, weight=None):
+	num = len(size)
+	group_ptr = np.zeros(len(group_sizes) + 1, dtype=np.int64)
+	np.cumsum(group_sizes, out=group_ptr[1:])
+	group = np.repeat(np.arange(len(group_sizes)), group_sizes)
+	ptr = np.zeros(num + 1, dtype=np.int64)
+	np.cumsum(size, out=ptr[1:])
+
+	owner = np.repeat(np.arange(num), size)
+	value = size if weight is None else np.bincount(owner, weights=weight[nodes], minlength=num)
+
+	order = np.lexsort((-size, -value))
+	position = np.empty(num, dtype=np.int64)
+	position[order] = np.arange(num)
+
+	# a conflict graph can be quadratic in the matches sharing a node (a
+	# pointer used all over), so keep the owners of each node instead
+	node_owner = owner[np.argsort(nodes, kind='stable')]
+	node_ptr = np.zeros(num_nodes + 1, dtype=np.int64)
+	np.cumsum(np.bincount(nodes, minlength=num_nodes), out=node_ptr[1:])
+
+	group_bits = [_bits(position[group_ptr[g]:group_ptr[g + 1]], num) for g in range(len(group_sizes))]
+	return MatchTable(matches, group, group_ptr, size, value, ptr, nodes, order, position,
+		node_ptr, node_owner, group_bits, {})
+
+# Returns: matches sharing a node with match m, m itself included (repeatedly)
+def _owners(table, m):
+	return np.concatenate([table.node_owner[table.node_ptr[v]:table.node_ptr[v + 1]]
+	                       for v in table.nodes[table.ptr[m]:table.ptr[m + 1]].tolist()] +
+	                      [np.array([m], dtype=np.int64)])
+
+# Returns: matches sharing a node with match m
+def neighbours(table, m):
+	owners = np.unique(_owners(table, m))
+	return owners[owners != m]
+
+def _conflict_bits(table, p):
+	if p not in table.conflict_bits:
+		table.conflict_bits[p] = _bits(table.position[_owners(table, table.order[p])], len(table.size))
+	return table.conflict_bits[p]
+
+# Returns: positions the greedy picks out of the candidates bitset, in order
+def _greedy(table, candidates):
+	picked = []
+	while candidates:
+		p = (candidates & -candidates).bit_length() - 1
+		picked.append(p)
+		candidates &= ~_conflict_bits(table, p)
+	return picked
+
+# Returns: indices (into table.matches) of the exclusive matches that
+#   pick_mutually_exclusive_matches would choose from the matches of groups
+#   (all groups by default) concatenated in that order, in the order it would
+#   choose them
+#   groups must be in increasing order, as itertools.combinations gives them
+def exclusive_selection(table, groups=None):
+	if groups is None:
+		groups = range(len(table.group_bits))
+	candidates = 0
+	for g in groups:
+		candidates |= table.group_bits[g]
+	return table.order[_greedy(table, candidates)]
+
+# Returns: number of exclusive matches of each group on its own
+def exclusive_counts_per_group(table):
+	return np.array([len(_greedy(table, bits)) for bits in table.group_bits], dtype=np.int64)
+
+# Returns: number of matches of each group among the selected
+def group_counts(table, selected):
+	return np.bincount(table.group[selected], minlength=len(table.group_bits))
+
+# Returns: number of nodes covered by the (mutually exclusive) selected matches
+def covered_nodes(table, selected):
+	return int(table.size[selected].sum())
+
+# Returns: total weight of the nodes covered by the (mutually exclusive)
+#   selected matches
+def covered_weight(table, selected):
+	return float(table.value[selected].sum())
+
+# local search on top of the greedy: swap one chosen match for non-overlapping
+# matches that only overlap it and cover more (weight of) nodes, until no swap
+# helps
+# Returns: indices (into table.matches), in table order
+def improve_exclusive(table, selected, groups=None):
+	allowed = np.zeros(len(table.size), dtype=bool)
+	for g in range(len(table.group_bits)) if groups is None else groups:
+		allowed[table.group_ptr[g]:table.group_ptr[g + 1]] = True
+	nbrs = {}
+	def neighbours_of(m):
+		if m not in nbrs:
+			nbrs[m] = neighbours(table, m)
+		return nbrs[m]
+	chosen = np.zeros(len(table.size), dtype=bool)
+	chosen[selected] = True
+	# number of chosen matches each match overlaps
+	blocking = np.zeros(len(table.size), dtype=np.int64)
+	for m in np.flatnonzero(chosen).tolist():
+		blocking[neighbours_of(m)] += 1
+
+	improved = True
+	while improved:
+		improved = False
+		for s in np.flatnonzero(chosen).tolist():
+			if not chosen[s]:
+				continue
+			candidates = sorted((n for n in neighbours_of(s).tolist()
+			                     if allowed[n] and not chosen[n] and blocking[n] == 1),
+			                    key=lambda n: (-table.value[n], -table.size[n], n))
+			swap_in = []
+			taken = set()
+			for n in candidates:
+				if n not in taken:
+					swap_in.append(n)
+					taken.update(neighbours_of(n).tolist())
+			gain = table.value[swap_in].sum() - table.value[s]
+			if gain > 0 or (gain == 0 and len(swap_in) > 1):
+				chosen[s] = False
+				blocking[neighbours_of(s)] -= 1
+				for m in swap_in:
+					chosen[m] = True
+					blocking[neighbours_of(m)] += 1
+				improved = True
+	return np.flatnonzero(chosen)
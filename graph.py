@@ -1,12 +1,18 @@
 import os
 import subprocess
 import glob
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
 import numpy as np
 import math
+import networkx as nx
+import dfg
+import profiling
 # don't let matplotlib use xwindows
 matplotlib.use('Agg')
 
@@ -53,7 +59,7 @@ stencils = ['aha-mont64/mont64',
 			'slre/libslre',
 			'st/libst',
 			'statemate/libstatemate',
-			'ud/libud'
+			'ud/libud',
 			'wikisort/libwikisort'
 			]
 stencils = ['./tests/embench/%s_2-to-2-edge-subgraphs_combos-stencils.json' % s for s in stencils]
@@ -83,7 +89,71 @@ def run_all_benchmarks_with_given_stencils(stencils):
 		print(stencil)
 		subprocess.call(['python', 'profiling.py', '--stencil-json', stencil])
 
+def load_stencils(stencil_json):
+	with open(stencil_json, 'r') as jsonfile:
+		return [nx.readwrite.json_graph.node_link_graph(H_json) for H_json in json.load(jsonfile)]
+
+# static coverage (percent of instructions matched) of each stencil set on one
+# benchmark, matched the way the pass has dfg.py match a --stencil-json
+#   The total is the pass's instruction count from the benchmark's last
+#   profiling run, as the DFG leaves out some instructions; without one it's
+#   the instructions in the DFG.
+def static_coverage_row(benchmark, stencil_sets, use_cache=True):
+	fn = profiling.dfg_json(benchmark)
+	C = dfg.compact_graph_from_json(fn, use_cache=use_cache)
+	graph_key = dfg.match_graph_key(fn) if use_cache else None
+	instructions = {v for v, code in zip(C.ids, C.opcode.tolist()) if dfg.is_instruction_opcode(C.opcodes[code])}
+	last_result = profiling.last_result(benchmark)
+	total = int(last_result['static total']) if last_result else len(instructions)
+
+	row = {}
+	for name, Hs in stencil_sets.items():
+		matches = [m for H_matches in dfg.find_matches_many(Hs, C, graph_key) for m in H_matches]
+		exclusive = dfg.pick_mutually_exclusive_matches(matches)
+		matched = len({v for m in exclusive for v in m['node_matches']} & instructions)
+		row[name] = 100 * matched / total if total else 0
+	return row
+
+# Fill the benchmark x stencil set static coverage matrix from the DFGs the
+# pass wrote, without recompiling anything: each DFG and stencil set is loaded
+# once, and benchmarks are matched jobs at a time
+# Returns: DataFrame of percent covered, by benchmark (rows) and stencil file
+def static_coverage_matrix(stencils, jobs=1, use_cache=True):
+	stencil_sets = {}
+	for stencil in stencils:
+		if os.path.exists(stencil):
+			name = os.path.relpath(stencil, profiling.EMBENCH_DIR).replace('_2-to-2-edge-subgraphs_combos-stencils.json', '')
+			stencil_sets[name] = load_stencils(stencil)
+		else:
+			print('missing stencils', stencil)
+	benchmarks = [b for b in benchmark_names if os.path.exists(profiling.dfg_json(os.path.join(profiling.EMBENCH_DIR, b)))]
+	for b in benchmark_names:
+		if b not in benchmarks:
+			print('missing DFG for', b)
+
+	with ProcessPoolExecutor(max_workers=jobs) as executor:
+		rows = list(executor.map(static_coverage_row, [os.path.join(profiling.EMBENCH_DIR, b) for b in benchmarks],
+			[stencil_sets] * len(benchmarks), [use_cache] * len(benchmarks)))
+	return pd.DataFrame(rows, index=pd.Index(benchmarks, name='benchmark'), columns=list(stencil_sets))
+
+def plot_static_coverage_matrix(matrix, filename):
+	plt.rcParams['figure.figsize'] = (12, 9)
+	ax = sns.heatmap(matrix, annot=True, fmt='.1f', annot_kws={'fontsize': 'x-small'}, cmap='viridis')
+	ax.set_xlabel('Stencils from')
+	ax.set_ylabel('Benchmark')
+	plt.savefig(filename, bbox_inches='tight', dpi=400)
+	plt.close()
+
 def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--dynamic', action='store_true',
+		help='recompile and run every benchmark with every stencil file for dynamic coverage too')
+	parser.add_argument('--jobs', type=int, default=1,
+		help='number of benchmarks to match at once')
+	parser.add_argument('--no-cache', action='store_true',
+		help='always parse DFGs and match stencils instead of using the caches')
+	args = parser.parse_args()
+
 	data = pd.read_csv('embench-profiling.csv').rename(columns={'static percent': 'Static', 'dynamic percent': 'Dynamic'})
 	data = data.melt(id_vars='benchmark').rename(columns=str.title).rename(columns={'Value': 'Percent of instructions covered'})
 	data = data.loc[data['Variable'].isin(['Static', 'Dynamic'])]
@@ -92,7 +162,12 @@ def main():
 	data_second_half = data.loc[data['Benchmark'].isin(benchmark_names[halfway:])]
 	plot_all_static_dynamic_coverage(data_first_half, half=1, figsize=(12,3))
 	plot_all_static_dynamic_coverage(data_second_half, half=2, figsize=(12,3))
-	run_all_benchmarks_with_given_stencils(stencils)
+	if args.dynamic:
+		run_all_benchmarks_with_given_stencils(stencils)
+	else:
+		matrix = static_coverage_matrix(stencils, jobs=args.jobs, use_cache=not args.no_cache)
+		matrix.to_csv('embench-static-coverage.csv', float_format='%.2f')
+		plot_static_coverage_matrix(matrix, 'embench-static-coverage.png')
 
 if __name__ == '__main__':
 	main()
\ No newline at end of file
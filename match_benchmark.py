@@ -0,0 +1,99 @@
+import os
+import glob
+import json
+import time
+import random
+import argparse
+import networkx as nx
+import dfg
+import compact_graph
+
+# Microbenchmark of stencil matching on program graphs: VF2 on networkx (what
+# find_matches did for everything), the label-indexed search on a
+# CompactGraph one stencil at a time, and find_matches_many for the whole
+# library at once. Checks all three find the same matches.
+
+EMBENCH_DIR = 'tests/embench/'
+
+# Returns: the num largest DFG json files the pass wrote for Embench
+def largest_embench_dfgs(num):
+	dfgs = [fn for fn in glob.glob(os.path.join(EMBENCH_DIR, '*', '*.json'))
+	        if not os.path.basename(fn).startswith('.') and '-matches' not in fn]
+	return sorted(dfgs, key=os.path.getsize, reverse=True)[:num]
+
+# Returns: num small connected node-induced subgraphs of G to use as stencils
+def sample_stencils(G, num, seed=0):
+	rng = random.Random(seed)
+	nodes = sorted(G)
+	Hs = []
+	while nodes and len(Hs) < num:
+		k = rng.randint(2, 5)
+		sub = [rng.choice(nodes)]
+		for _ in range(4 * k):
+			if len(sub) == k:
+				break
+			w = rng.choice(sub)
+			nbrs = sorted(set(G.successors(w)) | set(G.predecessors(w)))
+			if nbrs:
+				u = rng.choice(nbrs)
+				if u not in sub:
+					sub.append(u)
+		H = nx.DiGraph(G.subgraph(sub))
+		H = nx.relabel_nodes(H, {u: '%s_%d' % (H.nodes[u]['opcode'], i) for i, u in enumerate(sub)})
+		H.graph['name'] = 'sampled_%d' % len(Hs)
+		Hs.append(H)
+	return Hs
+
+def match_sets(matches):
+	return [sorted(tuple(sorted(m['node_matches'].items())) for m in H_matches) for H_matches in matches]
+
+def benchmark(fn, Hs, num_stencils):
+	C = dfg.compact_graph_from_json(fn, use_cache=False)
+	G = compact_graph.compact_to_nx(C)
+	if Hs is None:
+		Hs = sample_stencils(G, num_stencils)
+
+	start = time.time()
+	vf2 = [dfg.find_matches(H, G) for H in Hs]
+	vf2_time = time.time() - start
+
+	start = time.time()
+	compact_graph.label_index(C)
+	index_time = time.time() - start
+	indexed = [dfg.find_matches(H, C) for H in Hs]
+	indexed_time = time.time() - start
+
+	start = time.time()
+	many = dfg.find_matches_many(Hs, C)
+	many_time = time.time() - start
+
+	same = match_sets(vf2) == match_sets(indexed) == match_sets(many)
+	print('%s: %d nodes, %d edges, %d stencils, %d matches%s' %
+		(fn, len(C.ids), len(C.out_nbr), len(Hs), sum(map(len, vf2)), '' if same else ', MISMATCH'))
+	print('\tvf2 %.3fs, indexed %.3fs (index %.3fs, %.1fx), find_matches_many %.3fs (%.1fx)' %
+		(vf2_time, indexed_time, index_time, vf2_time / max(indexed_time, 1e-9),
+		 many_time, vf2_time / max(many_time, 1e-9)))
+	return same
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('inputs', nargs='*',
+		help='DFG json files (by default the largest Embench ones)')
+	parser.add_argument('--num-inputs', type=int, default=3,
+		help='number of Embench DFGs to use when no inputs are given')
+	parser.add_argument('--stencil-json', type=str, required=False,
+		help='stencils to match (by default sampled from each input)')
+	parser.add_argument('--num-stencils', type=int, default=100,
+		help='number of stencils to sample')
+	args = parser.parse_args();
+
+	Hs = None
+	if args.stencil_json:
+		with open(args.stencil_json, 'r') as jsonfile:
+			Hs = [nx.readwrite.json_graph.node_link_graph(H_json) for H_json in json.load(jsonfile)]
+
+	inputs = args.inputs or largest_embench_dfgs(args.num_inputs)
+	if not inputs:
+		print('no DFGs found, build the Embench benchmarks first (python3 profiling.py)')
+	if not all([benchmark(fn, Hs, args.num_stencils) for fn in inputs]):
+		exit(1)
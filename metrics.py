@@ -0,0 +1,101 @@
+import os
+import re
+import sys
+import json
+import time
+import socket
+import resource
+from contextlib import contextmanager
+from collections import defaultdict
+
+# Phase timings and counters of one dfg.py run, written with --profile-out.
+# Phases are (name, k, within) triples: k is the number of stencil edges for
+# phases run once per k and None otherwise, and within is the phase it ran in
+# (whose time includes it), if any. A phase entered more than once adds up.
+# Each records wall time and the peak resident memory of the process while it
+# ran. Counters are (name, k) pairs.
+#   The output's layout is versioned by schema, so nightly runs can be
+#   compared: bump it when a field changes meaning or is removed.
+schema = 'dfg-metrics-1'
+
+# (name, k, within) -> {'seconds', 'peak_rss_bytes', 'calls'}, in the order
+# phases were first entered
+phases = {}
+counters = defaultdict(int)
+# names and peak memory of the phases being run, innermost last
+_open_names = []
+_open_peaks = []
+_start = time.time()
+
+def reset():
+	global _start
+	phases.clear()
+	counters.clear()
+	_open_names.clear()
+	_open_peaks.clear()
+	_start = time.time()
+	_reset_peak_rss()
+
+# Linux lets a process reset its peak RSS (VmHWM), so each phase gets its own
+# peak; elsewhere it's the process's peak so far
+def _reset_peak_rss():
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+	except OSError:
+		pass
+
+def _peak_rss_bytes():
+	try:
+		with open('/proc/self/status', 'r') as f:
+			return int(re.search(r'VmHWM:\s+(\d+) kB', f.read()).group(1)) * 1024
+	except (OSError, AttributeError):
+		# ru_maxrss is in bytes on macOS, kB elsewhere
+		scale = 1 if sys.platform == 'darwin' else 1024
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+@contextmanager
+def phase(name, k=None):
+	# a nested phase resets the peak, so it hands the peak it saw up instead
+	if _open_peaks:
+		_open_peaks[-1] = max(_open_peaks[-1], _peak_rss_bytes())
+	_reset_peak_rss()
+	within = _open_names[-1] if _open_names else None
+	_open_names.append(name)
+	_open_peaks.append(0)
+	t = time.perf_counter()
+	try:
+		yield
+	finally:
+		seconds = time.perf_counter() - t
+		_open_names.pop()
+		peak = max(_open_peaks.pop(), _peak_rss_bytes())
+		if _open_peaks:
+			_open_peaks[-1] = max(_open_peaks[-1], peak)
+		entry = phases.setdefault((name, k, within), {'seconds': 0.0, 'peak_rss_bytes': 0, 'calls': 0})
+		entry['seconds'] += seconds
+		entry['peak_rss_bytes'] = max(entry['peak_rss_bytes'], peak)
+		entry['calls'] += 1
+
+def count(name, value=1, k=None):
+	counters[name, k] += value
+
+# Returns: the run's metrics as a json-able dict
+def report(**run):
+	return dict(
+		schema = schema,
+		date = time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(_start)),
+		host = socket.gethostname(),
+		run = run,
+		total_seconds = time.time() - _start,
+		peak_rss_bytes = max([_peak_rss_bytes()] + [p['peak_rss_bytes'] for p in phases.values()]),
+		phases = [dict(name=name, k=k, within=within, **entry) for (name, k, within), entry in phases.items()],
+		counters = [dict(name=name, k=k, value=value)
+		            for (name, k), value in sorted(counters.items(), key=lambda c: (c[0][0], c[0][1] or 0))],
+	)
+
+def write(filename, **run):
+	tmp = '%s.%d.tmp' % (filename, os.getpid())
+	with open(tmp, 'w') as f:
+		f.write(json.dumps(report(**run), indent=4))
+	os.replace(tmp, filename)
@@ -0,0 +1,272 @@
+import os
+import csv
+import json
+import argparse
+from collections import namedtuple
+import networkx as nx
+from networkx import isomorphism
+import numpy as np
+import dfg
+import compact_graph
+import exclusive
+import metrics
+import profiling
+
+# Frequent stencils across a corpus of programs, grown one edge at a time
+# (Apriori / gSpan style) instead of enumerating every connected subgraph of
+# each program: only the occurrences of frequent k-edge patterns are extended
+# to (k+1)-edge ones, so patterns of 5 or 6 edges are reachable on all of
+# Embench.
+#   Patterns are pruned by their minimum image based support (MNI): for each
+#   orbit of the pattern's automorphisms, the number of distinct program nodes
+#   its nodes are matched to, minimised over orbits. No two mutually exclusive
+#   matches share a node, so MNI bounds the number of exclusive matches from
+#   above, and unlike the exclusive count it can only shrink as a pattern
+#   grows. Pruning a pattern with too little MNI therefore never loses a
+#   frequent larger pattern. Patterns are reported by their exclusive matches,
+#   counted the way dfg.py counts them.
+#   A pattern's nodes are positions 0..n-1 in canonical order (see
+#   dfg.canonical_labelling), and each occurrence is kept as the program
+#   nodes at those positions. An occurrence grown by an edge is a child
+#   pattern's occurrence only through how the edge attaches to the parent's
+#   positions, so each way of growing a pattern is labelled once rather than
+#   once per occurrence.
+#	key: canonical key of the pattern
+#	opcodes, edges: opcode of each position, and edges between positions
+#	first: (program, edge set) of the occurrence the pattern was found as
+#	occurrences: per program, a dict from the edge set of each occurrence (a
+#	             frozenset of positions in that program's stencil_edges) to its
+#	             nodes by position
+Pattern = namedtuple('Pattern', ['key', 'opcodes', 'edges', 'first', 'occurrences'])
+
+# A program of the corpus: its graph, the opcode name of each node and the
+# edges stencils may use (see dfg.stencil_edges)
+Program = namedtuple('Program', ['name', 'C', 'opcode', 'edges', 'incident'])
+
+def program(name, C):
+	_, edges, incident = dfg.stencil_edges(C)
+	return Program(name, C, [C.opcodes[code] for code in C.opcode.tolist()], edges, incident)
+
+def _node_match(data1, data2):
+	return data1['opcode'] == data2['opcode']
+
+def _position_graph(opcodes, edges):
+	H = nx.DiGraph()
+	H.add_nodes_from((i, {'opcode': op}) for i, op in enumerate(opcodes))
+	H.add_edges_from(edges)
+	return H
+
+# Find or make the pattern of the graph with the given positions, among
+# patterns (a dict from key to the patterns with that key)
+# Returns: (pattern, ordering), ordering being the given position at each of
+#   the pattern's positions
+def _pattern(patterns, opcodes, edges, first, num_programs):
+	key, ordering = dfg.canonical_labelling(range(len(opcodes)), edges, opcodes.__getitem__, lambda v: v)
+	bucket = patterns.setdefault(key, [])
+	if key[0] == 'canonical' and bucket:
+		return bucket[0], ordering
+	if key[0] == 'invariant':
+		# invariant keys can collide, so check which pattern this is
+		H = _position_graph(opcodes, edges)
+		for pattern in bucket:
+			gm = isomorphism.DiGraphMatcher(_position_graph(pattern.opcodes, pattern.edges), H, node_match=_node_match)
+			if gm.is_isomorphic():
+				return pattern, [gm.mapping[i] for i in range(len(opcodes))]
+	position = {v: i for i, v in enumerate(ordering)}
+	pattern = Pattern(key, tuple(opcodes[v] for v in ordering), sorted((position[s], position[t]) for s, t in edges),
+		first, [{} for _ in range(num_programs)])
+	bucket.append(pattern)
+	return pattern, ordering
+
+# Returns: the orbits of the pattern's automorphisms, as lists of positions
+def _orbits(pattern):
+	H = _position_graph(pattern.opcodes, pattern.edges)
+	orbit_of = list(range(len(pattern.opcodes)))
+	def find(i):
+		while orbit_of[i] != i:
+			i = orbit_of[i]
+		return i
+	for automorphism in isomorphism.DiGraphMatcher(H, H, node_match=_node_match).isomorphisms_iter():
+		for u, v in automorphism.items():
+			orbit_of[find(u)] = find(v)
+	orbits = {}
+	for i in range(len(pattern.opcodes)):
+		orbits.setdefault(find(i), []).append(i)
+	return list(orbits.values())
+
+# Returns: MNI of the pattern in each program, over the given groups of
+#   positions (by default the orbits of its automorphisms)
+def support(pattern, orbits=None):
+	if orbits is None:
+		orbits = _orbits(pattern)
+	return [min(len({nodes[i] for nodes in occurrences.values() for i in orbit}) for orbit in orbits)
+	        if occurrences else 0 for occurrences in pattern.occurrences]
+
+def _is_frequent(per_program, min_support, min_programs):
+	return sum(per_program) >= min_support and sum(s > 0 for s in per_program) >= min_programs
+
+# Grow every occurrence of the patterns by each stencil edge touching it
+# Returns: dict from key to the (k+1)-edge patterns found
+def _grow(frequent, programs):
+	patterns = {}
+	# an edge set reached from several parents is only added once
+	grown = [set() for _ in programs]
+	for pattern in frequent:
+		n = len(pattern.opcodes)
+		children = {}
+		for p, occurrences in enumerate(pattern.occurrences):
+			prog = programs[p]
+			for S, nodes in occurrences.items():
+				position = {v: i for i, v in enumerate(nodes)}
+				touching = set()
+				for v in nodes:
+					touching |= prog.incident[v]
+				for e in touching - S:
+					S_e = S | {e}
+					if S_e in grown[p]:
+						continue
+					grown[p].add(S_e)
+					s, t = prog.edges[e]
+					# how the edge attaches: both ends in the pattern, or
+					# one end and a new node
+					if s in position and t in position:
+						how, new = (position[s], position[t]), ()
+					elif s in position:
+						how, new = (position[s], 'out', prog.opcode[t]), (t,)
+					else:
+						how, new = (position[t], 'in', prog.opcode[s]), (s,)
+					if how not in children:
+						if not new:
+							edge = how
+						elif how[1] == 'out':
+							edge = (how[0], n)
+						else:
+							edge = (n, how[0])
+						opcodes = pattern.opcodes + ((how[2],) if new else ())
+						children[how] = _pattern(patterns, opcodes, pattern.edges + [edge], (p, S_e), len(programs))
+					child, ordering = children[how]
+					extended = nodes + new
+					child.occurrences[p][S_e] = tuple(extended[i] for i in ordering)
+	return patterns
+
+# Mine patterns of up to max_k edges whose MNI, summed over programs, is at
+# least min_support, and which occur in at least min_programs programs
+# Returns: dict from k to the frequent k-edge patterns
+def mine_frequent_stencils(programs, max_k, min_support=1, min_programs=1):
+	frequent = {}
+	for k in range(1, max_k + 1):
+		with metrics.phase('grow', k):
+			if k == 1:
+				patterns = {}
+				for p, prog in enumerate(programs):
+					for e, (s, t) in enumerate(prog.edges):
+						pattern, ordering = _pattern(patterns, (prog.opcode[s], prog.opcode[t]), [(0, 1)],
+							(p, frozenset([e])), len(programs))
+						pattern.occurrences[p][frozenset([e])] = tuple((s, t)[i] for i in ordering)
+			else:
+				patterns = _grow(frequent[k - 1], programs)
+		with metrics.phase('support', k):
+			frequent[k] = []
+			for pattern in (pattern for bucket in patterns.values() for pattern in bucket):
+				# positions of the same opcode include each orbit, so this
+				# bounds the MNI from above without finding automorphisms
+				by_opcode = {}
+				for i, op in enumerate(pattern.opcodes):
+					by_opcode.setdefault(op, []).append(i)
+				if not _is_frequent(support(pattern, list(by_opcode.values())), min_support, min_programs):
+					continue
+				if _is_frequent(support(pattern), min_support, min_programs):
+					frequent[k].append(pattern)
+		num_patterns = sum(map(len, patterns.values()))
+		metrics.count('patterns', num_patterns, k=k)
+		metrics.count('patterns_pruned', num_patterns - len(frequent[k]), k=k)
+		metrics.count('occurrences', sum(len(o) for bucket in patterns.values() for pattern in bucket for o in pattern.occurrences), k=k)
+		print('%d-edge patterns: %d, frequent: %d' % (k, num_patterns, len(frequent[k])))
+		if not frequent[k]:
+			break
+	return frequent
+
+# Returns: (H, ordering) a networkx graph of the pattern's first occurrence,
+#   with the attributes of the program graph, and its nodes by position
+def pattern_graph(pattern, programs):
+	p, S = pattern.first
+	prog = programs[p]
+	H = compact_graph.edge_subgraph(prog.C, [prog.edges[e] for e in S])
+	return H, [prog.C.ids[v] for v in pattern.occurrences[p][S]]
+
+# Returns: the occurrences of the pattern in the p-th program as a
+#   dfg.StencilMatches, in order of their nodes, so the exclusive matches
+#   picked from them don't depend on the order they were found in
+def pattern_matches(pattern, programs, p, name, H_json, canonical):
+	rows = np.array(sorted(pattern.occurrences[p].values()), dtype=np.int32).reshape(-1, len(canonical))
+	return dfg.StencilMatches(name, H_json, canonical, programs[p].C.ids, rows)
+
+# Returns: list of (name, stencil json, exclusive matches per program, matches
+#   per program) for the frequent patterns of bottom_k or more edges with at
+#   least min_support exclusive matches in all, most exclusive matches first
+def rank_patterns(frequent, programs, bottom_k, min_support=1):
+	ranked = []
+	for k, patterns in frequent.items():
+		if k < bottom_k:
+			continue
+		for pattern in patterns:
+			H, ordering = pattern_graph(pattern, programs)
+			name, pointer_to_canonical = dfg.canonicalize_name(H, ordering)
+			canonical = [pointer_to_canonical[v] for v in ordering]
+			H_json = dfg.canonicalize_json(H, ordering, pointer_to_canonical)
+			matches = [pattern_matches(pattern, programs, p, name, H_json, canonical) for p in range(len(programs))]
+			num_exclusive = [len(exclusive.exclusive_selection(exclusive.row_match_table([m.rows], len(m.ids))))
+			                 if len(m.rows) else 0 for m in matches]
+			if sum(num_exclusive) >= min_support:
+				ranked.append((name, H_json, num_exclusive, [len(m.rows) for m in matches]))
+	ranked.sort(key=lambda r: (-sum(r[2]), -len(r[1]['edges']), r[0]))
+	return ranked
+
+# write the ranked patterns as a stencil json file, like dfg.py's
+# *-stencils.json, and a csv of their matches per program next to it
+def write_patterns(ranked, programs, filename):
+	with open(filename.replace('.json', '.csv', 1), 'w') as csvfile:
+		csvwriter = csv.writer(csvfile, delimiter='\t')
+		csvwriter.writerow(['subgraph', 'edges', 'exclusive', 'total'] + [prog.name for prog in programs])
+		for name, H_json, num_exclusive, num_matches in ranked:
+			csvwriter.writerow([name, len(H_json['edges']), sum(num_exclusive), sum(num_matches)] + num_exclusive)
+	with open(filename, 'w') as f:
+		f.write(json.dumps([H_json for _, H_json, _, _ in ranked], indent=4))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('inputs', nargs='*',
+		help='DFG json files (by default those the pass wrote for Embench)')
+	parser.add_argument('--bottom-k', type=int, default=2,
+		help='smallest number of edges of stencils to report')
+	parser.add_argument('--max-k', type=int, default=6,
+		help='largest number of edges of stencils to grow')
+	parser.add_argument('--min-support', type=int, default=20,
+		help='fewest exclusive matches, over all programs, of a stencil')
+	parser.add_argument('--min-programs', type=int, default=2,
+		help='fewest programs a stencil has to match in')
+	parser.add_argument('--num-stencils', type=int, default=None,
+		help='number of stencils with the most exclusive matches to write (by default all)')
+	parser.add_argument('--output', type=str, default='corpus-stencils.json',
+		help='stencil json file to write, with a csv of matches per program next to it')
+	parser.add_argument('--no-cache', action='store_true',
+		help='always parse the input json instead of using the cache')
+	parser.add_argument('--profile-out', type=str, default=None,
+		help='write phase times and counters to this json file (see dfg.py)')
+	args = parser.parse_args()
+
+	inputs = args.inputs
+	if not inputs:
+		benchmarks = [os.path.join(profiling.EMBENCH_DIR, b) for b in profiling.BY_SIZE]
+		inputs = [fn for fn in map(profiling.dfg_json, benchmarks) if os.path.exists(fn)]
+	if not inputs:
+		exit('no DFGs found, build the Embench benchmarks first (python3 profiling.py)')
+
+	metrics.reset()
+	programs = [program(fn, dfg.compact_graph_from_json(fn, use_cache=not args.no_cache)) for fn in inputs]
+	frequent = mine_frequent_stencils(programs, args.max_k, args.min_support, args.min_programs)
+	ranked = rank_patterns(frequent, programs, args.bottom_k, args.min_support)[:args.num_stencils]
+	write_patterns(ranked, programs, args.output)
+	print('Wrote %d stencils to %s' % (len(ranked), args.output))
+	if args.profile_out:
+		metrics.write(args.profile_out, inputs=inputs)
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import random
+import platform
+import tempfile
+import argparse
+import contextlib
+import networkx as nx
+import dfg
+import compact_graph
+
+# Benchmarks of the dfg.py pipeline on synthetic DFGs, so it can be timed
+# without LLVM or an Embench build. The generators write DFG json in the format
+# DFGPass writes; each stage is timed at several sizes, best of a few repeats,
+# and the times are written to a json baseline that later runs can be
+# compared against.
+
+schema = 'pipeline-benchmark-1'
+
+# opcodes of generated instructions, most common first (see the skew of
+# random_dfg), and their number of operands when that's fixed
+opcodes = ['add', 'load', 'getelementptr', 'store', 'icmp', 'br', 'mul', 'sext', 'sub',
+           'shl', 'and', 'xor', 'or', 'ashr', 'select', 'zext', 'trunc', 'call', 'sdiv', 'srem']
+arities = {'load': 1, 'br': 1, 'sext': 1, 'zext': 1, 'trunc': 1, 'store': 2, 'select': 3}
+
+# Returns: list of instructions and out nodes, as in the DFG json DFGPass
+#   writes, of num_blocks basic blocks of block_size instructions each
+#   skew: opcode i is picked with weight 1 / (i + 1) ** skew, so 0 is uniform
+#   fan_in: number of operands of instructions whose arity isn't fixed
+#   chain: each instruction's first operand is the instruction before it,
+#          rather than a random earlier one in the block
+#   Operands are earlier instructions of the block with probability
+#   p_instruction, otherwise constants, arguments or (after the first block)
+#   instructions of earlier blocks. Instructions are used outside their block
+#   (and get an out node) with probability p_out.
+def random_dfg(num_blocks, block_size, skew=1.0, fan_in=2, chain=False, blocks_per_function=8,
+               p_instruction=0.7, p_out=0.1, seed=0):
+	rng = random.Random(seed)
+	weights = [1 / (i + 1) ** skew for i in range(len(opcodes))]
+	next_ptr = [0x10000]
+	def pointer():
+		next_ptr[0] += 16
+		return '0x%x' % next_ptr[0]
+
+	instructions = []
+	earlier_blocks = []
+	arguments = []
+	for b in range(num_blocks):
+		if b % blocks_per_function == 0:
+			arguments = [pointer() for _ in range(rng.randint(1, 4))]
+		block = []
+		for opcode in rng.choices(opcodes, weights, k=block_size):
+			ptr = pointer()
+			operands = []
+			for i in range(arities.get(opcode, fan_in)):
+				r = rng.random()
+				if block and (chain and i == 0 or r < p_instruction):
+					value = block[-1] if chain and i == 0 else rng.choice(block)
+					operands.append({'description': 'instruction', 'type': 'i32', 'value': value})
+				elif earlier_blocks and r < p_instruction + (1 - p_instruction) / 3:
+					operands.append({'description': 'instruction-external', 'type': 'i32',
+					                 'value': rng.choice(earlier_blocks)})
+				elif r < p_instruction + 2 * (1 - p_instruction) / 3:
+					n = rng.randrange(len(arguments))
+					operands.append({'description': 'argument', 'type': 'i32', 'value': arguments[n],
+					                 'argument_number_in_function': n})
+				else:
+					operands.append({'description': 'constant', 'type': 'i32', 'value': rng.randint(0, 255)})
+			if rng.random() < p_out:
+				instructions.append({'pointer': pointer(), 'description': 'out', 'type': 'i32', 'value': ptr})
+			instructions.append({'pointer': ptr, 'opcode': opcode, 'type': 'i32', 'operands': operands, 'block': b,
+			                     'text': '  %%%s = %s i32 %s' % (ptr, opcode, ', '.join(str(op['value']) for op in operands))})
+			block.append(ptr)
+		# only a few values are live out of a block
+		earlier_blocks += rng.sample(block, min(len(block), 2))
+	return instructions
+
+# shapes of program to generate, by name: function from scale (number of
+# instructions) to DFG json
+workloads = {
+	# one large block of random dependencies
+	'dag': lambda n: random_dfg(1, n, seed=n),
+	# one large block, weighted towards a few opcodes, with more operands
+	'skewed-dag': lambda n: random_dfg(1, n, skew=2.0, fan_in=3, seed=n),
+	# long dependency chains
+	'chains': lambda n: random_dfg(max(1, n // 250), 250, chain=True, p_instruction=0.3, seed=n),
+	# many small blocks, like most real programs
+	'blocks': lambda n: random_dfg(max(1, n // 8), 8, seed=n),
+}
+
+default_scales = [100, 300, 1000]
+
+# Returns: the best of repeat wall times of f(), and what its last call returned
+def best_time(f, repeat):
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = f()
+		times.append(time.perf_counter() - start)
+	return min(times), result
+
+# Time each stage of the pipeline on the DFG json in fn
+# Returns: dict from stage name to seconds
+def benchmark(fn, max_k, num_stencils, repeat):
+	seconds = {}
+	seconds['graph_from_json'], (V, E) = best_time(lambda: dfg.graph_from_json(fn), repeat)
+	seconds['graph2nx'], G = best_time(lambda: dfg.graph2nx(V, E), repeat)
+	C = compact_graph.compact_from_nx(G)
+
+	# the pipeline prints its results, which would drown out the times
+	with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+		subgraph_to_matches = {}
+		for k in range(1, max_k + 1):
+			seconds['generate_stencils_k%d' % k], subgraph_to_matches[k] = best_time(
+				lambda: dfg.generate_all_stencils_between_ks(G, k, k, fn), repeat)
+
+		# the stencils with the most matches at k = 2 make a realistic library
+		stencils = subgraph_to_matches[min(2, max_k)]
+		library = sorted(stencils.values(), key=lambda s: len(s.rows), reverse=True)[:num_stencils]
+		Hs = [nx.readwrite.json_graph.node_link_graph(H_matches.json) for H_matches in library]
+		seconds['find_matches'], matches = best_time(lambda: [m for H in Hs for m in dfg.find_matches(H, C)], repeat)
+		seconds['pick_mutually_exclusive_matches'], _ = best_time(
+			lambda: dfg.pick_mutually_exclusive_matches(matches), repeat)
+		seconds['estimate_coverage'], _ = best_time(lambda: dfg.estimate_coverage(Hs, C), repeat)
+		seconds['pick_r_stencils'], _ = best_time(
+			lambda: dfg.pick_r_stencils(stencils, 2, fn.replace('.json', '_combos.csv', 1)), repeat)
+	return seconds
+
+# Run every workload at every scale
+# Returns: the baseline: dict with the schema, the machine it ran on, and
+#   results, a dict from '<workload>/<scale>/<stage>' to seconds
+def run_suite(names, scales, max_k, num_stencils, repeat, keep_dir=None):
+	results = {}
+	with tempfile.TemporaryDirectory() as tmp:
+		directory = keep_dir or tmp
+		os.makedirs(directory, exist_ok=True)
+		for name in names:
+			for scale in scales:
+				fn = os.path.join(directory, '%s-%d.json' % (name, scale))
+				with open(fn, 'w') as f:
+					# DFGPass's json library writes keys in order too
+					json.dump(workloads[name](scale), f, indent=4, sort_keys=True)
+				seconds = benchmark(fn, max_k, num_stencils, repeat)
+				print('%s/%d: %s' % (name, scale, ', '.join('%s %.3fs' % kv for kv in seconds.items())))
+				for stage, s in seconds.items():
+					results['%s/%d/%s' % (name, scale, stage)] = s
+	return dict(schema=schema, python=platform.python_version(), machine=platform.machine(),
+	            date=time.strftime('%Y-%m-%dT%H:%M:%S%z'), results=results)
+
+# Returns: list of (key, baseline seconds, seconds) that got more than
+#   threshold (a fraction) slower than the baseline
+#   Stages faster than min_seconds in the baseline are too noisy to judge.
+def regressions(baseline, current, threshold, min_seconds=0.01):
+	slower = []
+	for key, seconds in current['results'].items():
+		before = baseline['results'].get(key)
+		if before is None or before < min_seconds:
+			continue
+		if seconds > before * (1 + threshold):
+			slower.append((key, before, seconds))
+	return slower
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--workloads', nargs='+', choices=list(workloads), default=list(workloads))
+	parser.add_argument('--scales', nargs='+', type=int, default=default_scales,
+		help='numbers of instructions to generate')
+	parser.add_argument('--max-k', type=int, default=4,
+		help='largest number of stencil edges to generate stencils with')
+	parser.add_argument('--num-stencils', type=int, default=20,
+		help='number of stencils to match with find_matches')
+	parser.add_argument('--repeat', type=int, default=3,
+		help='times to run each stage, keeping the best')
+	parser.add_argument('--output', type=str, default='pipeline-benchmark.json',
+		help='json file to write the times to')
+	parser.add_argument('--compare', type=str, required=False,
+		help='baseline json to compare the times against')
+	parser.add_argument('--threshold', type=float, default=0.2,
+		help='fraction slower than the baseline that counts as a regression')
+	parser.add_argument('--min-seconds', type=float, default=0.01,
+		help="stages faster than this in the baseline aren't compared")
+	parser.add_argument('--keep-dfgs', type=str, required=False,
+		help='directory to keep the generated DFG json files in')
+	args = parser.parse_args();
+
+	if args.compare:
+		with open(args.compare, 'r') as f:
+			baseline = json.load(f)
+		if baseline.get('schema') != schema:
+			exit('%s has schema %s, not %s' % (args.compare, baseline.get('schema'), schema))
+
+	current = run_suite(args.workloads, args.scales, args.max_k, args.num_stencils, args.repeat, args.keep_dfgs)
+	with open(args.output, 'w') as f:
+		f.write(json.dumps(current, indent=4))
+
+	if args.compare:
+		slower = regressions(baseline, current, args.threshold, args.min_seconds)
+		for key, before, seconds in slower:
+			print('REGRESSION %s: %.3fs -> %.3fs (%+.0f%%)' % (key, before, seconds, 100 * (seconds / before - 1)))
+		print('%d of %d stages more than %.0f%% slower than %s' %
+			(len(slower), len(current['results']), 100 * args.threshold, args.compare))
+		if slower:
+			exit(1)
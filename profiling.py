@@ -1,17 +1,15 @@
 import os
+import csv
+import glob
+import time
+import hashlib
 import subprocess
 import argparse
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--stencil-json', type=str, required=False)
-args = parser.parse_args();
-additional_flags = ''
-csv_filename = 'embench-profiling.csv'
-if args.stencil_json:
-    additional_flags = 'ADD_PASS_FLAGS=-stencil-json %s' % args.stencil_json
-    csv_filename = 'embench-profiling_%s.csv' % (args.stencil_json.split('/')[-1]).replace('.json', '', 1)
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 EMBENCH_DIR = 'tests/embench/'
+EMBENCH_SUPPORT_DIR = os.path.join(EMBENCH_DIR, 'support')
+CSV_HEADER = "benchmark,static matched,static total,static percent,dynamic matched,dynamic total,dynamic percent\n"
 
 BY_SIZE = [
             "cubic/",
@@ -35,56 +33,159 @@ BY_SIZE = [
             "nsichneu/",
             ]
 
-def run_embench_benchmark(benchmark):
+def c_file_roots(benchmark):
     c_files = []
     for filename in os.listdir(benchmark):
         f_root, ext = os.path.splitext(filename)
         if ext == '.c':
             c_files.append(f_root)
+    return c_files
+
+# Returns: the DFG json the pass writes for a benchmark (benchmarks with
+# multiple files are combined into one before the pass)
+def dfg_json(benchmark):
+    c_files = c_file_roots(benchmark)
+    base = 'combined' if len(c_files) > 1 else c_files[0]
+    return os.path.join(benchmark, base + '.json')
+
+# Returns: the result row (a dict by column) of the benchmark's last run for
+# csv_filename, or None if it hasn't been run
+def last_result(benchmark, csv_filename='embench-profiling.csv'):
+    name = os.path.splitext(os.path.basename(csv_filename))[0]
+    try:
+        with open(os.path.join(benchmark, name + '.csv'), 'r') as f:
+            return list(csv.DictReader(f))[-1]
+    except (OSError, IndexError):
+        return None
+
+# Everything a benchmark's results depend on: its sources, the Embench support
+# code, the profiling runtime, the Makefile, the pass library and the python
+# it calls, and the stencil file and flags it's run with
+def input_files(benchmark):
+    files = glob.glob(os.path.join(benchmark, '*.[ch]'))
+    files += glob.glob(os.path.join(EMBENCH_SUPPORT_DIR, '*.[ch]'))
+    files += ['profiling/Profiling.c', 'Makefile']
+    files += glob.glob('build/dfg-pass/libDFGPass.*')
+    files += glob.glob('*.py')
+    return sorted(files)
+
+def inputs_hash(benchmark, additional_flags, stencil_json):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(additional_flags.encode() + b'\0')
+    for fn in input_files(benchmark) + ([stencil_json] if stencil_json else []):
+        h.update(fn.encode() + b'\0')
+        with open(fn, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+# Build and run one benchmark, with all its output in its own directory:
+# the make/run log in <benchmark>/<name>.log, and the result line in
+# <benchmark>/<name>.csv, where name is the csv_filename's base
+#   The result is reused if the benchmark's inputs hash the same as the run
+#   that wrote it.
+# Returns: (benchmark, result line, wall time in seconds, whether it ran)
+def run_embench_benchmark(benchmark, additional_flags, csv_filename, stencil_json=None):
+    start_time = time.time()
+    name = os.path.splitext(os.path.basename(csv_filename))[0]
+    result_csv = os.path.join(benchmark, name + '.csv')
+    hash_file = os.path.join(benchmark, name + '.hash')
+    key = inputs_hash(benchmark, additional_flags, stencil_json)
+    if os.path.exists(result_csv) and os.path.exists(hash_file):
+        with open(hash_file, 'r') as f:
+            unchanged = f.read().strip() == key
+        if unchanged:
+            with open(result_csv, 'r') as f:
+                return benchmark, f.readlines()[-1], time.time() - start_time, False
+
+    # the pass target isn't a prerequisite here any more, so clear out the
+    # last build to make sure everything is rebuilt with the current inputs
+    for fn in glob.glob(os.path.join(benchmark, '*.ll')) + glob.glob(os.path.join(benchmark, '*.o')):
+        os.remove(fn)
+
+    c_files = c_file_roots(benchmark)
 
-    # Benchmarks with multiple files need to be combined into one IR file before
-    # running our pass
-    if len(c_files) > 1:
-        ll_files = []
-        for file in c_files:
-            f_target = os.path.join(benchmark, file + '.ll')
-            ll_files.append(f_target)
-            make_command = ['make', f_target]
+    with open(os.path.join(benchmark, name + '.log'), 'w') as log:
+        def call(command):
+            log.flush()
+            subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+
+        def make(target):
+            make_command = ['make', target, 'PASS_TARGET=']
             if additional_flags:
                 make_command.append(additional_flags)
-            subprocess.call(make_command)
+            call(make_command)
+
+        # Benchmarks with multiple files need to be combined into one IR file before
+        # running our pass
+        if len(c_files) > 1:
+            ll_files = []
+            for file in c_files:
+                f_target = os.path.join(benchmark, file + '.ll')
+                ll_files.append(f_target)
+                make(f_target)
 
-        comb_target = os.path.join(benchmark, 'combined.ll')
-        subprocess.call(['llvm-link'] + ll_files + ["-S", "-o", comb_target])
+            comb_target = os.path.join(benchmark, 'combined.ll')
+            call(['llvm-link'] + ll_files + ["-S", "-o", comb_target])
 
-        target = os.path.join(benchmark, 'combined-profiling-em.o')
-    else:
-        target = os.path.join(benchmark, c_files[0] + '-profiling-em.o')
+            target = os.path.join(benchmark, 'combined-profiling-em.o')
+        else:
+            target = os.path.join(benchmark, c_files[0] + '-profiling-em.o')
 
-    # Run make
-    make_command = ['make', target]
-    if additional_flags:
-        make_command.append(additional_flags)
-    subprocess.call(make_command)
+        make(target)
 
-    # Run the executable
-    subprocess.call([target])
+        # Run the executable
+        call([target])
 
     print(target[:-5] + ".csv")
     with open(target[:-5] + ".csv", "r") as csv_file:
-        with open(csv_filename, "a") as f:
-            for l in csv_file:
-                pass
+        for l in csv_file:
+            pass
+    line = benchmark.split('/')[-2] + "," + l
 
-            f.write(benchmark.split('/')[-2] + "," + l)
+    with open(result_csv, 'w') as f:
+        f.write(CSV_HEADER + line)
+    with open(hash_file, 'w') as f:
+        f.write(key + '\n')
+    return benchmark, line, time.time() - start_time, True
 
-def profile_embench():
-    with open(csv_filename, "w") as f:
-        f.write("benchmark,static matched,static total,static percent,dynamic matched,dynamic total,dynamic percent\n")
+# Profile every Embench benchmark, jobs at a time, then write their results to
+# csv_filename in BY_SIZE order and their wall times to <name>-times.csv
+def profile_embench(additional_flags='', csv_filename='embench-profiling.csv', stencil_json=None, jobs=1):
+    # shared prerequisites are built once up front, not by every benchmark
+    subprocess.call(['make', 'pass'])
+    subprocess.call(['make'] + [os.path.join(EMBENCH_SUPPORT_DIR, f) for f in ['main.ll', 'beebsc.ll']])
 
     benchmarks = [os.path.join(EMBENCH_DIR, v) for v in BY_SIZE]
-    for benchmark in benchmarks:
-        run_embench_benchmark(benchmark)
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_embench_benchmark, benchmark, additional_flags, csv_filename, stencil_json)
+                   for benchmark in benchmarks]
+        for future in as_completed(futures):
+            benchmark, line, seconds, ran = future.result()
+            results[benchmark] = (line, seconds, ran)
+            print('%s: %.1fs%s' % (benchmark, seconds, '' if ran else ' (unchanged)'))
+
+    with open(csv_filename, "w") as f:
+        f.write(CSV_HEADER)
+        for benchmark in benchmarks:
+            f.write(results[benchmark][0])
+
+    with open(csv_filename.replace('.csv', '-times.csv', 1), "w") as f:
+        f.write("benchmark,seconds,rerun\n")
+        for benchmark in benchmarks:
+            line, seconds, ran = results[benchmark]
+            f.write("%s,%.3f,%d\n" % (benchmark.split('/')[-2], seconds, ran))
 
 if __name__ == '__main__':
-    profile_embench()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stencil-json', type=str, required=False)
+    parser.add_argument('--jobs', type=int, default=1,
+        help='number of benchmarks to build and run at once')
+    args = parser.parse_args();
+    additional_flags = ''
+    csv_filename = 'embench-profiling.csv'
+    if args.stencil_json:
+        additional_flags = 'ADD_PASS_FLAGS=-stencil-json %s' % args.stencil_json
+        csv_filename = 'embench-profiling_%s.csv' % (args.stencil_json.split('/')[-1]).replace('.json', '', 1)
+
+    profile_embench(additional_flags, csv_filename, args.stencil_json, args.jobs)
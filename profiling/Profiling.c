@@ -1,31 +1,84 @@
+#include <stdatomic.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 
 #ifndef FILENAME
 #define FILENAME "profiling.csv"
 #endif
 
-// Global count variables, atomic to support multithreaded code
-_Atomic long DynamicMatched = 0;
-_Atomic long DynamicTotal = 0;
+long StaticMatched = 0;
+long StaticTotal = 0;
 
-_Atomic long StaticMatched = 0;
-_Atomic long StaticTotal = 0;
+// Per basic block, by the id the pass gave it: instructions matched and in
+// total, and the function it's in
+int NumBlocks = 0;
+const int *BlockMatched = NULL;
+const int *BlockTotal = NULL;
+const char **BlockFunction = NULL;
+
+// Each thread counts the executions of each block in an array of its own, so
+// threads don't contend for the same cache line. The arrays are kept in a
+// list, and summed when the program ends.
+struct ThreadCounts {
+  long *Counts;
+  struct ThreadCounts *Next;
+};
+static struct ThreadCounts *_Atomic AllThreadCounts = NULL;
+static _Thread_local long *Counts = NULL;
+
+static long *newThreadCounts() {
+  struct ThreadCounts *T = malloc(sizeof(struct ThreadCounts));
+  long *C = calloc(NumBlocks > 0 ? NumBlocks : 1, sizeof(long));
+  if (T == NULL || C == NULL) {
+    printf("Error allocating block counts!\n");
+    exit(1);
+  }
+  T->Counts = C;
+  T->Next = atomic_load(&AllThreadCounts);
+  while (!atomic_compare_exchange_weak(&AllThreadCounts, &T->Next, T)) {
+  }
+  Counts = C;
+  return C;
+}
 
 // To be called once, on module begin
-void saveStaticCounts(int Matched, int Total) {
+void saveStaticCounts(int Matched, int Total, int Blocks, const int *Matches,
+    const int *Totals, const char **Functions) {
   StaticMatched = Matched;
   StaticTotal = Total;
+  NumBlocks = Blocks;
+  BlockMatched = Matches;
+  BlockTotal = Totals;
+  BlockFunction = Functions;
 }
 
 // To be called per basic block
-void incremementCounts(int Matched, int Total) {
-  DynamicMatched += Matched;
-  DynamicTotal += Total;
+void incrementBlockCount(int BlockId) {
+  long *ThreadCounts = Counts ? Counts : newThreadCounts();
+  ThreadCounts[BlockId]++;
 }
 
 // To be called once, on module end
 void printDynamicProfiling() {
+  // Threads still running may be counting, but the counts are only read
+  long *Executions = calloc(NumBlocks > 0 ? NumBlocks : 1, sizeof(long));
+  if (Executions == NULL) {
+    printf("Error allocating block counts!\n");
+    exit(1);
+  }
+  for (struct ThreadCounts *T = atomic_load(&AllThreadCounts); T; T = T->Next) {
+    for (int B = 0; B < NumBlocks; B++) {
+      Executions[B] += T->Counts[B];
+    }
+  }
+  long DynamicMatched = 0;
+  long DynamicTotal = 0;
+  for (int B = 0; B < NumBlocks; B++) {
+    DynamicMatched += Executions[B] * BlockMatched[B];
+    DynamicTotal += Executions[B] * BlockTotal[B];
+  }
+
   float StaticPercent = (float)StaticMatched/StaticTotal*100;
   printf("%ld/%ld (%.2f %%) static instructions matched\n",
     StaticMatched,
@@ -58,4 +111,29 @@ void printDynamicProfiling() {
     );
 
   fclose(f);
+
+  // And the executions of each block, to FILENAME with -blocks before .csv
+  char BlocksFilename[4096];
+  const char *Suffix = strstr(FILENAME, ".csv");
+  int BaseLength = Suffix ? (int)(Suffix - FILENAME) : (int)strlen(FILENAME);
+  snprintf(BlocksFilename, sizeof(BlocksFilename), "%.*s-blocks.csv",
+    BaseLength, FILENAME);
+  f = fopen(BlocksFilename, "w");
+  if (f == NULL) {
+      printf("Error opening file!\n");
+      exit(1);
+  }
+
+  fprintf(f, "block,function,executions,matched,total\n");
+  for (int B = 0; B < NumBlocks; B++) {
+    fprintf(f, "%d,%s,%ld,%d,%d\n",
+      B,
+      BlockFunction[B],
+      Executions[B],
+      BlockMatched[B],
+      BlockTotal[B]);
+  }
+
+  fclose(f);
+  free(Executions);
 }
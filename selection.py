@@ -0,0 +1,135 @@
+from collections import namedtuple
+import heapq
+import time
+import numpy as np
+
+# Picking r stencils as maximum coverage: each stencil covers the instructions
+# of all its matches, and a combination is worth the total weight of the
+# instructions it covers (weight 1 each unless weights are given). Coverage is
+# monotone and submodular, so greedy is within (1 - 1/e) of the best.
+#	stencils: chosen stencils, in the order they were picked
+#	coverage: weight they cover
+#	upper_bound: proven upper bound on the coverage of any r stencils
+#	optimal: whether coverage is known to equal the upper bound
+Selection = namedtuple('Selection', ['stencils', 'coverage', 'upper_bound', 'optimal'])
+
+# Returns: (stencils, ptr, nodes, weight) where stencil i covers nodes
+#   nodes[ptr[i]:ptr[i+1]] (integers), with weight[node] per node
+#   subgraph_to_matches: dict from stencil name to its dfg.StencilMatches
+#   node_weights: dict from node id to weight
+def coverage_sets(subgraph_to_matches, node_weights=None):
+	stencils = list(subgraph_to_matches.keys())
+	covered = [np.unique(subgraph_to_matches[stencil].rows) for stencil in stencils]
+	ptr = np.zeros(len(stencils) + 1, dtype=np.int64)
+	np.cumsum([len(c) for c in covered], out=ptr[1:])
+	nodes = np.concatenate(covered + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+	ids = subgraph_to_matches[stencils[0]].ids if stencils else []
+	if node_weights is None:
+		weight = np.ones(len(ids))
+	else:
+		weight = np.array([node_weights.get(v, 0) for v in ids], dtype=float)
+	return stencils, ptr, nodes, weight
+
+# Returns: gain of adding each stencil given the covered node mask
+def marginal_gains(ptr, nodes, weight, covered):
+	if not len(nodes):
+		return np.zeros(len(ptr) - 1)
+	uncovered = np.where(covered[nodes], 0, weight[nodes])
+	# every stencil covers at least one node, so no segment is empty
+	return np.add.reduceat(uncovered, ptr[:-1])
+
+def _gain(ptr, nodes, weight, covered, i):
+	segment = nodes[ptr[i]:ptr[i + 1]]
+	return weight[segment][~covered[segment]].sum()
+
+def _cover(ptr, nodes, covered, i):
+	covered = covered.copy()
+	covered[nodes[ptr[i]:ptr[i + 1]]] = True
+	return covered
+
+def _top_sum(gains, r):
+	if r <= 0 or not len(gains):
+		return 0
+	if r >= len(gains):
+		return gains.sum()
+	return np.partition(gains, len(gains) - r)[-r:].sum()
+
+# lazy greedy (Minoux): a stencil's last computed gain bounds its gain now, so
+# only the top of the heap needs recomputing
+def greedy_max_coverage(ptr, nodes, weight, r):
+	num_stencils = len(ptr) - 1
+	covered = np.zeros(len(weight), dtype=bool)
+	gains = marginal_gains(ptr, nodes, weight, covered)
+	heap = [(-g, i) for i, g in enumerate(gains)]
+	heapq.heapify(heap)
+	chosen = []
+	value = 0
+	# OPT <= f(S) + sum of the r largest gains w.r.t. S, for any S; the stale
+	# heap gains are upper bounds on those gains
+	upper_bound = _top_sum(gains, r)
+	while heap and len(chosen) < min(r, num_stencils):
+		neg_gain, i = heapq.heappop(heap)
+		gain = _gain(ptr, nodes, weight, covered, i)
+		if heap and gain < -heap[0][0]:
+			heapq.heappush(heap, (-gain, i))
+			continue
+		chosen.append(i)
+		value += gain
+		covered = _cover(ptr, nodes, covered, i)
+		stale = np.array([-g for g, _ in heap])
+		upper_bound = min(upper_bound, value + _top_sum(stale, r))
+	if len(chosen) == num_stencils:
+		upper_bound = value
+	elif chosen:
+		upper_bound = min(upper_bound, value / (1 - (1 - 1 / len(chosen)) ** len(chosen)))
+	upper_bound = max(upper_bound, value)
+	return Selection(chosen, value, upper_bound, value >= upper_bound)
+
+# branch and bound over combinations of stencils (by decreasing gain), pruning
+# any branch whose coverage plus the best possible gains of the stencils left
+# can't beat the best combination so far
+#   Starts from the greedy combination; with a time budget (seconds), returns
+#   the best combination found and the largest bound still open.
+def exact_max_coverage(ptr, nodes, weight, r, time_budget=None):
+	start_time = time.time()
+	incumbent = greedy_max_coverage(ptr, nodes, weight, r)
+	best_value, best_chosen = incumbent.coverage, list(incumbent.stencils)
+	r = min(r, len(ptr) - 1)
+
+	empty = np.zeros(len(weight), dtype=bool)
+	order = np.argsort(-marginal_gains(ptr, nodes, weight, empty), kind='stable')
+	# DFS stack of (bound, chosen, next position in order, covered before the
+	# last chosen stencil, value); covering is done when an entry is popped
+	stack = [(np.inf, [], 0, empty, 0)]
+	while stack:
+		if time_budget is not None and time.time() - start_time > time_budget:
+			open_bound = max(bound for bound, _, _, _, _ in stack)
+			upper_bound = min(max(best_value, open_bound), incumbent.upper_bound)
+			return Selection(best_chosen, best_value, upper_bound, best_value >= upper_bound)
+		bound, chosen, position, covered, value = stack.pop()
+		if bound <= best_value:
+			continue
+		if chosen:
+			covered = _cover(ptr, nodes, covered, chosen[-1])
+		remaining = order[position:]
+		gains = marginal_gains(ptr, nodes, weight, covered)[remaining]
+		needed = r - len(chosen)
+		if value + _top_sum(gains, needed) <= best_value:
+			continue
+		children = []
+		for offset, i in enumerate(remaining):
+			if gains[offset] <= 0 or len(remaining) - offset < needed:
+				continue
+			child_value = value + gains[offset]
+			child_chosen = chosen + [int(i)]
+			if needed == 1:
+				if child_value > best_value:
+					best_value, best_chosen = child_value, child_chosen
+				continue
+			# bound the child by its gain plus the best gains after it
+			child_bound = child_value + _top_sum(gains[offset + 1:], needed - 1)
+			if child_bound > best_value:
+				children.append((child_bound, child_chosen, position + offset + 1, covered, child_value))
+		# explore the most promising child first
+		stack.extend(reversed(children))
+	return Selection(best_chosen, best_value, best_value, True)